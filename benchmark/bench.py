@@ -0,0 +1,242 @@
+"""
+ise_api_client.py の性能測定スクリプト。
+
+模擬ISE (mock_ise.py) とアプリをこのプロセス内で起動し、主要なルートへ
+同時にリクエストを送って、ルートごとのスループット、レイテンシ (p50 / p99)、
+1リクエストあたりのISE APIコール数を表示する。ライブのISEには接続しない。
+
+使い方:
+    python benchmark/bench.py --endpoints 10000 --latency 0.01 --requests 20 --concurrency 4
+    python benchmark/bench.py --endpoints 100000 --rate 200 --scenarios endpoints_snapshot,sessions
+    python benchmark/bench.py --json result.json # 結果をJSONでも保存する (変更前後の比較用)
+
+シナリオ (--scenarios、カンマ区切り):
+    endpoints_live      GET /get_endpoints?source=live (ISEから全件取得)
+    endpoints_refresh   GET /get_endpoints?refresh=1 (スナップショットの差分更新)
+    endpoints_snapshot  GET /get_endpoints (スナップショットから応答)
+    sessions            GET /get_sessions
+    add_delete          POST /add_endpoint と POST /delete_endpoint
+アプリの設定 (ISE_MAX_WORKERS、ISE_RATE_LIMITなど) は環境変数で変更できる。
+模擬ISEとアプリは同じプロセスで動くため、絶対値には模擬ISE側の処理時間も含まれる。
+変更前後の比較やISE APIコール数の確認に使うこと。
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCHMARK_DIR)
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+import mock_ise # noqa: E402
+
+ALL_SCENARIOS = ('endpoints_live', 'endpoints_refresh', 'endpoints_snapshot', 'sessions', 'add_delete')
+
+
+def percentile(sorted_values, pct):
+    """
+    昇順に並んだ値のパーセンタイル (nearest-rank法)。
+    """
+    if not sorted_values:
+        return 0.0
+    rank = max(1, -(-len(sorted_values) * pct // 100)) # ceil
+    return sorted_values[int(rank) - 1]
+
+
+class RouteResult:
+    """
+    1つのルートの測定結果。
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.errors = 0
+        self.elapsed = 0.0
+        self.ise_calls = {}
+
+    def summary(self):
+        latencies = sorted(self.latencies)
+        count = len(latencies)
+        # throttled (429) や not_modified (304) は "メソッド ルート" の件数の内訳なので合計に含めない
+        total_calls = sum(value for key, value in self.ise_calls.items() if ' ' in key)
+        return {
+            'route': self.name,
+            'requests': count,
+            'errors': self.errors,
+            'throughput_rps': round(count / self.elapsed, 2) if self.elapsed else 0.0,
+            'p50_ms': round(percentile(latencies, 50) * 1000, 1),
+            'p99_ms': round(percentile(latencies, 99) * 1000, 1),
+            'max_ms': round(latencies[-1] * 1000, 1) if latencies else 0.0,
+            'ise_calls': total_calls,
+            'ise_calls_per_request': round(total_calls / count, 1) if count else 0.0,
+            'ise_calls_by_route': dict(sorted(self.ise_calls.items())),
+        }
+
+
+class Benchmark:
+    """
+    模擬ISEとアプリを起動し、シナリオごとにリクエストを送って結果を集める。
+    """
+
+    def __init__(self, app_url, mock_url, concurrency):
+        self.app_url = app_url
+        self.mock_url = mock_url
+        self.concurrency = concurrency
+        self.http = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=max(10, concurrency))
+        self.http.mount('http://', adapter)
+
+    def mock_calls(self):
+        return self.http.get(f"{self.mock_url}/mock/stats").json()['calls']
+
+    def run(self, name, request_args_list):
+        """
+        request_args_list の各要素 (method, path, json) を concurrency 件ずつ同時に送り、RouteResultを返す。
+        """
+        result = RouteResult(name)
+        lock = threading.Lock()
+
+        def send(args):
+            method, path, body = args
+            started = time.perf_counter()
+            try:
+                response = self.http.request(method, f"{self.app_url}{path}", json=body, timeout=600)
+                response.content # 本文 (ストリーミング含む) を受信し終えるまでを測る
+                ok = response.status_code < 400 and not (response.headers.get('Content-Type', '').startswith('application/json')
+                                                         and response.json().get('incomplete'))
+            except requests.RequestException:
+                ok = False
+            elapsed = time.perf_counter() - started
+            with lock:
+                result.latencies.append(elapsed)
+                if not ok:
+                    result.errors += 1
+
+        before = self.mock_calls()
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            list(executor.map(send, request_args_list))
+        result.elapsed = time.perf_counter() - started
+        after = self.mock_calls()
+        result.ise_calls = {key: after[key] - before.get(key, 0) for key in after if after[key] != before.get(key, 0)}
+        return result
+
+
+def start_environment(args):
+    """
+    模擬ISEを起動し、その模擬ISEに接続するようにアプリを設定して起動する。
+    (アプリのURL, 模擬ISEのURL, 模擬ISEのデータ) を返す。
+    """
+    data = mock_ise.MockISEData(args.endpoints, args.groups, sessions=args.sessions)
+    mock_app = mock_ise.create_app(data, 'bench', 'bench', args.latency, args.jitter, args.rate, args.burst,
+                                   etags=args.etags)
+    _, mock_port = mock_ise.serve_in_background(mock_app)
+
+    # ise_api_client は読み込み時に設定を読むため、先に環境変数を設定する (.envより優先される)
+    os.environ.update({
+        'ISE_IP': '127.0.0.1',
+        'ISE_USERNAME': 'bench',
+        'ISE_PASSWORD': 'bench',
+        'ISE_PAN_NODES': '127.0.0.1',
+        'ISE_MNT_NODES': '127.0.0.1',
+        'ISE_SCHEME': 'http',
+        'ISE_ERS_PORT': str(mock_port),
+        'ISE_MNT_PORT': str(mock_port),
+        'ISE_INVENTORY_DB': '', # 測定ごとにスナップショットを作り直す
+        'HTTP_PROXY': '',
+        'ISE_SETTINGS_WATCH_INTERVAL': '0', # .envの再読み込みで上の設定が上書きされないようにする
+    })
+    os.environ.setdefault('ISE_LOG_LEVEL', 'WARNING')
+    os.environ.setdefault('ISE_ROUTE_DEADLINE', '0') # 大量データの全件取得を途中で打ち切らない
+    import ise_api_client
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    _, app_port = mock_ise.serve_in_background(ise_api_client.app)
+    return f"http://127.0.0.1:{app_port}", f"http://127.0.0.1:{mock_port}", data
+
+
+def build_scenarios(args, data):
+    """
+    シナリオ名 -> [(ルート名, [(method, path, json), ...]), ...] を返す。
+    """
+    count = args.requests
+    macs = [':'.join(f'{b:02X}' for b in (0x0E0000000000 + i).to_bytes(6, 'big')) for i in range(count)]
+    group_id = data.group_ids[0]
+    return {
+        'endpoints_live': [('GET /get_endpoints?source=live', [('GET', '/get_endpoints?source=live', None)] * count)],
+        'endpoints_refresh': [('GET /get_endpoints?refresh=1', [('GET', '/get_endpoints?refresh=1', None)] * count)],
+        'endpoints_snapshot': [('GET /get_endpoints', [('GET', '/get_endpoints', None)] * count)],
+        'sessions': [('GET /get_sessions', [('GET', '/get_sessions', None)] * count)],
+        'add_delete': [
+            ('POST /add_endpoint', [('POST', '/add_endpoint', {'mac_address': mac, 'endpoint_group_id': group_id}) for mac in macs]),
+            ('POST /delete_endpoint', [('POST', '/delete_endpoint', {'mac_address': mac}) for mac in macs]),
+        ],
+    }
+
+
+def print_table(summaries):
+    header = f"{'route':<34} {'req':>5} {'err':>4} {'req/s':>8} {'p50 ms':>9} {'p99 ms':>9} {'ISE calls/req':>14}"
+    print(header)
+    print('-' * len(header))
+    for s in summaries:
+        print(f"{s['route']:<34} {s['requests']:>5} {s['errors']:>4} {s['throughput_rps']:>8} "
+              f"{s['p50_ms']:>9} {s['p99_ms']:>9} {s['ise_calls_per_request']:>14}")
+    print()
+    for s in summaries:
+        calls = ', '.join(f"{key}={value}" for key, value in s['ise_calls_by_route'].items()) or '-'
+        print(f"{s['route']}: {calls}")
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description='ise_api_client の性能測定 (模擬ISEを使用)')
+    parser.add_argument('--endpoints', type=int, default=2000, help='模擬ISEのEndpoint数')
+    parser.add_argument('--groups', type=int, default=20, help='模擬ISEのEndpoint Group数')
+    parser.add_argument('--sessions', type=int, default=None, help='模擬ISEのActive Session数')
+    parser.add_argument('--latency', type=float, default=0.005, help='模擬ISEの応答遅延 (秒)')
+    parser.add_argument('--jitter', type=float, default=0.0, help='応答遅延のばらつき (±秒)')
+    parser.add_argument('--rate', type=float, default=0.0, help='模擬ISEの受付上限 (件/秒、超えると429。0は無制限)')
+    parser.add_argument('--burst', type=int, default=20, help='模擬ISEが瞬間的に受け付ける件数')
+    parser.add_argument('--no-etag', dest='etags', action='store_false', help='模擬ISEがETagを返さないようにする')
+    parser.add_argument('--requests', type=int, default=10, help='シナリオごとのリクエスト数')
+    parser.add_argument('--concurrency', type=int, default=2, help='同時に送るリクエスト数')
+    parser.add_argument('--scenarios', default=','.join(ALL_SCENARIOS), help='実行するシナリオ (カンマ区切り)')
+    parser.add_argument('--json', dest='json_path', help='結果をJSONで保存するファイル')
+    return parser
+
+
+def main():
+    args = build_arg_parser().parse_args()
+    scenario_names = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = [name for name in scenario_names if name not in ALL_SCENARIOS]
+    if unknown:
+        sys.exit(f"不明なシナリオ: {', '.join(unknown)} (指定できるもの: {', '.join(ALL_SCENARIOS)})")
+
+    app_url, mock_url, data = start_environment(args)
+    print(f"模擬ISE: {mock_url} (Endpoint {len(data.endpoints)}件, Session {data.session_count}件, "
+          f"遅延 {args.latency}秒, 上限 {args.rate or '無制限'}件/秒)")
+    print(f"同時リクエスト数: {args.concurrency}, シナリオごとのリクエスト数: {args.requests}\n")
+
+    benchmark = Benchmark(app_url, mock_url, args.concurrency)
+    scenarios = build_scenarios(args, data)
+    summaries = []
+    for name in scenario_names:
+        for route_name, request_args_list in scenarios[name]:
+            summary = benchmark.run(route_name, request_args_list).summary()
+            summaries.append(summary)
+
+    print_table(summaries)
+    if args.json_path:
+        with open(args.json_path, 'w', encoding='utf-8') as f:
+            json.dump({'args': vars(args), 'results': summaries}, f, ensure_ascii=False, indent=2)
+        print(f"\n結果を保存しました: {args.json_path}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,429 @@
+"""
+ISEの代わりに使うローカルの模擬サーバー (性能測定・動作確認用)。
+
+ERS API (endpoint, endpointgroup, internaluser, endpoint bulk) と
+MnT API (Session/ActiveList, Session/MACAddress) を、指定した件数の合成データで応答する。
+応答の遅延 (--latency, --jitter) と、流量超過時の429 (--rate, --burst) を再現できる。
+個別リソースのGETにはETagを付け、If-None-Matchが一致すれば304を返す (--no-etag で無効)。
+
+HTTPで待ち受けるため、ise_api_client.py 側は次のように設定する。
+    ISE_IP=127.0.0.1
+    ISE_SCHEME=http
+    ISE_ERS_PORT=<ポート>
+    ISE_MNT_PORT=<ポート>
+
+使い方:
+    python benchmark/mock_ise.py --port 9060 --endpoints 100000 --latency 0.02 --rate 100
+
+GET /mock/stats で受け付けたリクエスト数 (ルートごと) を、POST /mock/reset でその初期化を行う。
+"""
+import argparse
+import base64
+import collections
+import logging
+import random
+import threading
+import time
+import uuid
+import xml.etree.ElementTree as ET
+
+from flask import Flask, Response, jsonify, request
+from werkzeug.serving import make_server
+
+logger = logging.getLogger(__name__)
+
+ERS_MAX_PAGE_SIZE = 100
+ERS_BULK_NAMESPACE = '{identity.ers.ise.cisco.com}'
+
+
+class TokenBucket:
+    """
+    1秒あたりrate件、最大burst件まで受け付けるトークンバケット。rate=0は無制限。
+    """
+
+    def __init__(self, rate=0.0, burst=10):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def try_acquire(self):
+        if self.rate <= 0:
+            return True
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+            self._updated_at = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            return False
+
+
+class MockISEData:
+    """
+    模擬サーバーが応答するデータ。Endpointの追加・削除はスレッドセーフに行う。
+    """
+
+    def __init__(self, endpoints=1000, groups=20, internal_users=50, sessions=None, seed=0):
+        self.group_ids = [str(uuid.UUID(int=i + 1)) for i in range(groups)]
+        self.groups = {group_id: f"MockGroup{i:03d}" for i, group_id in enumerate(self.group_ids)}
+        self.internal_users = collections.OrderedDict(
+            (str(uuid.UUID(int=2 ** 64 + i)), f"user{i:05d}") for i in range(internal_users)
+        )
+        self.endpoints = collections.OrderedDict() # id -> (mac, group_id)
+        self.ids_by_mac = {}
+        for i in range(endpoints):
+            endpoint_id = str(uuid.UUID(int=2 ** 96 + i))
+            mac = ':'.join(f'{b:02X}' for b in (0x020000000000 + i).to_bytes(6, 'big'))
+            self.endpoints[endpoint_id] = (mac, self.group_ids[i % groups])
+            self.ids_by_mac[mac] = endpoint_id
+        self.session_count = min(endpoints, 1000) if sessions is None else sessions
+        self._endpoint_ids = None # ページング用のID一覧 (追加・削除で作り直す)
+        self._random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def endpoint_ids(self):
+        with self.lock:
+            if self._endpoint_ids is None:
+                self._endpoint_ids = list(self.endpoints)
+            return self._endpoint_ids
+
+    def add_endpoint(self, mac, group_id):
+        """
+        Endpointを追加してIDを返す。同じMACアドレスが登録済みの場合はNoneを返す。
+        """
+        mac = mac.upper()
+        with self.lock:
+            if mac in self.ids_by_mac:
+                return None
+            endpoint_id = str(uuid.UUID(int=self._random.getrandbits(128)))
+            self.endpoints[endpoint_id] = (mac, group_id)
+            self.ids_by_mac[mac] = endpoint_id
+            self._endpoint_ids = None
+            return endpoint_id
+
+    def delete_endpoint(self, endpoint_id):
+        with self.lock:
+            entry = self.endpoints.pop(endpoint_id, None)
+            if entry is None:
+                return False
+            self.ids_by_mac.pop(entry[0], None)
+            self._endpoint_ids = None
+            return True
+
+
+def create_app(data, username='admin', password='admin', latency=0.0, jitter=0.0,
+               rate=0.0, burst=10, retry_after=1, etags=True, bulk_delay=0.0):
+    """
+    模擬サーバーのFlaskアプリを作成する。
+    latency/jitter: 各リクエストに加える遅延 (秒、latency±jitterの一様分布)
+    rate/burst: 1秒あたりの受付件数の上限と瞬間的な上限 (超えた分は429とRetry-Afterを返す)
+    etags: 個別リソースのGETにETagを付けて条件付きGET (If-None-Match) に304で応答する
+    bulk_delay: Bulk処理の受付から完了 (executionStatus: COMPLETED) までの秒数
+    """
+    app = Flask('mock_ise')
+    app.data = data
+    app.calls = collections.Counter()
+    app.calls_lock = threading.Lock()
+    limiter = TokenBucket(rate, burst)
+    expected_auth = 'Basic ' + base64.b64encode(f"{username}:{password}".encode('utf-8')).decode('utf-8')
+
+    def count(key):
+        with app.calls_lock:
+            app.calls[key] += 1
+
+    @app.before_request
+    def simulate_ise():
+        if request.path.startswith('/mock/'):
+            return None
+        rule = request.url_rule.rule if request.url_rule else request.path
+        count(f"{request.method} {rule}")
+        if request.headers.get('Authorization') != expected_auth:
+            count('unauthorized')
+            return jsonify({'ERSResponse': {'messages': [{'title': 'Unauthorized'}]}}), 401
+        if not limiter.try_acquire():
+            count('throttled')
+            return Response('Too Many Requests', status=429, headers={'Retry-After': str(retry_after)})
+        delay = latency + random.uniform(-jitter, jitter) if jitter else latency
+        if delay > 0:
+            time.sleep(delay)
+        return None
+
+    @app.after_request
+    def conditional_get(response):
+        if (etags and request.method == 'GET' and response.status_code == 200
+                and request.endpoint in ('endpoint', 'endpoint_group', 'internal_user')):
+            response.add_etag()
+            response.make_conditional(request)
+            if response.status_code == 304:
+                count('not_modified')
+        return response
+
+    def search_result(items, total):
+        """
+        ERS一覧APIの応答 (SearchResult) を作成する。itemsは現在ページの要素。
+        """
+        size = min(request.args.get('size', 20, type=int), ERS_MAX_PAGE_SIZE)
+        page = request.args.get('page', 1, type=int)
+        result = {'total': total, 'resources': items}
+        base = f"{request.host_url.rstrip('/')}{request.path}"
+        if page * size < total:
+            result['nextPage'] = {'rel': 'next', 'href': f"{base}?size={size}&page={page + 1}", 'type': 'application/json'}
+        if page > 1:
+            result['previousPage'] = {'rel': 'previous', 'href': f"{base}?size={size}&page={page - 1}", 'type': 'application/json'}
+        return jsonify({'SearchResult': result})
+
+    def page_slice(items):
+        size = min(request.args.get('size', 20, type=int), ERS_MAX_PAGE_SIZE)
+        page = max(1, request.args.get('page', 1, type=int))
+        return items[(page - 1) * size:page * size]
+
+    def link(path):
+        return {'rel': 'self', 'href': f"{request.host_url.rstrip('/')}{path}", 'type': 'application/json'}
+
+    def ers_error(status, title):
+        return jsonify({'ERSResponse': {'operation': f"{request.method}-{request.path}",
+                                        'messages': [{'title': title, 'type': 'ERROR'}]}}), status
+
+    @app.route('/ers/config/endpoint', methods=['GET'])
+    def list_endpoints():
+        filter_value = request.args.get('filter') # mac.EQ.xx:xx:... のみ対応
+        if filter_value:
+            mac = filter_value.split('.', 2)[-1].upper()
+            endpoint_id = data.ids_by_mac.get(mac)
+            items = [{'id': endpoint_id, 'name': mac, 'link': link(f"/ers/config/endpoint/{endpoint_id}")}] if endpoint_id else []
+            return search_result(items, len(items))
+        ids = data.endpoint_ids()
+        items = []
+        for endpoint_id in page_slice(ids):
+            entry = data.endpoints.get(endpoint_id)
+            if entry is not None:
+                items.append({'id': endpoint_id, 'name': entry[0], 'link': link(f"/ers/config/endpoint/{endpoint_id}")})
+        return search_result(items, len(ids))
+
+    def endpoint_detail(endpoint_id, entry):
+        mac, group_id = entry
+        return jsonify({'ERSEndPoint': {
+            'id': endpoint_id,
+            'name': mac,
+            'mac': mac,
+            'groupId': group_id,
+            'staticGroupAssignment': True,
+            'staticProfileAssignment': False,
+            'link': link(f"/ers/config/endpoint/{endpoint_id}"),
+        }})
+
+    @app.route('/ers/config/endpoint/<endpoint_id>', methods=['GET', 'DELETE'])
+    def endpoint(endpoint_id):
+        if request.method == 'DELETE':
+            if not data.delete_endpoint(endpoint_id):
+                return ers_error(404, f"Resource with id {endpoint_id} not found")
+            return '', 204
+        entry = data.endpoints.get(endpoint_id)
+        if entry is None:
+            return ers_error(404, f"Resource with id {endpoint_id} not found")
+        return endpoint_detail(endpoint_id, entry)
+
+    @app.route('/ers/config/endpoint/name/<name>', methods=['GET'])
+    def endpoint_by_name(name):
+        endpoint_id = data.ids_by_mac.get(name.upper())
+        entry = data.endpoints.get(endpoint_id) if endpoint_id else None
+        if entry is None:
+            return ers_error(404, f"Resource with name {name} not found")
+        return endpoint_detail(endpoint_id, entry)
+
+    @app.route('/ers/config/endpoint', methods=['POST'])
+    def create_endpoint():
+        payload = (request.get_json(silent=True) or {}).get('ERSEndPoint') or {}
+        if not payload.get('mac'):
+            return ers_error(400, 'mac is required')
+        endpoint_id = data.add_endpoint(payload['mac'], payload.get('groupId') or data.group_ids[0])
+        if endpoint_id is None:
+            return ers_error(400, f"Unable to create the endpoint. {payload['mac']} already exists.")
+        return '', 201, {'Location': f"{request.host_url.rstrip('/')}/ers/config/endpoint/{endpoint_id}"}
+
+    @app.route('/ers/config/endpointgroup', methods=['GET'])
+    def list_endpoint_groups():
+        items = [{'id': group_id, 'name': data.groups[group_id], 'link': link(f"/ers/config/endpointgroup/{group_id}")}
+                 for group_id in page_slice(data.group_ids)]
+        return search_result(items, len(data.group_ids))
+
+    @app.route('/ers/config/endpointgroup/<group_id>', methods=['GET'])
+    def endpoint_group(group_id):
+        name = data.groups.get(group_id)
+        if name is None:
+            return ers_error(404, f"Resource with id {group_id} not found")
+        return jsonify({'EndPointGroup': {'id': group_id, 'name': name, 'description': '', 'systemDefined': False,
+                                          'link': link(f"/ers/config/endpointgroup/{group_id}")}})
+
+    @app.route('/ers/config/internaluser', methods=['GET'])
+    def list_internal_users():
+        ids = list(data.internal_users)
+        items = [{'id': user_id, 'name': data.internal_users[user_id], 'link': link(f"/ers/config/internaluser/{user_id}")}
+                 for user_id in page_slice(ids)]
+        return search_result(items, len(ids))
+
+    @app.route('/ers/config/internaluser/<user_id>', methods=['GET'])
+    def internal_user(user_id):
+        name = data.internal_users.get(user_id)
+        if name is None:
+            return ers_error(404, f"Resource with id {user_id} not found")
+        return jsonify({'InternalUser': {'id': user_id, 'name': name, 'enabled': True,
+                                         'identityGroups': data.group_ids[0], 'link': link(f"/ers/config/internaluser/{user_id}")}})
+
+    bulk_jobs = {}
+
+    @app.route('/ers/config/endpoint/bulk/submit', methods=['PUT'])
+    def bulk_submit():
+        try:
+            root = ET.fromstring(request.get_data())
+        except ET.ParseError:
+            return ers_error(400, 'Invalid bulk request')
+        operation = root.attrib.get('operationType')
+        statuses = []
+        if operation == 'create':
+            for element in root.iter(f'{ERS_BULK_NAMESPACE}endpoint'):
+                mac = (element.findtext('mac') or '').upper()
+                endpoint_id = data.add_endpoint(mac, element.findtext('groupId') or data.group_ids[0])
+                statuses.append({'id': endpoint_id or '', 'name': mac,
+                                 'resourceExecutionStatus': 'SUCCESS' if endpoint_id else 'FAIL',
+                                 'status': '' if endpoint_id else f"{mac} already exists"})
+        elif operation == 'delete':
+            for element in root.iter('id'):
+                deleted = data.delete_endpoint(element.text)
+                statuses.append({'id': element.text, 'resourceExecutionStatus': 'SUCCESS' if deleted else 'FAIL',
+                                 'status': '' if deleted else 'not found'})
+        else:
+            return ers_error(400, f"Unsupported operationType: {operation}")
+        bulk_id = str(uuid.uuid4())
+        bulk_jobs[bulk_id] = {
+            'bulkId': bulk_id,
+            'executionStatus': 'COMPLETED',
+            'completedAt': time.monotonic() + bulk_delay,
+            'operationType': operation,
+            'resourcesCount': len(statuses),
+            'successCount': sum(1 for status in statuses if status['resourceExecutionStatus'] == 'SUCCESS'),
+            'failCount': sum(1 for status in statuses if status['resourceExecutionStatus'] != 'SUCCESS'),
+            'resourcesStatus': statuses,
+        }
+        return '', 202, {'Location': f"{request.host_url.rstrip('/')}/ers/config/endpoint/bulk/{bulk_id}"}
+
+    @app.route('/ers/config/endpoint/bulk/<bulk_id>', methods=['GET'])
+    def bulk_status(bulk_id):
+        job = bulk_jobs.get(bulk_id)
+        if job is None:
+            return ers_error(404, f"Bulk {bulk_id} not found")
+        job = {key: value for key, value in job.items() if key != 'completedAt'}
+        if time.monotonic() < bulk_jobs[bulk_id]['completedAt']:
+            job.update(executionStatus='IN_PROGRESS', resourcesStatus=[])
+        return jsonify({'BulkStatus': job})
+
+    @app.route('/admin/API/mnt/Session/ActiveList', methods=['GET'])
+    def active_list():
+        ids = data.endpoint_ids()[:data.session_count]
+
+        def generate():
+            yield f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?><activeList noOfActiveSession="{len(ids)}">'
+            for i, endpoint_id in enumerate(ids):
+                entry = data.endpoints.get(endpoint_id)
+                if entry is None:
+                    continue
+                yield (
+                    '<activeSession>'
+                    f'<user_name>user{i:05d}</user_name>'
+                    f'<calling_station_id>{entry[0]}</calling_station_id>'
+                    '<nas_ip_address>10.0.0.1</nas_ip_address>'
+                    f'<acct_session_id>{i:08X}</acct_session_id>'
+                    f'<audit_session_id>0A00000100{i:014X}</audit_session_id>'
+                    '<server>mock-ise</server>'
+                    f'<framed_ip_address>10.{(i >> 16) & 255}.{(i >> 8) & 255}.{i & 255}</framed_ip_address>'
+                    '</activeSession>'
+                )
+            yield '</activeList>'
+
+        return Response(generate(), mimetype='application/xml')
+
+    @app.route('/admin/API/mnt/Session/MACAddress/<mac>', methods=['GET'])
+    def session_by_mac(mac):
+        endpoint_id = data.ids_by_mac.get(mac.upper())
+        ids = data.endpoint_ids()[:data.session_count]
+        if endpoint_id is None or endpoint_id not in ids:
+            return Response('', status=404)
+        i = ids.index(endpoint_id)
+        return Response(
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?><sessionParameters>'
+            '<passed xsi:type="xs:boolean" xmlns:xs="http://www.w3.org/2001/XMLSchema" '
+            'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">true</passed>'
+            f'<user_name>user{i:05d}</user_name>'
+            f'<calling_station_id>{mac.upper()}</calling_station_id>'
+            '<nas_ip_address>10.0.0.1</nas_ip_address>'
+            f'<acct_session_id>{i:08X}</acct_session_id>'
+            f'<audit_session_id>0A00000100{i:014X}</audit_session_id>'
+            f'<framed_ip_address>10.{(i >> 16) & 255}.{(i >> 8) & 255}.{i & 255}</framed_ip_address>'
+            '<identity_group>Profiled</identity_group>'
+            '<endpoint_policy>Unknown</endpoint_policy>'
+            '<auth_acs_timestamp>2024-01-01T00:00:00.000+09:00</auth_acs_timestamp>'
+            '</sessionParameters>',
+            mimetype='application/xml',
+        )
+
+    @app.route('/mock/stats', methods=['GET'])
+    def mock_stats():
+        with app.calls_lock:
+            calls = dict(app.calls)
+        return jsonify({'calls': calls, 'endpoints': len(data.endpoints), 'sessions': data.session_count})
+
+    @app.route('/mock/reset', methods=['POST'])
+    def mock_reset():
+        with app.calls_lock:
+            app.calls.clear()
+        return jsonify({'message': 'reset'})
+
+    return app
+
+
+def serve_in_background(app, host='127.0.0.1', port=0):
+    """
+    別スレッドでアプリを起動し、(サーバー, ポート番号) を返す。port=0は空いているポートを使う。
+    """
+    server = make_server(host, port, app, threaded=True)
+    threading.Thread(target=server.serve_forever, name='mock-ise', daemon=True).start()
+    return server, server.server_port
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description='ISEの模擬サーバー (ERS / MnT API)')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9060)
+    parser.add_argument('--endpoints', type=int, default=1000, help='Endpoint数')
+    parser.add_argument('--groups', type=int, default=20, help='Endpoint Group数')
+    parser.add_argument('--internal-users', type=int, default=50, help='内部ユーザー数')
+    parser.add_argument('--sessions', type=int, default=None, help='Active Session数 (既定はEndpoint数と1000の小さい方)')
+    parser.add_argument('--username', default='admin')
+    parser.add_argument('--password', default='admin')
+    parser.add_argument('--latency', type=float, default=0.0, help='各リクエストに加える遅延 (秒)')
+    parser.add_argument('--jitter', type=float, default=0.0, help='遅延のばらつき (±秒)')
+    parser.add_argument('--rate', type=float, default=0.0, help='1秒あたりの受付件数の上限 (超えると429、0は無制限)')
+    parser.add_argument('--burst', type=int, default=10, help='瞬間的に受け付ける件数')
+    parser.add_argument('--retry-after', type=int, default=1, help='429応答のRetry-After (秒)')
+    parser.add_argument('--no-etag', dest='etags', action='store_false', help='ETagを付けない (条件付きGETに対応しないISEを再現)')
+    parser.add_argument('--bulk-delay', type=float, default=0.0, help='Bulk処理が完了するまでの秒数')
+    return parser
+
+
+def main():
+    args = build_arg_parser().parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    data = MockISEData(args.endpoints, args.groups, args.internal_users, args.sessions)
+    app = create_app(data, args.username, args.password, args.latency, args.jitter,
+                     args.rate, args.burst, args.retry_after, args.etags, args.bulk_delay)
+    logger.info("模擬ISEを起動します: http://%s:%s (Endpoint %s件, Session %s件)",
+                args.host, args.port, len(data.endpoints), data.session_count)
+    make_server(args.host, args.port, app, threaded=True).serve_forever()
+
+
+if __name__ == '__main__':
+    main()
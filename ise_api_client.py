@@ -1,34 +1,127 @@
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, render_template, request, jsonify, Response, stream_with_context, g
 import requests
 import json
 import urllib3
-from dotenv import load_dotenv
+from dotenv import load_dotenv, find_dotenv, dotenv_values
 import os
+import re
 import logging
 import base64
+import csv # 一括処理のCSVアップロード
+import io
+import sqlite3 # Endpointインベントリの永続化
 import xml.etree.ElementTree as ET # XML処理
 import time # API呼び出し間の待機に必要
+import random # 再試行間隔のジッター
+import datetime
+import email.utils # Retry-After (HTTP日付) の解釈
+import sys
+import threading # 共有クライアントの排他制御
+import queue # ログの非同期出力
+import logging.handlers
+import atexit
+import itertools
+from collections import OrderedDict, deque, defaultdict
+from urllib.parse import urlsplit, parse_qsl
+from requests.adapters import HTTPAdapter # コネクションプール設定
+from concurrent.futures import ThreadPoolExecutor, Future # Endpoint詳細の並行取得
+from concurrent.futures import TimeoutError as FutureTimeoutError
+import asyncio # 非同期ルート
+import contextlib
+import contextvars # 処理期限をワーカースレッド・タスクへ引き継ぐ
+import functools
+import inspect
+from dataclasses import dataclass, field, fields # 設定オブジェクト
+from types import MappingProxyType
+
+try:
+    import httpx # 非同期ISEクライアント (非同期ルートを使う場合のみ必要)
+except ImportError:
+    httpx = None
+
+try:
+    import prometheus_client # /metrics (Prometheus形式のメトリクス) を使う場合のみ必要
+except ImportError:
+    prometheus_client = None
+
+try:
+    from opentelemetry import trace as otel_trace # トレースを使う場合のみ必要 (opentelemetry-sdk)
+    from opentelemetry import context as otel_context
+    from opentelemetry.propagate import extract as extract_trace_context
+    from opentelemetry.sdk.resources import Resource
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter
+    from opentelemetry.sdk.trace.sampling import ParentBased, TraceIdRatioBased
+except ImportError:
+    otel_trace = None
 
 # 自己署名証明書などを使用している場合のSSL警告を無効にする（開発時のみ使用し、本番環境では警告を有効にしてください）
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 app = Flask(__name__)
-load_dotenv()
 
 # ロギング設定
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s [%(levelname)s] %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S',
-    )
-logger = logging.getLogger(__name__)
+#   ISE_LOG_LEVEL       : ログレベル (DEBUG / INFO / WARNING / ERROR、既定はINFO)
+#   ISE_LOG_FORMAT      : text (既定) または json (1行1JSON)
+#   ISE_LOG_SAMPLE_RATE : Endpoint1件ごとのDEBUGログをN件に1件だけ出力する (1は全件)
+# ログの書き込みはQueueListenerのスレッドで行い、リクエスト処理をI/Oで待たせない。
+class JsonLogFormatter(logging.Formatter):
+    """
+    ログを1行1JSON (time, level, logger, thread, message) で出力するフォーマッター。
+    """
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record, '%Y-%m-%dT%H:%M:%S'),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+_log_listener = None
+
+
+def configure_logging():
+    """
+    環境変数に従ってルートロガーを設定する。呼び出し元のスレッドはキューへ積むだけで、
+    フォーマット後の書き込みはQueueListenerのスレッドが行う。
+    """
+    global _log_listener
+    level_name = (os.getenv('ISE_LOG_LEVEL') or 'INFO').strip().upper()
+    level = logging.getLevelName(level_name)
+    if not isinstance(level, int):
+        level = logging.INFO
+
+    handler = logging.StreamHandler()
+    if (os.getenv('ISE_LOG_FORMAT') or 'text').strip().lower() == 'json':
+        handler.setFormatter(JsonLogFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(
+            fmt='%(asctime)s [%(levelname)s] %(message)s',
+            datefmt='%Y-%m-%d %H:%M:%S',
+        ))
+
+    if _log_listener is not None:
+        _log_listener.stop()
+    log_queue = queue.SimpleQueue()
+    root_logger = logging.getLogger()
+    root_logger.handlers[:] = [logging.handlers.QueueHandler(log_queue)]
+    root_logger.setLevel(level)
+    _log_listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    _log_listener.start()
+    atexit.register(_log_listener.stop) # 終了時にキューに残ったログを書き出す
 
-# 環境変数はFlaskの実行時に読み込まれますが、関数内でos.getenvで都度取得します。
-# グローバル変数は削除またはコメントアウトします。
-# ISE_IP = os.getenv('ISE_IP')
-# ISE_USERNAME = os.getenv('ISE_USERNAME')
-# ISE_PASSWORD = os.getenv('ISE_PASSWORD')
-# HTTP_PROXY = os.getenv('HTTP_PROXY')
+
+# .envを読み込む前の環境変数 (.envより優先する。設定の再読み込みでも.envの値で上書きしない)
+_BASE_ENVIRON = dict(os.environ)
+load_dotenv() # ログ設定も.envから読み込めるよう、先に読み込む
+configure_logging()
+logger = logging.getLogger(__name__)
 
 # =====================================================
 # ヘルパー関数群
@@ -36,18 +129,17 @@ logger = logging.getLogger(__name__)
 
 def get_ise_connection_details():
     """
-    .envファイルからISEの接続情報を取得する。
-    APIコールを行う関数内でこれを呼び出す。
+    .envファイルから読み込んだISEの接続情報を返す。
     """
-    # load_dotenv() はスクリプト冒頭で行われているためここでは不要ですが、
-    # 念のため必要な環境変数が取得できるか確認します。
-    ise_ip = os.getenv('ISE_IP')
-    username = os.getenv('ISE_USERNAME')
-    password = os.getenv('ISE_PASSWORD')
-    http_proxy = os.getenv('HTTP_PROXY')
+    # 環境変数は起動時 (または再読み込み時) に一度だけ読み込んだ設定 (Settings) から取得します。
+    settings = get_settings()
+    ise_ip = settings.ise_ip
+    username = settings.username
+    password = settings.password
+    http_proxy = settings.http_proxy
 
     # 必須の設定がない場合はログを出力
-    if not ise_ip or not username or not password:
+    if not settings.configured:
         logger.error(".envファイルにISE_IP、ISE_USERNAMEまたはISE_PASSWORDが設定されていません")
         # エラーの場合はNoneを返す
         return None, None, None, None
@@ -76,8 +168,7 @@ def get_proxies():
     HTTP_PROXY環境変数が設定されている場合はプロキシ設定を返し、
     設定されていない場合はNoneを返す。
     """
-    proxy = os.getenv('HTTP_PROXY') # 環境変数から都度取得
-    logger.debug(f"HTTP_PROXY: {proxy}")
+    proxy = get_settings().http_proxy
     if proxy:
         return {
             'http': proxy,
@@ -86,50 +177,4107 @@ def get_proxies():
     else:
         return None
 
-# Helper function to get Group Name by ID
-def get_group_name_by_id(ise_ip, username, password, http_proxy, group_id):
+
+def _env_int(name, default):
+    """
+    環境変数を整数として取得する。未設定または不正な値の場合はデフォルト値を返す。
+    """
+    value = os.getenv(name)
+    if value is None or value.strip() == '':
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        logger.warning("%s の値が不正です (%s)。デフォルト値 %s を使用します。", name, value, default)
+        return default
+
+
+def _env_float(name, default):
+    """
+    環境変数を小数として取得する。未設定または不正な値の場合はデフォルト値を返す。
+    """
+    value = os.getenv(name)
+    if value is None or value.strip() == '':
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        logger.warning("%s の値が不正です (%s)。デフォルト値 %s を使用します。", name, value, default)
+        return default
+
+
+_log_sample_counters = defaultdict(itertools.count)
+
+
+def debug_sampled(key, msg, *args):
+    """
+    Endpoint1件ごとなど、件数に比例して出力されるDEBUGログ用。
+    DEBUGが無効な場合は何もせず、有効な場合も同じkeyのログを ISE_LOG_SAMPLE_RATE 件に1件だけ出力する。
+    """
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+    count = next(_log_sample_counters[key])
+    sample_rate = get_settings().log_sample_rate
+    if count % sample_rate == 0:
+        logger.debug(msg + " [%s件に1件を記録, %s件目]", *args, sample_rate, count + 1)
+
+
+def _env_list(name):
+    """
+    カンマ区切りの環境変数をリストとして取得する。未設定の場合は空のリスト。
+    """
+    return [item.strip() for item in (os.getenv(name) or '').split(',') if item.strip()]
+
+
+def _status_code_of(e):
+    """
+    RequestExceptionからHTTPステータスコードを取り出す。レスポンスがない場合は'N/A'。
+    """
+    if hasattr(e, 'response') and e.response is not None:
+        return e.response.status_code
+    return 'N/A'
+
+
+# =====================================================
+# 設定 (起動時に一度だけ読み込む)
+# =====================================================
+
+@dataclass(frozen=True)
+class Settings:
+    """
+    .env (環境変数) から読み込んだ設定。生成後は変更しない。
+    設定を変更する場合は reload_settings() で新しいSettingsに差し替える。
+    ログレベル・形式、トレースの出力先、MnTの読み込み単位、Session変更履歴の件数は起動時にのみ読み込むため、
+    変更には再起動が必要。
+    """
+    ise_ip: str = None
+    username: str = None
+    password: str = field(default=None, repr=False)
+    http_proxy: str = None
+    pan_nodes: tuple = ()
+    mnt_nodes: tuple = ()
+    # 接続先のスキームとポート (ISEの手前にリバースプロキシを置く場合やローカルの模擬サーバー用)
+    ise_scheme: str = 'https'
+    ers_port: int = 9060
+    mnt_port: int = 443
+    # 接続・流量制御
+    pool_connections: int = 10
+    pool_maxsize: int = 20
+    connect_timeout: float = 5.0
+    read_timeout: float = 30.0
+    rate_limit: float = 0.0
+    rate_burst: int = 10
+    max_concurrency: int = 20
+    retry_max: int = 5
+    retry_base_delay: float = 0.5
+    retry_max_delay: float = 30.0
+    node_failure_threshold: int = 3
+    node_cooldown: float = 30.0
+    async_max_connections: int = 50
+    async_max_concurrency: int = 50
+    # 処理期限・並行数
+    route_deadline: float = 60.0
+    deadline_margin: float = 1.0
+    max_workers: int = 8
+    max_workers_limit: int = 32
+    # Bulk処理
+    bulk_poll_interval: int = 1
+    bulk_timeout: int = 300
+    bulk_chunk_size: int = 500
+    # Endpointインベントリ
+    inventory_max_age: int = 300
+    inventory_full_refresh_interval: int = 3600
+    inventory_refresh_interval: int = 0
+    # バックグラウンド更新 (Active Session・Group名) とゆらぎ
+    session_max_age: int = 30
+    session_refresh_interval: int = 0
+    group_refresh_interval: int = 0
+    refresh_jitter: float = 0.1
+    # ERSレスポンスのHTTPキャッシュ (ETag / Last-Modified、件数0で無効)
+    http_cache_maxsize: int = 10000
+    http_cache_ttl: float = 0.0
+    http_cache_ttl_endpoint: float = 0.0
+    http_cache_ttl_endpointgroup: float = 0.0
+    http_cache_db: str = None
+    # プロセス内キャッシュの容量と有効期間 (秒)。設定の再読み込みで変更される
+    group_cache_maxsize: int = 1024
+    group_cache_ttl: int = 300
+    mac_index_maxsize: int = 200000
+    mac_index_ttl: int = 300
+    session_lookup_cache_maxsize: int = 4096
+    session_lookup_cache_ttl: int = 10
+    session_lookup_max_items: int = 500
+    # Endpointインベントリの保存先 (空はメモリのみ)
+    inventory_db: str = 'endpoint_inventory.sqlite3'
+    # Endpoint1件ごとのDEBUGログをN件に1件だけ出力する
+    log_sample_rate: int = 100
+    # .envの変更監視間隔 (秒、0は監視しない)
+    settings_watch_interval: int = 0
+
+    @classmethod
+    def from_env(cls):
+        """
+        現在の環境変数からSettingsを作成する。
+        """
+        ise_ip = os.getenv('ISE_IP')
+        rate_limit = _env_float('ISE_RATE_LIMIT', 0.0)
+        http_cache_ttl = _env_float('ISE_HTTP_CACHE_TTL', 0.0)
+        return cls(
+            ise_ip=ise_ip,
+            username=os.getenv('ISE_USERNAME'),
+            password=os.getenv('ISE_PASSWORD'),
+            http_proxy=os.getenv('HTTP_PROXY'),
+            # 役割ごとのノード一覧 (先頭がprimary)。未設定の役割は ISE_IP の1台のみ
+            pan_nodes=tuple(_env_list('ISE_PAN_NODES') or ([ise_ip] if ise_ip else [])),
+            mnt_nodes=tuple(_env_list('ISE_MNT_NODES') or ([ise_ip] if ise_ip else [])),
+            ise_scheme=(os.getenv('ISE_SCHEME') or 'https').strip().lower(),
+            ers_port=_env_int('ISE_ERS_PORT', 9060),
+            mnt_port=_env_int('ISE_MNT_PORT', 443),
+            pool_connections=_env_int('ISE_POOL_CONNECTIONS', 10),
+            pool_maxsize=_env_int('ISE_POOL_MAXSIZE', 20),
+            connect_timeout=_env_float('ISE_CONNECT_TIMEOUT', 5.0),
+            read_timeout=_env_float('ISE_READ_TIMEOUT', 30.0),
+            rate_limit=rate_limit,
+            rate_burst=_env_int('ISE_RATE_BURST', max(1, int(rate_limit)) if rate_limit else 10),
+            max_concurrency=_env_int('ISE_MAX_CONCURRENCY', 20),
+            retry_max=_env_int('ISE_RETRY_MAX', 5),
+            retry_base_delay=_env_float('ISE_RETRY_BASE_DELAY', 0.5),
+            retry_max_delay=_env_float('ISE_RETRY_MAX_DELAY', 30.0),
+            node_failure_threshold=_env_int('ISE_NODE_FAILURE_THRESHOLD', 3),
+            node_cooldown=_env_float('ISE_NODE_COOLDOWN', 30.0),
+            async_max_connections=_env_int('ISE_ASYNC_MAX_CONNECTIONS', 50),
+            async_max_concurrency=_env_int('ISE_ASYNC_MAX_CONCURRENCY', 50),
+            route_deadline=_env_float('ISE_ROUTE_DEADLINE', 60.0),
+            deadline_margin=_env_float('ISE_DEADLINE_MARGIN', 1.0),
+            max_workers=_env_int('ISE_MAX_WORKERS', 8),
+            max_workers_limit=_env_int('ISE_MAX_WORKERS_LIMIT', 32),
+            bulk_poll_interval=_env_int('ISE_BULK_POLL_INTERVAL', 1),
+            bulk_timeout=_env_int('ISE_BULK_TIMEOUT', 300),
+            bulk_chunk_size=_env_int('ISE_BULK_CHUNK_SIZE', 500),
+            inventory_max_age=_env_int('ISE_INVENTORY_MAX_AGE', 300),
+            inventory_full_refresh_interval=_env_int('ISE_INVENTORY_FULL_REFRESH_INTERVAL', 3600),
+            inventory_refresh_interval=_env_int('ISE_INVENTORY_REFRESH_INTERVAL', 0),
+            session_max_age=_env_int('ISE_SESSION_MAX_AGE', 30),
+            session_refresh_interval=_env_int('ISE_SESSION_REFRESH_INTERVAL', 0),
+            group_refresh_interval=_env_int('ISE_GROUP_REFRESH_INTERVAL', 0),
+            refresh_jitter=min(1.0, max(0.0, _env_float('ISE_REFRESH_JITTER', 0.1))),
+            http_cache_maxsize=_env_int('ISE_HTTP_CACHE_MAXSIZE', 10000),
+            http_cache_ttl=http_cache_ttl,
+            http_cache_ttl_endpoint=_env_float('ISE_HTTP_CACHE_TTL_ENDPOINT', http_cache_ttl),
+            http_cache_ttl_endpointgroup=_env_float('ISE_HTTP_CACHE_TTL_ENDPOINTGROUP', http_cache_ttl),
+            http_cache_db=os.getenv('ISE_HTTP_CACHE_DB') or None,
+            group_cache_maxsize=_env_int('ISE_GROUP_CACHE_MAXSIZE', 1024),
+            group_cache_ttl=_env_int('ISE_GROUP_CACHE_TTL', 300),
+            mac_index_maxsize=_env_int('ISE_MAC_INDEX_MAXSIZE', 200000),
+            mac_index_ttl=_env_int('ISE_MAC_INDEX_TTL', 300),
+            session_lookup_cache_maxsize=_env_int('ISE_SESSION_LOOKUP_CACHE_MAXSIZE', 4096),
+            session_lookup_cache_ttl=_env_int('ISE_SESSION_LOOKUP_CACHE_TTL', 10),
+            session_lookup_max_items=_env_int('ISE_SESSION_LOOKUP_MAX_ITEMS', 500),
+            inventory_db=os.getenv('ISE_INVENTORY_DB', 'endpoint_inventory.sqlite3'),
+            log_sample_rate=max(1, _env_int('ISE_LOG_SAMPLE_RATE', 100)),
+            settings_watch_interval=_env_int('ISE_SETTINGS_WATCH_INTERVAL', 0),
+        )
+
+    @property
+    def configured(self):
+        """
+        ISEへの接続に必須の設定 (ISE_IP、ISE_USERNAME、ISE_PASSWORD) が揃っているかどうか。
+        """
+        return bool(self.ise_ip and self.username and self.password)
+
+    def changed_fields(self, other):
+        """
+        otherと値が異なる設定項目の名前のリストを返す。
+        """
+        return [f.name for f in fields(self) if getattr(self, f.name) != getattr(other, f.name)]
+
+
+# .envファイルの場所 (起動時の load_dotenv と同じ探し方)
+ENV_FILE_PATH = find_dotenv()
+
+_settings = None
+_settings_lock = threading.Lock()
+# 最後に.envから環境変数へ反映したキー (起動時の環境変数にあるキーは反映しない)
+_dotenv_keys = set(dotenv_values(ENV_FILE_PATH)) - set(_BASE_ENVIRON) if ENV_FILE_PATH else set()
+_settings_reload_hooks = []
+
+
+def get_settings():
+    """
+    現在の設定を返す。初回呼び出し時に環境変数から読み込む。
+    """
+    global _settings
+    if _settings is None:
+        with _settings_lock:
+            if _settings is None:
+                _settings = Settings.from_env()
+    return _settings
+
+
+def on_settings_reload(func):
+    """
+    reload_settings() で設定が変わった場合に func(新しいSettings) を呼び出すよう登録するデコレーター。
+    モジュール読み込み時に設定から作成したキャッシュなどに変更を反映するために使う。
+    """
+    _settings_reload_hooks.append(func)
+    return func
+
+
+def _reload_dotenv(path):
+    """
+    .envを読み込み直して環境変数に反映する。起動時の load_dotenv と同じく、
+    起動時に設定されていた環境変数は.envの値で上書きしない。
+    前回の.envにあって今回なくなったキーは環境変数から削除する。
+    """
+    global _dotenv_keys
+    values = {key: value for key, value in dotenv_values(path).items()
+              if value is not None and key not in _BASE_ENVIRON}
+    for key in _dotenv_keys - set(values):
+        os.environ.pop(key, None)
+    os.environ.update(values)
+    _dotenv_keys = set(values)
+
+
+def reload_settings():
+    """
+    .envを読み込み直して設定を差し替え、変更された項目の名前のリストを返す。
+    ISEへの接続に関わる設定 (ISE_CLIENT_SETTINGS) が変わった場合、次回の get_ise_client() で
+    新しいクライアントを生成する (それ以外の変更では既存のクライアントを使い続ける)。
+    キャッシュの容量などは on_settings_reload で登録された処理で反映する。
+    """
+    global _settings
+    with _settings_lock:
+        if ENV_FILE_PATH:
+            _reload_dotenv(ENV_FILE_PATH)
+        old_settings = _settings or Settings()
+        _settings = Settings.from_env()
+        settings = _settings
+        changed = _settings.changed_fields(old_settings)
+    if changed:
+        logger.info("設定を再読み込みしました。変更された項目: %s", ', '.join(changed))
+        for hook in _settings_reload_hooks:
+            try:
+                hook(settings)
+            except Exception as e:
+                logger.error("設定の反映に失敗しました (%s): %s", hook.__name__, e)
+    return changed
+
+
+_settings_watcher_started = False
+
+
+def start_settings_watcher():
+    """
+    ISE_SETTINGS_WATCH_INTERVAL (秒) が設定されている場合、.envの更新を監視して
+    変更があれば設定を再読み込みするバックグラウンドスレッドを1つだけ起動する。
+    """
+    global _settings_watcher_started
+    interval = get_settings().settings_watch_interval
+    if interval <= 0 or not ENV_FILE_PATH:
+        return
+    with _settings_lock:
+        if _settings_watcher_started:
+            return
+        _settings_watcher_started = True
+
+    def mtime():
+        try:
+            return os.path.getmtime(ENV_FILE_PATH)
+        except OSError:
+            return None
+
+    def run():
+        last_mtime = mtime()
+        while True:
+            time.sleep(interval)
+            current_mtime = mtime()
+            if current_mtime != last_mtime:
+                last_mtime = current_mtime
+                try:
+                    reload_settings()
+                except Exception as e:
+                    logger.error("設定の再読み込みに失敗しました: %s", e)
+
+    threading.Thread(target=run, name='settings-watcher', daemon=True).start()
+    logger.info(".envの変更監視を開始しました (間隔: %s秒): %s", interval, ENV_FILE_PATH)
+
+
+# =====================================================
+# ISE APIのレート制御とリトライ
+# =====================================================
+
+# ISEが過負荷・同時セッション数超過を示すステータスコード (再試行対象)
+RETRYABLE_STATUS = (429, 503)
+
+
+def _parse_retry_after(value):
+    """
+    Retry-Afterヘッダー (秒数またはHTTP日付) を待機秒数に変換する。解釈できない場合はNone。
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=datetime.timezone.utc)
+    return max(0.0, (retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+
+class AdaptiveRateLimiter:
+    """
+    ISEへのリクエストの流量を制御する、プロセス内で共有のリミッター。
+      - トークンバケット: 1秒あたり rate 件 (バースト burst 件) まで。rate=0 の場合は制限なし。
+      - 同時実行数のAIMD制御: 成功するたびに上限を少しずつ (1/上限) 増やし、
+        429/503を受けたら半分に減らす (max_concurrency と min_concurrency の範囲内)。
+      - Retry-Afterを受けた場合は、その時刻まで全リクエストの送信を止める。
+    同期クライアント (スレッド) と非同期クライアント (asyncio) の両方から使用する。
+    """
+
+    def __init__(self, rate=0.0, burst=10, max_concurrency=20, min_concurrency=1):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.max_concurrency = max(1, max_concurrency)
+        self.min_concurrency = max(1, min(min_concurrency, self.max_concurrency))
+        self.concurrency_limit = float(self.max_concurrency) # 現在の同時実行数の上限
+        self.in_flight = 0
+        self.throttled_count = 0 # 429/503を受けた回数
+        self._tokens = float(self.burst)
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+        self._last_decrease_at = 0.0
+        self._cond = threading.Condition()
+
+    def _try_acquire(self):
+        """
+        送信枠を取得できれば0を、できなければ次に試すまでの待機秒数を返す。_condを保持して呼ぶこと。
+        """
+        now = time.monotonic()
+        if now < self._paused_until:
+            return self._paused_until - now
+        if self.in_flight >= int(self.concurrency_limit):
+            return 0.05 # 他のリクエストの完了待ち (同期版はrelease時の通知で起きる)
+        if self.rate > 0:
+            self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+            self._updated_at = now
+            if self._tokens < 1:
+                return (1 - self._tokens) / self.rate
+            self._tokens -= 1
+        self.in_flight += 1
+        return 0
+
+    def acquire(self):
+        """
+        送信枠を取得するまで待機する (スレッド用)。
+        待機は処理期限 (deadline_scope) までとし、期限までに取得できない場合はDeadlineExceededを送出する。
+        """
+        with self._cond:
+            while True:
+                wait = self._try_acquire()
+                if not wait:
+                    return
+                self._cond.wait(_deadline_capped_wait(wait))
+
+    async def acquire_async(self):
+        """
+        送信枠を取得するまで待機する (asyncio用、イベントループはブロックしない)。
+        """
+        while True:
+            with self._cond:
+                wait = self._try_acquire()
+            if not wait:
+                return
+            await asyncio.sleep(_deadline_capped_wait(wait))
+
+    def release(self, throttled=False, retry_after=None):
+        """
+        送信枠を返却し、結果に応じて同時実行数の上限を調整する。
+        """
+        with self._cond:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if throttled:
+                self.throttled_count += 1
+                # 同時に返ってきた複数の429で上限を下げすぎないよう、減少は1秒に1回まで
+                if now - self._last_decrease_at >= 1.0:
+                    self.concurrency_limit = max(self.min_concurrency, self.concurrency_limit / 2)
+                    self._last_decrease_at = now
+                    logger.warning("ISEからスロットリング応答を受けました。同時実行数の上限を %s に下げます。", int(self.concurrency_limit))
+                if retry_after:
+                    self._paused_until = max(self._paused_until, now + retry_after)
+            elif self.concurrency_limit < self.max_concurrency:
+                self.concurrency_limit = min(self.max_concurrency, self.concurrency_limit + 1 / self.concurrency_limit)
+            self._cond.notify_all()
+
+    def status(self):
+        with self._cond:
+            return {
+                'rate': self.rate,
+                'concurrency_limit': int(self.concurrency_limit),
+                'max_concurrency': self.max_concurrency,
+                'in_flight': self.in_flight,
+                'throttled_count': self.throttled_count,
+            }
+
+
+class RetryPolicy:
+    """
+    429/503を受けたリクエストの再試行方針。
+    待機時間はRetry-Afterがあればそれに従い、なければ指数バックオフ (フルジッター) とする。
+    """
+
+    def __init__(self, max_retries=5, base_delay=0.5, max_delay=30.0):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def should_retry(self, status_code, attempt):
+        return status_code in RETRYABLE_STATUS and attempt < self.max_retries
+
+    def delay(self, attempt, retry_after=None):
+        """
+        attempt回目 (0始まり) の再試行までの待機秒数を返す。
+        """
+        if retry_after is not None:
+            # 同時に待たされたリクエストが一斉に再送しないよう、少しずらす
+            return min(self.max_delay, retry_after) + random.uniform(0, self.base_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+
+# =====================================================
+# タイムアウトと処理期限 (デッドライン)
+# =====================================================
+
+class DeadlineExceeded(requests.exceptions.Timeout):
+    """
+    ルート全体の処理期限を過ぎたため、ISEへのリクエストを行わなかった (または待機を打ち切った)。
+    requestsのTimeoutとして扱えるため、既存のRequestExceptionの処理でエラーとして記録される。
+    """
+
+
+class Deadline:
+    """
+    処理全体の期限 (time.monotonic基準)。
+    """
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self):
+        return self.expires_at - time.monotonic()
+
+    def expired(self):
+        return self.remaining() <= 0
+
+
+# 現在の処理の期限。スレッドプールやasyncioのタスクにはcontextvarsとして引き継ぐ
+_current_deadline = contextvars.ContextVar('ise_deadline', default=None)
+
+
+def current_deadline():
+    return _current_deadline.get()
+
+
+@contextlib.contextmanager
+def deadline_scope(seconds):
+    """
+    with内で行うISEへのリクエスト全体に期限を設定する。secondsが0以下またはNoneの場合は期限なし。
+    """
+    if not seconds or seconds <= 0:
+        yield None
+        return
+    deadline = Deadline(seconds)
+    token = _current_deadline.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _current_deadline.reset(token)
+
+
+def _call_timeout(timeout):
+    """
+    1回のリクエストの (接続, 読み込み) タイムアウトを、現在の期限までの残り時間以内に収める。
+    期限を過ぎている場合はDeadlineExceededを送出する。
+    """
+    deadline = current_deadline()
+    if deadline is None:
+        return timeout
+    remaining = deadline.remaining()
+    if remaining <= 0:
+        raise DeadlineExceeded(f"処理期限 ({deadline.seconds}秒) を過ぎたためISEへのリクエストを中止しました")
+    connect_timeout, read_timeout = timeout
+    return min(connect_timeout, remaining), min(read_timeout, remaining)
+
+
+def _timeout_from_deadline(timeout, call_timeout):
+    """
+    送信がタイムアウトした場合に、その原因が処理期限かどうか
+    (期限に合わせてタイムアウトを短縮していた、または期限を過ぎている) を返す。
+    期限によるタイムアウトはノードの障害として扱わない。
+    """
+    deadline = current_deadline()
+    if deadline is None:
+        return False
+    return tuple(call_timeout) != tuple(timeout) or deadline.remaining() <= 0
+
+
+def _deadline_allows(delay):
+    """
+    delay秒待っても現在の期限に間に合うかどうか。期限がない場合は常にTrue。
+    """
+    deadline = current_deadline()
+    return deadline is None or delay < deadline.remaining()
+
+
+def _deadline_capped_wait(wait):
+    """
+    待機秒数を現在の期限までの残り時間以内に収める (送信枠の待ちなど、期限を過ぎて待たないように)。
+    期限を過ぎている場合はDeadlineExceededを送出する。
+    """
+    deadline = current_deadline()
+    if deadline is None:
+        return wait
+    remaining = deadline.remaining()
+    if remaining <= 0:
+        raise DeadlineExceeded(f"処理期限 ({deadline.seconds}秒) を過ぎたためISEへのリクエストを中止しました (送信待ち)")
+    return min(wait, remaining)
+
+
+def deadline_wait_timeout():
+    """
+    結果待ちに使える秒数を返す。期限の ISE_DEADLINE_MARGIN 秒前で打ち切り、
+    部分的な結果を返す時間を残す。期限がない場合はNone、残りがない場合はDeadlineExceeded。
+    """
+    deadline = current_deadline()
+    if deadline is None:
+        return None
+    remaining = deadline.remaining() - get_settings().deadline_margin
+    if remaining <= 0:
+        raise DeadlineExceeded(f"処理期限 ({deadline.seconds}秒) が近いため結果待ちを打ち切りました")
+    return remaining
+
+
+def route_deadline_seconds():
+    """
+    ルート全体の処理期限 (秒)。?deadline=秒 で指定がなければ ISE_ROUTE_DEADLINE (0は期限なし)。
+    """
+    seconds = request.args.get('deadline', type=float)
+    if seconds is None:
+        seconds = get_settings().route_deadline
+    return seconds
+
+
+def with_route_deadline(view):
+    """
+    Flaskのルートに処理期限を設定するデコレーター (同期・非同期ビューの両方に対応)。
+    ストリーミングレスポンスの生成はルート関数の終了後に行われるため、期限の対象外となる。
+    """
+    if inspect.iscoroutinefunction(view):
+        @functools.wraps(view)
+        async def async_wrapper(*args, **kwargs):
+            with deadline_scope(route_deadline_seconds()):
+                return await view(*args, **kwargs)
+        return async_wrapper
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        with deadline_scope(route_deadline_seconds()):
+            return view(*args, **kwargs)
+    return wrapper
+
+
+# =====================================================
+# ISEノードの選択とサーキットブレーカー
+# =====================================================
+
+class NodeUnavailable(requests.exceptions.ConnectionError):
+    """
+    送信先の候補となるISEノードが全てサーキットブレーカーで遮断中のため、リクエストを行わなかった。
+    """
+
+
+class CircuitBreaker:
+    """
+    ノード1台分の稼働状況。接続エラー・タイムアウトなどが failure_threshold 回続くと遮断 (open) し、
+    cooldown 秒間はそのノードへ送信しない。cooldown経過後は1件だけ試行を許可し (half-open)、
+    成功すれば復旧 (closed)、失敗すれば再び cooldown 秒遮断する。試行の結果が出るまで他の送信は遮断したまま。
+    """
+
+    def __init__(self, failure_threshold=3, cooldown=30.0):
+        self.failure_threshold = max(1, failure_threshold)
+        self.cooldown = cooldown
+        self.consecutive_failures = 0
+        self.open_until = 0.0 # time.monotonic
+        self.probe_until = 0.0 # half-openの試行中 (結果が出ないまま cooldown 秒経過すると次の試行を許可する)
+        self.last_error = None
+        self.success_count = 0
+        self.failure_count = 0
+        self._lock = threading.Lock()
+
+    def _closed(self):
+        return self.consecutive_failures < self.failure_threshold
+
+    def available(self):
+        """
+        送信できる見込みがあるかどうか (half-openの試行枠は確保しない)。
+        """
+        if self._closed():
+            return True
+        now = time.monotonic()
+        return now >= self.open_until and now >= self.probe_until
+
+    def acquire(self):
+        """
+        送信の直前に呼ぶ。closedであればTrue。half-openであれば試行枠を確保できた1件だけTrue。
+        """
+        with self._lock:
+            if self._closed():
+                return True
+            now = time.monotonic()
+            if now < self.open_until or now < self.probe_until:
+                return False
+            self.probe_until = now + self.cooldown
+            return True
+
+    def release(self):
+        """
+        試行の結果が出ないまま終わった場合 (処理期限切れなど) に試行枠を返す。
+        """
+        with self._lock:
+            self.probe_until = 0.0
+
+    def state(self):
+        if self._closed():
+            return 'closed'
+        return 'half-open' if time.monotonic() >= self.open_until else 'open'
+
+    def record_success(self):
+        with self._lock:
+            self.success_count += 1
+            self.consecutive_failures = 0
+            self.open_until = 0.0
+            self.probe_until = 0.0
+
+    def record_failure(self, error):
+        """
+        失敗を記録し、遮断を開始した場合はTrueを返す。
+        """
+        with self._lock:
+            self.failure_count += 1
+            self.consecutive_failures += 1
+            self.last_error = str(error)
+            self.probe_until = 0.0
+            if self.consecutive_failures >= self.failure_threshold:
+                self.open_until = time.monotonic() + self.cooldown
+                return True
+            return False
+
+
+class NodePool:
+    """
+    同じ役割 (PAN / MnT) のISEノード群。先頭を primary とする。
+    読み込みは遮断中でないノードへラウンドロビンで振り分け、書き込みは常にprimaryへ送る。
+    """
+
+    def __init__(self, role, nodes, failure_threshold=3, cooldown=30.0):
+        if not nodes:
+            raise ValueError(f"{role} ノードが指定されていません")
+        self.role = role
+        self.nodes = list(nodes)
+        self.primary = self.nodes[0]
+        self.breakers = {node: CircuitBreaker(failure_threshold, cooldown) for node in self.nodes}
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def candidates(self, primary_only=False):
+        """
+        今回のリクエストで試すノードを順に返す (失敗時は次のノードへフェイルオーバーする)。
+        候補が全て遮断中の場合はNodeUnavailableを送出する。
+        """
+        if primary_only:
+            nodes = [self.primary]
+        else:
+            with self._lock:
+                start = self._next
+                self._next = (self._next + 1) % len(self.nodes)
+            nodes = self.nodes[start:] + self.nodes[:start]
+        available = [node for node in nodes if self.breakers[node].available()]
+        if not available:
+            raise NodeUnavailable(f"{self.role} ノード ({', '.join(nodes)}) は全て一時的に遮断中です")
+        return available
+
+    def acquire(self, node):
+        return self.breakers[node].acquire()
+
+    def release(self, node):
+        self.breakers[node].release()
+
+    def record_success(self, node):
+        self.breakers[node].record_success()
+
+    def record_failure(self, node, error):
+        if self.breakers[node].record_failure(error):
+            logger.warning("%s ノード %s への送信を %s秒間停止します: %s", self.role, node, self.breakers[node].cooldown, error)
+
+    def status(self):
+        return [{
+            'node': node,
+            'primary': node == self.primary,
+            'state': breaker.state(),
+            'consecutive_failures': breaker.consecutive_failures,
+            'success_count': breaker.success_count,
+            'failure_count': breaker.failure_count,
+            'last_error': breaker.last_error,
+        } for node, breaker in self.breakers.items()]
+
+
+# ノード障害とみなすステータスコード (ISE手前のロードバランサー・プロキシが返すもの)
+NODE_FAILURE_STATUS = (502, 504)
+
+
+# =====================================================
+# メトリクス (Prometheus形式)
+# =====================================================
+# prometheus_clientがインストールされている場合のみ記録し、/metrics で返す。
+
+# ISE APIコール1回の所要時間のバケット (秒)
+ISE_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# ルート (Flaskのリクエスト) 処理時間のバケット (秒)
+ROUTE_DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+# このアプリのメトリクスのみを登録するレジストリ (プロセスの既定メトリクスは含めない)
+metrics_registry = prometheus_client.CollectorRegistry() if prometheus_client is not None else None
+
+
+class _Metric:
+    """
+    prometheus_clientのメトリクスを、ラベルの値をキーワード引数で指定して使うためのラッパー。
+    prometheus_clientがない場合は何も記録しない。
+    (prometheus_clientのCounterなどと区別できるよう、派生クラスは CounterMetric などの名前とする)
+    """
+    metric_class = None # prometheus_clientのクラス名
+
+    def __init__(self, name, documentation, labelnames=(), **kwargs):
+        self.labelnames = tuple(labelnames)
+        self._metric = None
+        if prometheus_client is not None:
+            self._metric = getattr(prometheus_client, self.metric_class)(
+                name, documentation, self.labelnames, registry=metrics_registry, **kwargs)
+
+    def _child(self, labels):
+        if self._metric is None:
+            return None
+        return self._metric.labels(**labels) if self.labelnames else self._metric
+
+    def clear(self):
+        if self._metric is not None:
+            self._metric.clear()
+
+
+class CounterMetric(_Metric):
+    metric_class = 'Counter'
+
+    def inc(self, amount=1, **labels):
+        metric = self._child(labels)
+        if metric is not None:
+            metric.inc(amount)
+
+
+class GaugeMetric(_Metric):
+    metric_class = 'Gauge'
+
+    def set(self, value, **labels):
+        metric = self._child(labels)
+        if metric is not None:
+            metric.set(value)
+
+    def inc(self, amount=1, **labels):
+        metric = self._child(labels)
+        if metric is not None:
+            metric.inc(amount)
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class HistogramMetric(_Metric):
+    metric_class = 'Histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=ISE_LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames, buckets=buckets)
+
+    def observe(self, value, **labels):
+        metric = self._child(labels)
+        if metric is not None:
+            metric.observe(value)
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """
+        with ブロックの所要時間を記録する。
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+
+ISE_API_REQUEST_SECONDS = HistogramMetric(
+    'ise_api_request_duration_seconds',
+    'ISE APIコール1回 (再試行は別の回として数える) の応答ヘッダー受信までの時間',
+    ('api', 'method', 'status'), buckets=ISE_LATENCY_BUCKETS,
+)
+ISE_API_IN_FLIGHT = GaugeMetric(
+    'ise_api_requests_in_flight', '送信中のISE APIコール数', ('api',),
+)
+ISE_API_RETRIES = CounterMetric(
+    'ise_api_retries_total', '429/503による再試行の回数', ('api', 'status'),
+)
+ROUTE_REQUEST_SECONDS = HistogramMetric(
+    'ise_client_route_duration_seconds',
+    'ルートの処理時間 (ストリーミングの場合は送信完了まで)',
+    ('route', 'method', 'status'), buckets=ROUTE_DURATION_BUCKETS,
+)
+ROUTE_IN_FLIGHT = GaugeMetric(
+    'ise_client_route_requests_in_flight', '処理中のリクエスト数', ('route',),
+)
+ROUTE_PHASE_SECONDS = HistogramMetric(
+    'ise_client_route_phase_duration_seconds',
+    'ルート内の処理段階 (一覧取得、詳細取得、JSON変換など) ごとの時間',
+    ('route', 'phase'), buckets=ROUTE_DURATION_BUCKETS,
+)
+CACHE_REQUESTS = CounterMetric(
+    'ise_client_cache_requests_total', 'キャッシュの参照回数 (result: hit / miss、ers_httpはrevalidatedも)', ('cache', 'result'),
+)
+RATE_LIMITER_CONCURRENCY_LIMIT = GaugeMetric(
+    'ise_rate_limiter_concurrency_limit', 'レートリミッターの現在の同時実行数の上限 (429/503で減少する)',
+)
+RATE_LIMITER_IN_FLIGHT = GaugeMetric(
+    'ise_rate_limiter_in_flight', 'レートリミッターの送信枠を使用中のISE APIコール数',
+)
+NODE_UP = GaugeMetric(
+    'ise_node_up', 'ISEノードへ送信可能か (サーキットブレーカーが遮断中なら0)', ('role', 'node'),
+)
+
+
+def ise_api_family(path):
+    """
+    ISE APIのパスをメトリクス用の種別名にする (IDやMACアドレスはラベルに含めない)。
+    例: /ers/config/endpoint -> ers_endpoint_list, /ers/config/endpoint/{id} -> ers_endpoint,
+    /ers/config/endpoint/bulk/submit -> ers_endpoint_bulk, /admin/API/mnt/Session/ActiveList -> mnt_session_activelist
+    """
+    parts = [part for part in path.split('/') if part]
+    if parts[:2] == ['ers', 'config'] and len(parts) >= 3:
+        resource = parts[2].lower()
+        if len(parts) == 3:
+            return f'ers_{resource}_list'
+        if parts[3] == 'bulk':
+            return f'ers_{resource}_bulk'
+        return f'ers_{resource}'
+    if [part.lower() for part in parts[:3]] == ['admin', 'api', 'mnt'] and len(parts) >= 4:
+        return 'mnt_' + '_'.join(part.lower() for part in parts[3:5])
+    return 'other'
+
+
+def _call_error_status(e):
+    """
+    ISE APIコールが例外で終わった場合にstatusラベルとして使う値。
+    """
+    if isinstance(e, requests.exceptions.Timeout) or (httpx is not None and isinstance(e, httpx.TimeoutException)):
+        return 'timeout'
+    if isinstance(e, requests.exceptions.ConnectionError) or (httpx is not None and isinstance(e, httpx.TransportError)):
+        return 'connection_error'
+    if isinstance(e, (asyncio.CancelledError, GeneratorExit)):
+        return 'cancelled'
+    return 'error'
+
+
+@contextlib.contextmanager
+def observe_ise_call(api, method):
+    """
+    ISE APIコール1回の送信中の件数と所要時間を記録する。
+    呼び出し側はレスポンスを受け取ったら call['status'] にステータスコードを設定する。
+    """
+    call = {'status': 'error'}
+    ISE_API_IN_FLIGHT.inc(api=api)
+    started = time.perf_counter()
+    try:
+        yield call
+    except BaseException as e:
+        call['status'] = _call_error_status(e)
+        raise
+    finally:
+        ISE_API_IN_FLIGHT.dec(api=api)
+        ISE_API_REQUEST_SECONDS.observe(time.perf_counter() - started, api=api, method=method.upper(), status=call['status'])
+
+
+def count_cache_lookup(cache, hit):
+    CACHE_REQUESTS.inc(cache=cache, result='hit' if hit else 'miss')
+
+
+# =====================================================
+# トレース (OpenTelemetry)
+# =====================================================
+#   ISE_TRACE_EXPORTER     : none (既定) / console (標準出力) / file (ISE_TRACE_FILE へ追記) /
+#                            otlp (OTLP/HTTPでOpenTelemetry Collectorなどへ送信、送信先は OTEL_EXPORTER_OTLP_ENDPOINT)
+#   ISE_TRACE_FILE         : fileの出力先 (既定は traces.jsonl)
+#   ISE_TRACE_SAMPLE_RATIO : 記録するトレースの割合 (0〜1、既定は1)
+# opentelemetry-sdkが必要 (otlpはopentelemetry-exporter-otlp-proto-httpも必要)。
+# 出力はBatchSpanProcessorがバックグラウンドのスレッドでまとめて行う。
+
+SPAN_KIND_INTERNAL = 'INTERNAL'
+SPAN_KIND_SERVER = 'SERVER'
+SPAN_KIND_CLIENT = 'CLIENT'
+
+
+class _NonRecordingSpan:
+    """
+    トレースが無効の場合のスパン。何も記録しない。
+    """
+
+    def is_recording(self):
+        return False
+
+    def set_attribute(self, key, value):
+        pass
+
+    def record_exception(self, exception):
+        pass
+
+    def end(self):
+        pass
+
+
+NON_RECORDING_SPAN = _NonRecordingSpan()
+
+
+def current_span():
+    """
+    現在のスパンを返す。スパンの外やトレースが無効の場合は記録しないスパンを返す。
+    """
+    if otel_trace is None:
+        return NON_RECORDING_SPAN
+    return otel_trace.get_current_span()
+
+
+def mark_span_error(span, description=None):
+    """
+    スパンのステータスをERRORにする。
+    """
+    if span.is_recording():
+        span.set_status(otel_trace.Status(otel_trace.StatusCode.ERROR, description))
+
+
+def _span_attributes(attributes):
+    return {key: value for key, value in (attributes or {}).items() if value is not None}
+
+
+class Tracer:
+    """
+    OpenTelemetryのTracerProviderでスパンを生成する。親子関係はOpenTelemetryのコンテキスト
+    (contextvars) でたどるため、ワーカースレッドへはcontextvars.copy_context()で、
+    asyncioのタスクへは自動的に引き継がれる。
+    """
+
+    def __init__(self, exporter=None, sample_ratio=1.0, service_name='ise_api_client'):
+        self._provider = None
+        self._tracer = None
+        if exporter is not None:
+            self._provider = TracerProvider(
+                resource=Resource.create({'service.name': service_name}),
+                sampler=ParentBased(TraceIdRatioBased(sample_ratio)),
+            )
+            self._provider.add_span_processor(BatchSpanProcessor(exporter))
+            self._tracer = self._provider.get_tracer('ise_api_client')
+            atexit.register(self.shutdown)
+
+    @property
+    def enabled(self):
+        return self._tracer is not None
+
+    @contextlib.contextmanager
+    def start_span(self, name, kind=SPAN_KIND_INTERNAL, attributes=None):
+        """
+        現在のスパンの子スパンを開始し、withブロックの間は現在のスパンとする。
+        スパンの外で呼び出した場合は新しいトレースのルートスパンになる。
+        例外で抜けた場合は例外を記録してステータスをERRORにし、例外をそのまま送出する。
+        """
+        if not self.enabled:
+            yield NON_RECORDING_SPAN
+            return
+        with self._tracer.start_as_current_span(
+                name, kind=otel_trace.SpanKind[kind], attributes=_span_attributes(attributes)) as span:
+            yield span
+
+    def start_detached_span(self, name, kind=SPAN_KIND_INTERNAL, attributes=None, context=None):
+        """
+        現在のスパンにせずにスパンを開始する (Flaskのbefore_request / teardown_request のように
+        開始と終了が別の関数になる場合に使用する)。contextを指定した場合はその中のスパンを親とする。
+        終了は呼び出し側で span.end() を呼ぶ。
+        """
+        if not self.enabled:
+            return NON_RECORDING_SPAN
+        return self._tracer.start_span(
+            name, context=context, kind=otel_trace.SpanKind[kind], attributes=_span_attributes(attributes))
+
+    def shutdown(self):
+        """
+        キューに残っているスパンを書き出して出力スレッドを終了する。
+        """
+        if self._provider is not None:
+            self._provider.shutdown()
+
+
+def _json_lines_exporter(out):
+    """
+    スパンを1行1JSON (OpenTelemetry SDKのスパンのJSON表現) で書き込むエクスポーター。
+    """
+    return ConsoleSpanExporter(out=out, formatter=lambda span: span.to_json(indent=None) + '\n')
+
+
+def configure_tracing():
+    """
+    環境変数に従ってTracerを生成する。
+    """
+    exporter_name = (os.getenv('ISE_TRACE_EXPORTER') or 'none').strip().lower()
+    if exporter_name in ('', 'none'):
+        return Tracer()
+    if exporter_name not in ('console', 'file', 'otlp'):
+        logger.warning("ISE_TRACE_EXPORTER の値が不正です: %s (トレースは無効)", exporter_name)
+        return Tracer()
+    if otel_trace is None:
+        logger.warning("トレースにはopentelemetry-sdkが必要です (pip install opentelemetry-sdk)。トレースは無効です。")
+        return Tracer()
+    if exporter_name == 'console':
+        exporter = _json_lines_exporter(sys.stdout)
+    elif exporter_name == 'file':
+        exporter = _json_lines_exporter(open(os.getenv('ISE_TRACE_FILE') or 'traces.jsonl', 'a', encoding='utf-8'))
+    else:
+        try:
+            from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        except ImportError:
+            logger.warning("ISE_TRACE_EXPORTER=otlp にはopentelemetry-exporter-otlp-proto-httpが必要です。トレースは無効です。")
+            return Tracer()
+        exporter = OTLPSpanExporter()
+    return Tracer(exporter, sample_ratio=min(1.0, max(0.0, _env_float('ISE_TRACE_SAMPLE_RATIO', 1.0))))
+
+
+tracer = configure_tracing()
+
+
+def traced(name, attributes=None):
+    """
+    関数 (同期・非同期) の呼び出しをスパンとして記録するデコレーター。
+    attributesは関数と同じ引数を受け取り、スパンの属性の辞書を返す関数。
+    """
+    def decorator(func):
+        def span_for(args, kwargs):
+            span_attributes = attributes(*args, **kwargs) if attributes and tracer.enabled else None
+            return tracer.start_span(name, attributes=span_attributes)
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span_for(args, kwargs):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span_for(args, kwargs):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# =====================================================
+# 同一リクエストの集約 (single-flight)
+# =====================================================
+
+SINGLE_FLIGHT_REQUESTS = CounterMetric(
+    'ise_client_single_flight_total',
+    '集約対象の呼び出し回数 (result: leader=実際に実行 / shared=実行中の結果を共有)', ('group', 'result'),
+)
+
+
+class _FlightCall:
+    """
+    SingleFlightで実行中の処理1件。完了すると結果または例外を保持する。
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def wait(self):
+        deadline = current_deadline()
+        timeout = None if deadline is None else max(0.0, deadline.remaining())
+        if not self.done.wait(timeout):
+            raise DeadlineExceeded(f"処理期限 ({deadline.seconds}秒) を過ぎたため実行中のリクエストの完了待ちを打ち切りました")
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class SingleFlight:
+    """
+    同じキーの処理が並行に要求された場合に1回だけ実行し、その結果 (または例外) を
+    待っていた全ての呼び出し元で共有する。結果は実行中の間だけ共有し、キャッシュはしない。
+    """
+
+    def __init__(self, name):
+        self.name = name # メトリクスのgroupラベル
+        self._calls = {} # key -> _FlightCall
+        self._lock = threading.Lock()
+
+    def do(self, key, func, shareable=None):
+        """
+        keyの処理が実行中であればその完了を待って結果を返し、なければfunc()を実行して結果を返す。
+        実行した側の処理期限切れで失敗した場合、自分の期限が残っていれば自分で実行し直す。
+        shareable(結果) がFalseを返す結果 (実行した側の処理期限で途中までになった結果など) も
+        共有せず、自分で実行し直す。
+        """
+        while True:
+            with self._lock:
+                call = self._calls.get(key)
+                leader = call is None
+                if leader:
+                    call = self._calls[key] = _FlightCall()
+            if leader:
+                break
+            SINGLE_FLIGHT_REQUESTS.inc(group=self.name, result='shared')
+            try:
+                result = call.wait()
+            except DeadlineExceeded:
+                deadline = current_deadline()
+                if call.error is None or (deadline is not None and deadline.expired()):
+                    raise # 自分の期限切れ
+                continue
+            if shareable is None or shareable(result):
+                return result
+
+        SINGLE_FLIGHT_REQUESTS.inc(group=self.name, result='leader')
+        try:
+            call.result = func()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+class AsyncSingleFlight:
+    """
+    SingleFlightのasyncio版。同じイベントループ内のコルーチンの間で集約する。
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._tasks = {} # key -> asyncio.Task
+
+    async def do(self, key, coroutine_func):
+        task = self._tasks.get(key)
+        if task is None:
+            SINGLE_FLIGHT_REQUESTS.inc(group=self.name, result='leader')
+            task = asyncio.ensure_future(coroutine_func())
+            self._tasks[key] = task
+            task.add_done_callback(functools.partial(self._finished, key))
+        else:
+            SINGLE_FLIGHT_REQUESTS.inc(group=self.name, result='shared')
+        # 呼び出し元の1つが取り消されても、待っている他の呼び出し元のために処理は続ける
+        return await asyncio.shield(task)
+
+    def _finished(self, key, task):
+        self._tasks.pop(key, None)
+        if not task.cancelled():
+            task.exception() # 全員が取り消された場合に「例外が取得されなかった」警告を出さない
+
+
+def single_flight_key(method, path, params=None, headers=None, **kwargs):
+    """
+    ISEへのリクエストを集約してよい場合はそのキーを、集約しない場合はNoneを返す。
+    本文を読み込み済みのレスポンスを共有するため、集約するのはstreamでないGETのみ。
+    """
+    if method.upper() != 'GET' or kwargs.get('stream') or kwargs.get('data') or kwargs.get('json'):
+        return None
+    params_key = tuple(sorted((str(k), str(v)) for k, v in params.items())) if params else ()
+    headers_key = tuple(sorted(headers.items())) if headers else ()
+    return path, params_key, headers_key, tuple(sorted((k, str(v)) for k, v in kwargs.items()))
+
+
+# =====================================================
+# ERSレスポンスのHTTPキャッシュ (ETag / Last-Modified)
+# =====================================================
+
+@dataclass
+class HttpCacheEntry:
+    """
+    キャッシュしたERSレスポンス1件 (本文と検証用のヘッダー)。
+    """
+    body: bytes
+    content_type: str = None
+    etag: str = None
+    last_modified: str = None
+    fresh_until: float = 0.0 # この時刻 (time.time) までは再検証せずに使う
+
+    def fresh(self):
+        return time.time() < self.fresh_until
+
+    def headers(self):
+        headers = {'Content-Type': self.content_type or 'application/json'}
+        if self.etag:
+            headers['ETag'] = self.etag
+        if self.last_modified:
+            headers['Last-Modified'] = self.last_modified
+        return headers
+
+    def conditional_headers(self):
+        """
+        再検証 (条件付きGET) のリクエストヘッダー。
+        """
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+    def to_response(self, url):
+        """
+        requests.Response として返す (呼び出し元は通常のレスポンスと同じように扱える)。
+        """
+        response = requests.models.Response()
+        response.status_code = 200
+        response.reason = 'OK'
+        response.url = url
+        response.headers = requests.structures.CaseInsensitiveDict(self.headers())
+        response._content = self.body
+        response.from_cache = True
+        return response
+
+    def to_httpx_response(self, url):
+        """
+        httpx.Response として返す (AsyncISEClient用)。
+        """
+        response = httpx.Response(200, headers=self.headers(), content=self.body, request=httpx.Request('GET', url))
+        response.extensions['from_cache'] = True
+        return response
+
+
+# ERSのリソースを変更するメソッド (送信後にHTTPキャッシュの該当エントリを削除する)
+ERS_MUTATING_METHODS = ('POST', 'PUT', 'PATCH', 'DELETE')
+
+
+class ERSResponseCache:
+    """
+    ERSの個別リソース (/ers/config/{種別}/{id}) に対するGETレスポンスのキャッシュ。
+    ISEがETag / Last-Modified を返す場合は期限切れ後に条件付きGETで再検証し、
+    変更がなければ (304) 本文を受信せずにキャッシュを使う。
+    検証用ヘッダーがない場合は種別ごとの有効期間 (ttls、既定はdefault_ttl秒) の間だけ使う。
+    メモリ上ではLRUでmaxsize件まで保持し、db_pathを指定した場合はSQLiteにも保存して
+    再起動後も再検証に使う (書き込みはwrite_batch件ずつまとめて行う)。
+    """
+
+    def __init__(self, maxsize=10000, ttls=None, default_ttl=0, db_path=None, write_batch=200):
+        self.maxsize = maxsize
+        self.ttls = dict(ttls or {}) # リソース種別 (endpoint, endpointgroupなど) -> 有効期間 (秒)
+        self.default_ttl = default_ttl
+        self.db_path = db_path
+        self.write_batch = write_batch
+        self._entries = OrderedDict() # パス -> HttpCacheEntry
+        self._pending = {} # SQLiteへ未書き込みのエントリ (Noneは削除)
+        self._lock = threading.Lock()
+        self._connection = None
+        if db_path:
+            try:
+                self._connection = sqlite3.connect(db_path, check_same_thread=False)
+                self._connection.execute(
+                    "CREATE TABLE IF NOT EXISTS http_cache ("
+                    "path TEXT PRIMARY KEY, content_type TEXT, etag TEXT, last_modified TEXT, "
+                    "fresh_until REAL, body BLOB)"
+                )
+            except sqlite3.Error as e:
+                logger.error("HTTPキャッシュのデータベースを開けませんでした (%s): %s", db_path, e)
+                self._connection = None
+            else:
+                atexit.register(self.flush)
+
+    @classmethod
+    def from_settings(cls, settings):
+        """
+        設定からキャッシュを生成する。ISE_HTTP_CACHE_MAXSIZE=0 の場合はNone (キャッシュしない)。
+        """
+        if settings.http_cache_maxsize <= 0:
+            return None
+        return cls(
+            maxsize=settings.http_cache_maxsize,
+            ttls={'endpoint': settings.http_cache_ttl_endpoint, 'endpointgroup': settings.http_cache_ttl_endpointgroup},
+            default_ttl=settings.http_cache_ttl,
+            db_path=settings.http_cache_db,
+        )
+
+    @staticmethod
+    def cacheable(path, kwargs):
+        """
+        キャッシュの対象かどうか。/ers/config/{種別}/{id} への追加指定のないGETのみ対象とする
+        (一覧・検索・名前による参照・Bulkは結果が変わりやすいため対象外)。
+        """
+        parts = [part for part in path.split('/') if part]
+        return (not kwargs and len(parts) == 4 and parts[:2] == ['ers', 'config']
+                and parts[3] != 'bulk' and '?' not in path)
+
+    def ttl_for(self, path):
+        resource = path.strip('/').split('/')[2]
+        return self.ttls.get(resource, self.default_ttl)
+
+    def get(self, path):
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None:
+                self._entries.move_to_end(path)
+                return entry
+            if path in self._pending:
+                # メモリから追い出されたがSQLiteへ未書き込みのエントリ (Noneは削除済み)
+                entry = self._pending[path]
+                if entry is not None:
+                    self._remember(path, entry)
+                return entry
+            if self._connection is None:
+                return None
+            try:
+                row = self._connection.execute(
+                    "SELECT body, content_type, etag, last_modified, fresh_until FROM http_cache WHERE path = ?",
+                    (path,),
+                ).fetchone()
+            except sqlite3.Error as e:
+                logger.error("HTTPキャッシュの読み込みに失敗しました: %s", e)
+                return None
+            if row is None:
+                return None
+            entry = HttpCacheEntry(*row)
+            self._remember(path, entry)
+            return entry
+
+    def store(self, path, headers, body):
+        """
+        200レスポンスを保存する。検証用ヘッダーも有効期間もない場合は保存しない。
+        """
+        if 'no-store' in (headers.get('Cache-Control') or ''):
+            return None
+        ttl = self.ttl_for(path)
+        entry = HttpCacheEntry(
+            body=body,
+            content_type=headers.get('Content-Type'),
+            etag=headers.get('ETag'),
+            last_modified=headers.get('Last-Modified'),
+            fresh_until=time.time() + ttl,
+        )
+        if not (entry.etag or entry.last_modified or ttl > 0):
+            return None
+        self._put(path, entry)
+        return entry
+
+    def revalidated(self, path, entry, headers):
+        """
+        条件付きGETが304を返した場合に、有効期間と検証用ヘッダーを更新したエントリを返す。
+        """
+        entry = HttpCacheEntry(
+            body=entry.body,
+            content_type=entry.content_type,
+            etag=headers.get('ETag') or entry.etag,
+            last_modified=headers.get('Last-Modified') or entry.last_modified,
+            fresh_until=time.time() + self.ttl_for(path),
+        )
+        self._put(path, entry)
+        return entry
+
+    def invalidate(self, path):
+        with self._lock:
+            self._entries.pop(path, None)
+            if self._connection is not None:
+                self._pending[path] = None
+        self._flush_if_needed()
+
+    def invalidate_for_mutation(self, path):
+        """
+        ERSへの変更 (POST/PUT/PATCH/DELETE) の後に、古くなるエントリを削除する。
+        変更した個別リソースと、その種別の一覧 (/ers/config/{種別} とページ・検索のクエリ付きのもの) を削除する。
+        Bulk処理 (/ers/config/{種別}/bulk/...) は対象のリソースをパスから特定できないため、その種別の全エントリを削除する。
+        """
+        parts = [part for part in path.split('?', 1)[0].split('/') if part]
+        if len(parts) < 3 or parts[:2] != ['ers', 'config']:
+            self.invalidate(path)
+            return
+        collection = '/' + '/'.join(parts[:3])
+        ranges = [(collection + '?', collection + '@')] # 一覧のページ ('@' は '?' の次の文字)
+        if len(parts) > 3 and parts[3] == 'bulk':
+            ranges.append((collection + '/', collection + '0')) # 種別内の全リソース ('0' は '/' の次の文字)
+        else:
+            self.invalidate(path)
+
+        def matches(key):
+            return key == collection or any(low <= key < high for low, high in ranges)
+
+        with self._lock:
+            for key in [key for key in self._entries if matches(key)]:
+                del self._entries[key]
+            for key in [key for key in self._pending if matches(key)]:
+                del self._pending[key]
+            if self._connection is None:
+                return
+            try:
+                with self._connection:
+                    self._connection.execute("DELETE FROM http_cache WHERE path = ?", (collection,))
+                    self._connection.executemany("DELETE FROM http_cache WHERE path >= ? AND path < ?", ranges)
+            except sqlite3.Error as e:
+                logger.error("HTTPキャッシュの削除に失敗しました (%s): %s", self.db_path, e)
+
+    def _remember(self, path, entry):
+        self._entries[path] = entry
+        self._entries.move_to_end(path)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False) # SQLiteには残る
+
+    def _put(self, path, entry):
+        with self._lock:
+            self._remember(path, entry)
+            if self._connection is not None:
+                self._pending[path] = entry
+        self._flush_if_needed()
+
+    def _flush_if_needed(self):
+        if len(self._pending) >= self.write_batch:
+            self.flush()
+
+    def flush(self):
+        """
+        未書き込みのエントリをSQLiteに書き込む。
+        """
+        with self._lock:
+            if self._connection is None or not self._pending:
+                return
+            pending, self._pending = self._pending, {}
+            try:
+                with self._connection:
+                    self._connection.executemany("DELETE FROM http_cache WHERE path = ?",
+                                                 [(path,) for path, entry in pending.items() if entry is None])
+                    self._connection.executemany(
+                        "INSERT OR REPLACE INTO http_cache VALUES (?, ?, ?, ?, ?, ?)",
+                        [(path, entry.content_type, entry.etag, entry.last_modified, entry.fresh_until, entry.body)
+                         for path, entry in pending.items() if entry is not None],
+                    )
+            except sqlite3.Error as e:
+                logger.error("HTTPキャッシュの保存に失敗しました (%s): %s", self.db_path, e)
+
+    def close(self):
+        """
+        未書き込みのエントリを書き込んでSQLiteの接続を閉じる。以降はメモリ上でのみ保持する。
+        """
+        self.flush()
+        with self._lock:
+            connection, self._connection = self._connection, None
+            self._pending.clear()
+        if connection is not None:
+            atexit.unregister(self.flush)
+            connection.close()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+
+def record_http_cache_result(result):
+    """
+    HTTPキャッシュの参照結果 (hit / revalidated / miss) をメトリクスと現在のスパンに記録する。
+    """
+    CACHE_REQUESTS.inc(cache='ers_http', result=result)
+    current_span().set_attribute('ise.http_cache', result)
+
+
+_DEFAULT_PORTS = {'https': 443, 'http': 80}
+
+
+def ise_url_template(scheme, port):
+    """
+    node_request に渡すURLの書式 ('{node}' と '{path}' を含む) を作成する。
+    スキームの既定ポートの場合はポート番号を省略する。
+    """
+    if _DEFAULT_PORTS.get(scheme) == port:
+        return f"{scheme}://{{node}}{{path}}"
+    return f"{scheme}://{{node}}:{port}{{path}}"
+
+
+class ISEClient:
+    """
+    ISEへのHTTP通信をまとめて扱う共有クライアント。
+    ホストごとにrequests.Sessionを保持してurllib3のコネクションプールを使い回し、
+    APIコールごとのTCP/TLSハンドシェイクを省く。
+    プロセス内で1つだけ生成し、get_ise_client() から取得して使用する。
+    """
+
+    def __init__(self, ise_ip, username, password, http_proxy,
+                 pool_connections=10, pool_maxsize=20, rate_limiter=None, retry_policy=None,
+                 timeout=(5, 30), pan_pool=None, mnt_pool=None, settings=None,
+                 scheme='https', ers_port=9060, mnt_port=443, response_cache=None):
+        self.settings = settings # 生成元の設定 (get_ise_client で再読み込みの検出に使用)
+        self.ise_ip = ise_ip
+        self.scheme = scheme
+        self.ers_port = ers_port
+        self.mnt_port = mnt_port
+        self.ers_url_template = ise_url_template(scheme, ers_port)
+        self.mnt_url_template = ise_url_template(scheme, mnt_port)
+        # ERS APIはPANノード、MnT APIはMnTノードへ送信する (未指定の場合はise_ipの1台)
+        self.pan_pool = pan_pool or NodePool('PAN', [ise_ip])
+        self.mnt_pool = mnt_pool or NodePool('MnT', [ise_ip])
+        self.username = username
+        self.password = password
+        # 認証ヘッダーとプロキシ設定は生成時に一度だけ作成する
+        self.auth_header = get_basic_auth_header(username, password)
+        self.proxies = {'http': http_proxy, 'https': http_proxy} if http_proxy else None
+        # 毎回のAPIコールで使い回すヘッダー (変更不可)
+        self.ers_headers = MappingProxyType({
+            'Accept': 'application/json',
+            'authorization': self.auth_header,
+        })
+        self.mnt_headers = MappingProxyType({
+            'Accept': 'application/xml',
+            'cache-control': "no-cache",
+        })
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self._sessions = {} # ホスト(host:port) -> requests.Session
+        self._lock = threading.Lock()
+        # 全てのISE APIコールで共有する流量制御と再試行方針
+        self.rate_limiter = rate_limiter or AdaptiveRateLimiter()
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.timeout = timeout # (接続タイムアウト, 読み込みタイムアウト) 秒
+        self._single_flight = SingleFlight('ise_request') # 同じURLへの並行なGETをまとめる
+        self.response_cache = response_cache # ERSの個別リソースのGETをキャッシュする (Noneは無効)
+
+    @classmethod
+    def from_settings(cls, settings):
+        """
+        設定 (Settings) からクライアントを生成する。
+        """
+        return cls(
+            settings.ise_ip, settings.username, settings.password, settings.http_proxy,
+            pool_connections=settings.pool_connections,
+            pool_maxsize=settings.pool_maxsize,
+            rate_limiter=AdaptiveRateLimiter(
+                rate=settings.rate_limit,
+                burst=settings.rate_burst,
+                max_concurrency=settings.max_concurrency,
+            ),
+            retry_policy=RetryPolicy(
+                max_retries=settings.retry_max,
+                base_delay=settings.retry_base_delay,
+                max_delay=settings.retry_max_delay,
+            ),
+            timeout=(settings.connect_timeout, settings.read_timeout),
+            pan_pool=NodePool('PAN', settings.pan_nodes, settings.node_failure_threshold, settings.node_cooldown),
+            mnt_pool=NodePool('MnT', settings.mnt_nodes, settings.node_failure_threshold, settings.node_cooldown),
+            settings=settings,
+            scheme=settings.ise_scheme,
+            ers_port=settings.ers_port,
+            mnt_port=settings.mnt_port,
+            response_cache=ERSResponseCache.from_settings(settings),
+        )
+
+    def _get_session(self, host):
+        """
+        指定ホスト用のrequests.Sessionを返す。なければ作成する。
+        """
+        with self._lock:
+            session = self._sessions.get(host)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=self.pool_connections,
+                    pool_maxsize=self.pool_maxsize, # 同一ホストへの同時接続数の上限
+                )
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                session.verify = False # 自己署名証明書を想定 (本番環境では証明書検証を有効にしてください)
+                if self.proxies:
+                    session.proxies.update(self.proxies)
+                session.headers['Connection'] = 'keep-alive'
+                self._sessions[host] = session
+                logger.debug("HTTPセッションを作成しました: %s (pool_maxsize=%s)", host, self.pool_maxsize)
+            return session
+
+    def request(self, method, url, **kwargs):
+        """
+        URLのホストに対応するセッションでリクエストを送信する。
+        送信前にレートリミッターの送信枠を取得し、429/503の場合はRetry-Afterまたは
+        指数バックオフで待ってから再送する。再試行を使い切った場合は最後のレスポンスを返す。
+        タイムアウトは (接続, 読み込み) とも self.timeout、処理期限 (deadline_scope) 内では
+        期限までの残り時間に短縮し、期限を過ぎている場合はDeadlineExceededを送出する。
+        """
+        parts = urlsplit(url)
+        session = self._get_session(parts.netloc)
+        timeout = kwargs.pop('timeout', self.timeout)
+        api = ise_api_family(parts.path)
+        with tracer.start_span(f"ISE {method.upper()} {api}", SPAN_KIND_CLIENT, {
+            'http.request.method': method.upper(),
+            'server.address': parts.hostname,
+            'url.path': parts.path,
+            'ise.api': api,
+            'ise.retry_count': 0,
+        }) as span:
+            response = self._send_with_retry(session, method, url, api, timeout, span, **kwargs)
+            span.set_attribute('http.response.status_code', response.status_code)
+            return response
+
+    def _send_with_retry(self, session, method, url, api, timeout, span, **kwargs):
+        """
+        requestの本体。429/503の場合は再送し、再試行回数をスパンの ise.retry_count に記録する。
+        """
+        attempt = 0
+        while True:
+            call_timeout = _call_timeout(timeout)
+            self.rate_limiter.acquire()
+            throttled, retry_after = False, None
+            try:
+                with observe_ise_call(api, method) as call:
+                    try:
+                        response = session.request(method, url, timeout=call_timeout, **kwargs)
+                    except requests.exceptions.Timeout as e:
+                        if _timeout_from_deadline(timeout, call_timeout):
+                            raise DeadlineExceeded(f"処理期限までにISEから応答がありませんでした ({method.upper()} {urlsplit(url).path})") from e
+                        raise
+                    call['status'] = response.status_code
+                throttled = response.status_code in RETRYABLE_STATUS
+                if throttled:
+                    retry_after = _parse_retry_after(response.headers.get('Retry-After'))
+            finally:
+                self.rate_limiter.release(throttled, retry_after)
+            if not self.retry_policy.should_retry(response.status_code, attempt):
+                return response
+            delay = self.retry_policy.delay(attempt, retry_after)
+            if not _deadline_allows(delay):
+                return response # 待つと処理期限に間に合わないため再試行しない
+            ISE_API_RETRIES.inc(api=api, status=response.status_code)
+            logger.warning("ISEが %s を返しました (%s %s)。%.1f秒後に再試行します (%s/%s)。", response.status_code, method, urlsplit(url).path, delay, attempt + 1, self.retry_policy.max_retries)
+            response.close()
+            time.sleep(delay)
+            attempt += 1
+            span.set_attribute('ise.retry_count', attempt)
+
+    def node_request(self, pool, url_template, method, path, primary_only=False, **kwargs):
+        """
+        poolのノードへリクエストを送信する。url_templateは '{node}' と '{path}' を含むURLの書式。
+        接続エラー・タイムアウト・502/504の場合はノードの失敗として記録し、
+        読み込み (primary_only=False) であれば次のノードへフェイルオーバーする。
+        """
+        last_error = None
+        nodes = pool.candidates(primary_only)
+        for position, node in enumerate(nodes):
+            if not pool.acquire(node):
+                continue # half-openで他のリクエストが試行中
+            url = url_template.format(node=node, path=path)
+            try:
+                response = self.request(method, url, **kwargs)
+            except DeadlineExceeded:
+                pool.release(node) # 処理期限切れはノードの障害として扱わない
+                raise
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                pool.record_failure(node, e)
+                last_error = e
+                continue
+            except Exception:
+                pool.release(node)
+                raise
+            if response.status_code in NODE_FAILURE_STATUS:
+                pool.record_failure(node, f"HTTP {response.status_code}")
+                if position < len(nodes) - 1:
+                    response.close()
+                    continue
+                return response
+            pool.record_success(node)
+            return response
+        raise last_error or NodeUnavailable(f"{pool.role} ノード ({', '.join(nodes)}) は全て一時的に遮断中です")
+
+    def ers_request(self, method, path, headers=None, primary=None, **kwargs):
+        """
+        ERS API (既定はポート9060、ISE_ERS_PORTで変更可) へリクエストを送信する。
+        ERS APIはBasic認証ヘッダーを使用する。
+        読み込み (GET) はPANノードに振り分け、書き込みはprimary PANへ送る。
+        primary=True で読み込みもprimary PANへ送る (Bulk処理の状態確認など)。
+        同じURLへのGETが並行に要求された場合は1回だけ送信し、レスポンスを共有する。
+        個別リソース (/ers/config/{種別}/{id}) のGETはresponse_cacheを使い、変更がなければ本文を受信しない。
+        """
+        cache = self.response_cache
+        method = method.upper()
+        if cache is not None and method == 'GET' and not headers and cache.cacheable(path, kwargs):
+            return self._cached_ers_get(cache, path, primary)
+        response = self._send_ers(method, path, headers, primary, **kwargs)
+        if cache is not None and method in ERS_MUTATING_METHODS:
+            cache.invalidate_for_mutation(path) # 変更したリソースと一覧の古い内容を返さないようにする
+        return response
+
+    def _send_ers(self, method, path, headers, primary, **kwargs):
+        request_headers = {**self.ers_headers, **headers} if headers else self.ers_headers
+        if primary is None:
+            primary = method not in ('GET', 'HEAD')
+        send = functools.partial(self.node_request, self.pan_pool, self.ers_url_template, method, path,
+                                 primary_only=primary, headers=request_headers, **kwargs)
+        key = single_flight_key(method, path, headers=headers, **kwargs)
+        if key is None:
+            return send()
+        return self._single_flight.do(('ers', primary) + key, send)
+
+    def _cached_ers_get(self, cache, path, primary):
+        """
+        キャッシュが有効期間内ならISEへ送信せずに返し、期限切れなら条件付きGETで再検証する。
+        """
+        entry = cache.get(path)
+        if entry is not None and entry.fresh():
+            record_http_cache_result('hit')
+            return entry.to_response(path)
+        response = self._send_ers('GET', path, entry.conditional_headers() if entry else None, primary)
+        if response.status_code == 304 and entry is not None:
+            record_http_cache_result('revalidated')
+            return cache.revalidated(path, entry, response.headers).to_response(path)
+        record_http_cache_result('miss')
+        if response.status_code == 200:
+            cache.store(path, response.headers, response.content)
+        elif response.status_code == 404:
+            cache.invalidate(path)
+        return response
+
+    def mnt_request(self, method, path, headers=None, **kwargs):
+        """
+        MnT API (XML API) へリクエストを送信する。MnTノードに振り分ける。
+        XML APIは認証情報をrequestsのauthパラメータで渡す。
+        streamでないGETはers_requestと同様に並行な同一リクエストを1回にまとめる。
+        """
+        request_headers = {**self.mnt_headers, **headers} if headers else self.mnt_headers
+        send = functools.partial(self.node_request, self.mnt_pool, self.mnt_url_template, method, path,
+                                 headers=request_headers, auth=(self.username, self.password), **kwargs)
+        key = single_flight_key(method, path, headers=headers, **kwargs)
+        if key is None:
+            return send()
+        return self._single_flight.do(('mnt',) + key, send)
+
+    def close(self):
+        """
+        保持している全セッション (コネクションプール) とHTTPキャッシュのSQLite接続を閉じる。
+        """
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+        if self.response_cache is not None:
+            self.response_cache.close()
+
+
+# ISEClient (と AsyncISEClient) の生成に使う設定項目。再読み込みでこれら以外の項目だけが
+# 変わった場合は、既存のクライアント (サーキットブレーカー、流量制御、HTTPキャッシュの状態) を使い続ける
+ISE_CLIENT_SETTINGS = frozenset((
+    'ise_ip', 'username', 'password', 'http_proxy', 'pan_nodes', 'mnt_nodes',
+    'ise_scheme', 'ers_port', 'mnt_port', 'pool_connections', 'pool_maxsize',
+    'connect_timeout', 'read_timeout', 'rate_limit', 'rate_burst', 'max_concurrency',
+    'retry_max', 'retry_base_delay', 'retry_max_delay', 'node_failure_threshold', 'node_cooldown',
+    'async_max_connections', 'async_max_concurrency',
+    'http_cache_maxsize', 'http_cache_ttl', 'http_cache_ttl_endpoint', 'http_cache_ttl_endpointgroup',
+    'http_cache_db',
+))
+
+_ise_client = None
+_ise_client_lock = threading.Lock()
+
+def get_ise_client():
+    """
+    プロセス共通のISEClientを返す。初回呼び出し時に現在の設定 (Settings) から生成する。
+    設定が再読み込みされた場合、ISE_CLIENT_SETTINGS の項目が変わっていれば新しい設定で生成し直して
+    古いクライアントを閉じ、変わっていなければ既存のクライアントをそのまま使う。
+    必須の設定が不足している場合はNoneを返す。
+    """
+    global _ise_client
+    settings = get_settings()
+    if _ise_client is None or _ise_client.settings is not settings:
+        old_client = None
+        with _ise_client_lock:
+            if _ise_client is None or _ise_client.settings is not settings:
+                if not settings.configured:
+                    logger.error(".envファイルにISE_IP、ISE_USERNAMEまたはISE_PASSWORDが設定されていません")
+                    return None
+                if _ise_client is not None and not ISE_CLIENT_SETTINGS.intersection(
+                        settings.changed_fields(_ise_client.settings)):
+                    _ise_client.settings = settings # 接続に関わらない変更のみ
+                else:
+                    old_client, _ise_client = _ise_client, ISEClient.from_settings(settings)
+                    start_settings_watcher()
+        if old_client is not None:
+            # 処理中のリクエストは閉じたプールの接続を使い終えた時点で切断される
+            old_client.close()
+    return _ise_client
+
+
+# =====================================================
+# ERS一覧APIのページング
+# =====================================================
+
+# ERS一覧APIで指定できる1ページあたりの最大件数 (既定値は20件)
+ERS_MAX_PAGE_SIZE = 100
+
+
+def _ers_page_span_attributes(path, params):
+    return {'ise.resource_path': path, 'ise.page': int(params.get('page', 1)), 'ise.page_size': int(params.get('size', 20))}
+
+
+@traced('ers.page', lambda client, path, params: _ers_page_span_attributes(path, params))
+def _fetch_ers_page(client, path, params):
+    """
+    ERS一覧APIの1ページ分を取得し、SearchResultの辞書を返す。
+    """
+    response = client.ers_request('GET', path, params=params)
+    response.raise_for_status()
+    return response.json().get('SearchResult', {})
+
+
+def _next_page_request(search_result):
+    """
+    SearchResult.nextPage.href から次ページの (パス, クエリパラメータ) を取り出す。
+    次ページがない場合はNoneを返す。
+    hrefにはホスト名が含まれるが、接続先はclient側で決めるためパスのみを使用する。
+    """
+    href = (search_result.get('nextPage') or {}).get('href')
+    if not href:
+        return None
+    parts = urlsplit(href)
+    return parts.path, dict(parse_qsl(parts.query))
+
+
+def iter_ers_resources(client, path, params=None, page_size=ERS_MAX_PAGE_SIZE, prefetch=False):
+    """
+    ERS一覧API (endpoint, endpointgroup, internaluser など) の全ページをたどり、
+    SearchResult.resources の要素を1件ずつ返すジェネレータ。
+    nextPageのリンクがなくなるまで必要な分だけページを取得する。
+    prefetch=True の場合、現在ページの要素を返している間に次ページを先読みする。
+    取得エラー (RequestException, JSONDecodeError) は呼び出し元に送出する。
+    """
+    query = dict(params or {})
+    query.setdefault('size', page_size)
+    query.setdefault('page', 1)
+
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ers-prefetch') if prefetch else None
+    try:
+        search_result = _fetch_ers_page(client, path, query)
+        page_number = 1
+        logger.debug("ERS一覧取得 %s: total=%s", path, search_result.get('total', 'N/A'))
+        while True:
+            resources = search_result.get('resources', [])
+            next_request = _next_page_request(search_result) if resources else None
+            next_future = None
+            if next_request and executor:
+                next_future = executor.submit(contextvars.copy_context().run, _fetch_ers_page, client, *next_request)
+
+            for resource in resources:
+                yield resource
+
+            if not next_request:
+                break
+            page_number += 1
+            logger.debug("ERS一覧取得 %s: page %s", path, page_number)
+            if next_future is not None:
+                search_result = next_future.result()
+            else:
+                search_result = _fetch_ers_page(client, *next_request)
+    finally:
+        if executor:
+            # 途中で反復を打ち切った場合、先読み中のページは破棄する
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+# =====================================================
+# キャッシュ
+# =====================================================
+
+class TTLCache:
+    """
+    スレッドセーフなTTL付きキャッシュ。
+    エントリ数がmaxsizeを超えた場合は最も長く参照されていないものから削除する (LRU)。
+    nameを指定した場合はヒット・ミスの回数をメトリクスに記録する。
+    """
+
+    def __init__(self, maxsize=1024, ttl=300, name=None):
+        self.maxsize = maxsize
+        self.ttl = ttl # 秒
+        self.name = name
+        self._data = OrderedDict() # key -> (有効期限, value)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        キーに対応する値を返す。存在しないか期限切れの場合はdefaultを返す。
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] <= time.monotonic():
+                del self._data[key]
+                entry = None
+            if entry is not None:
+                self._data.move_to_end(key)
+        if self.name:
+            count_cache_lookup(self.name, entry is not None)
+        return default if entry is None else entry[1]
+
+    def set(self, key, value, ttl=None):
+        """
+        値を登録する。ttlを省略した場合はキャッシュ既定のTTLを使用する。
+        """
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def configure(self, maxsize, ttl):
+        """
+        容量と既定のTTLを変更する (設定の再読み込み用)。登録済みのエントリの有効期限は変えない。
+        """
+        with self._lock:
+            self.maxsize = maxsize
+            self.ttl = ttl
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key=None):
+        """
+        指定キーを削除する。keyを省略した場合は全件削除する。
+        """
+        with self._lock:
+            if key is None:
+                self._data.clear()
+            else:
+                self._data.pop(key, None)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+
+# Endpoint Group ID -> Group名 のプロセス共通キャッシュ
+# Group数はEndpoint数に比べて少ないため、一覧取得1回でほぼ全てを賄える
+_group_name_cache = TTLCache(
+    maxsize=get_settings().group_cache_maxsize,
+    ttl=get_settings().group_cache_ttl,
+    name='group_name',
+)
+
+
+@on_settings_reload
+def _configure_group_name_cache(settings):
+    _group_name_cache.configure(settings.group_cache_maxsize, settings.group_cache_ttl)
+
+
+_group_cache_lock = threading.Lock()
+_group_cache_next_warm_at = 0.0 # 次に一覧取得で温め直す時刻 (time.monotonic)
+_group_cache_warmed_at = None # 最後に一覧取得で温めた時刻 (time.time)
+
+
+def warm_group_name_cache(client):
+    """
+    Endpoint Group一覧 (GET /ers/config/endpointgroup) を一括取得し、
+    Group名キャッシュに登録する。登録件数を返す。
+    """
+    global _group_cache_next_warm_at, _group_cache_warmed_at
+    started_at = time.time()
+    count = 0
+    for group in iter_ers_resources(client, "/ers/config/endpointgroup"):
+        if group.get('id') and group.get('name'):
+            _group_name_cache.set(group['id'], group['name'])
+            count += 1
+    _group_cache_next_warm_at = time.monotonic() + _group_name_cache.ttl
+    _group_cache_warmed_at = started_at
+    logger.debug("Group名キャッシュを更新しました: %s件", count)
+    return count
+
+
+def ensure_group_name_cache(client):
+    """
+    Group名キャッシュが未取得またはTTL切れの場合に一覧取得で温める。
+    並行に呼び出されても一覧取得は1回だけ行う。
+    """
+    global _group_cache_next_warm_at
+    if time.monotonic() < _group_cache_next_warm_at:
+        return
+    with _group_cache_lock:
+        if time.monotonic() < _group_cache_next_warm_at:
+            return # 他のスレッドが取得済み
+        try:
+            warm_group_name_cache(client)
+        except Exception as e:
+            # 失敗時は個別取得にフォールバックし、一覧取得は少し待ってから再試行する
+            logger.error("Endpoint Group一覧の取得に失敗しました: %s", e)
+            _group_cache_next_warm_at = time.monotonic() + min(30, _group_name_cache.ttl)
+
+
+def refresh_group_name_cache(client):
+    """
+    Group名キャッシュを一覧取得で温め直す (バックグラウンド更新用)。
+    参照中のエントリは置き換わるまで使われ続けるため、ルートは一覧取得を待たない。
+    """
+    with _group_cache_lock:
+        return warm_group_name_cache(client)
+
+
+def group_name_cache_status():
+    """
+    Group名キャッシュの状態 (件数、最後に一覧取得した時刻と経過秒数) を返す。
+    """
+    warmed_at = _group_cache_warmed_at
+    return {
+        'count': len(_group_name_cache),
+        'refreshed_at': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(warmed_at)) if warmed_at else None,
+        'age_seconds': round(time.time() - warmed_at, 1) if warmed_at else None,
+    }
+
+
+def invalidate_group_name_cache():
+    """
+    Group名キャッシュを破棄し、次回参照時に一覧を取得し直すようにする。
+    """
+    global _group_cache_next_warm_at, _group_cache_warmed_at
+    _group_name_cache.invalidate()
+    _group_cache_next_warm_at = 0.0
+    _group_cache_warmed_at = None
+    logger.info("Group名キャッシュを破棄しました。")
+
+
+# Helper function to get Group Name by ID
+@traced('endpoint_group.lookup', lambda client, group_id: {'ise.group.id': group_id})
+def get_group_name_by_id(client, group_id):
+    """
+    Endpoint GroupのIDを使って、そのGroupの名前を取得するヘルパー関数。
+    Group名キャッシュ (未取得・期限切れの場合は一覧取得で温める) を参照し、
+    見つからない場合のみ個別にGroup詳細を取得する。
+    """
+    if not group_id:
+        return 'N/A (IDなし)'
+
+    # キャッシュ未取得・期限切れなら一覧取得で温めてから参照する (ヒット・ミスは1回だけ記録する)
+    ensure_group_name_cache(client)
+    group_name = _group_name_cache.get(group_id)
+    if group_name is not None:
+        current_span().set_attribute('ise.cache_hit', True)
+        return group_name
+    current_span().set_attribute('ise.cache_hit', False)
+
+    # 一覧取得後に作成されたGroupなど、キャッシュにない場合は個別に取得
+    debug_sampled('group_detail', "  Group詳細取得 (ID: %s)", group_id)
+
+    try:
+        response = client.ers_request('GET', f"/ers/config/endpointgroup/{group_id}")
+        response.raise_for_status()
+        group_data = response.json()
+
+        # Endpoint Group詳細レスポンスの構造に合わせて名前を抽出
+        # 前回の調査結果に基づき、'EndPointGroup' キーの下に 'name' があると想定
+        group_detail = group_data.get('EndPointGroup', {})
+        group_name = group_detail.get('name')
+        if group_name is None:
+            return '名前不明 (キーなし)'
+
+        # 取得に成功した名前のみキャッシュする (エラー文字列はキャッシュしない)
+        _group_name_cache.set(group_id, group_name)
+        return group_name
+
+    except DeadlineExceeded:
+        raise # 処理期限切れはエラー行にせず、呼び出し元で部分的な結果として扱う
+    except requests.exceptions.RequestException as e:
+        logger.error("Group詳細情報 (ID: %s) の取得に失敗しました: %s", group_id, e)
+        return f"取得失敗 ({_status_code_of(e)})"
+    except json.JSONDecodeError:
+        logger.error("Group詳細情報 (ID: %s) のレスポンスがJSON形式ではありません。", group_id)
+        return "不明 (不正なレスポンス)"
+    except Exception as e:
+        logger.error("Group詳細情報 (ID: %s) 取得中に予期しないエラーが発生しました: %s", group_id, e)
+        return f"予期しないエラー ({e})"
+
+
+def _endpoint_span_attributes(index, endpoint_summary):
+    return {'ise.endpoint.id': endpoint_summary.get('id'), 'ise.endpoint.index': index}
+
+
+@traced('endpoint.enrich', lambda client, index, endpoint_summary: _endpoint_span_attributes(index, endpoint_summary))
+def fetch_endpoint_with_group(client, index, endpoint_summary):
+    """
+    Endpoint簡易情報1件について、詳細情報と所属Groupの名前を取得して
+    {'mac', 'group_id', 'group_name'} の辞書を返す。
+    取得に失敗した場合もエラー内容を入れた辞書を返す。IDがない場合はNoneを返す。
+    スレッドプールから並行に呼び出されるため、共有状態はスレッドセーフなもののみ使用すること。
+    """
+    endpoint_id = endpoint_summary.get('id')
+    # 簡易リストのnameはMACアドレスを期待
+    endpoint_mac_summary = endpoint_summary.get('name', 'MAC不明 (簡易リスト)')
+
+    if not endpoint_id:
+        logger.warning("Endpoint簡易情報 %s: IDが見つかりません。スキップします。", index+1)
+        return None
+
+    # Endpoint詳細取得 (2番目のAPIコール)
+    debug_sampled('endpoint_detail', "  Endpoint詳細取得 (%s, ID: %s)", endpoint_mac_summary, endpoint_id)
+    try:
+        detail_response = client.ers_request('GET', f"/ers/config/endpoint/{endpoint_id}")
+        detail_response.raise_for_status()
+        detail_data = detail_response.json()
+
+        endpoint_detail = detail_data.get('ERSEndPoint', {})
+        # 詳細情報にあればそちらのMACを使用、なければ簡易リストから
+        mac_address = endpoint_detail.get('mac', endpoint_mac_summary)
+        # 詳細情報からgroupIdを取得
+        group_id = endpoint_detail.get('groupId', 'N/A')
+
+        group_name = 'N/A'
+        if group_id and group_id != 'N/A':
+            # Group名取得 (3番目のAPIコール)
+            group_name = get_group_name_by_id(client, group_id)
+
+        return {
+            'mac': mac_address,
+            'group_id': group_id,
+            'group_name': group_name
+        }
+
+    except DeadlineExceeded:
+        raise # 処理期限切れはエラー行にせず、呼び出し元で部分的な結果として扱う
+    except requests.exceptions.RequestException as e:
+        logger.error("Endpoint詳細情報 (%s, ID: %s) の取得に失敗しました: %s", endpoint_mac_summary, endpoint_id, e)
+        return {
+            'mac': endpoint_mac_summary,
+            'group_id': 'エラー',
+            'group_name': f'取得失敗 ({_status_code_of(e)})'
+        }
+    except json.JSONDecodeError:
+        logger.error("Endpoint詳細情報 (%s, ID: %s) のレスポンスがJSON形式ではありません。", endpoint_mac_summary, endpoint_id)
+        return {
+            'mac': endpoint_mac_summary,
+            'group_id': '不明',
+            'group_name': '不明 (不正なレスポンス)'
+        }
+    except Exception as e:
+        logger.error("Endpoint詳細情報 (%s, ID: %s) 取得中に予期しないエラーが発生しました: %s", endpoint_mac_summary, endpoint_id, e)
+        return {
+            'mac': endpoint_mac_summary,
+            'group_id': 'エラー',
+            'group_name': f'予期しないエラー ({e})'
+        }
+
+
+def _worker_count(workers=None):
+    """
+    並行取得のワーカー数を決める。省略時は ISE_MAX_WORKERS、上限は ISE_MAX_WORKERS_LIMIT。
+    """
+    if workers is None:
+        workers = get_settings().max_workers
+    return max(1, min(workers, get_settings().max_workers_limit))
+
+
+def _future_result(future):
+    """
+    Futureの結果を、処理期限が近づくまでの範囲で待って返す。
+    """
+    try:
+        return future.result(timeout=None if future.done() else deadline_wait_timeout())
+    except FutureTimeoutError:
+        raise DeadlineExceeded("処理期限が近いため結果待ちを打ち切りました")
+
+
+def iter_ordered_parallel(items, func, workers, needs_worker=None):
+    """
+    itemsの各要素にfuncを適用した結果を、入力と同じ順番で1件ずつ返すジェネレータ。
+    funcはスレッドプール (workers並行) で実行する。未完了の要素は workers*4 件までに抑えるため、
+    itemsがジェネレータの場合も全件をメモリに読み込まずに処理できる。
+    needs_worker(item) がFalseを返す要素はスレッドプールを使わずにその場でfuncを実行する。
+    workers=1の場合は順番に実行する。
+    処理期限 (deadline_scope) 内では、期限が近づいた時点でDeadlineExceededを送出し、
+    未実行の要素を破棄する (実行中の要素のISEリクエストも期限で打ち切られる)。
+    """
+    if workers <= 1:
+        for item in items:
+            deadline_wait_timeout() # 期限が近ければDeadlineExceeded
+            yield func(item)
+        return
+
+    pending = deque()
+    max_pending = workers * 4
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='ise-fetch')
+    try:
+        for item in items:
+            if needs_worker is None or needs_worker(item):
+                # 処理期限などのcontextvarsをワーカースレッドへ引き継ぐ
+                pending.append(executor.submit(contextvars.copy_context().run, func, item))
+            else:
+                future = Future()
+                future.set_result(func(item))
+                pending.append(future)
+            # 先頭から完了しているものを順に返す。未完了が多すぎる場合は先頭の完了を待つ
+            while pending and (pending[0].done() or len(pending) >= max_pending):
+                yield _future_result(pending.popleft())
+        while pending:
+            yield _future_result(pending.popleft())
+    finally:
+        # 途中で打ち切られた場合 (クライアント切断など) は未実行の要素を破棄する
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def iter_endpoints_with_group(client, endpoints_summary, workers=None):
+    """
+    Endpoint簡易情報 (リストまたはジェネレータ) の各要素について
+    fetch_endpoint_with_group を並行に実行し、入力と同じ順番で結果を返すジェネレータ。
+    IDがなくスキップされたEndpointは返さない。
+    """
+    workers = _worker_count(workers)
+    logger.debug("Endpoint詳細取得の並行数: %s", workers)
+    results = iter_ordered_parallel(
+        enumerate(endpoints_summary),
+        lambda args: fetch_endpoint_with_group(client, *args),
+        workers,
+    )
+    for result in results:
+        if result is not None:
+            yield result
+
+
+# =====================================================
+# MACアドレス -> Endpoint ID 解決
+# =====================================================
+
+_MAC_SEPARATORS = re.compile(r'[\s:\-.]')
+_MAC_HEX = re.compile(r'[0-9A-F]{12}')
+
+
+def normalize_mac(mac_address):
+    """
+    'aa-bb-cc-dd-ee-ff', 'aabb.ccdd.eeff', 'AABBCCDDEEFF' などのMACアドレス表記を
+    ISEの標準表記 'AA:BB:CC:DD:EE:FF' に正規化する。MACアドレスとして不正な場合はNoneを返す。
+    """
+    if not mac_address:
+        return None
+    hex_digits = _MAC_SEPARATORS.sub('', mac_address).upper()
+    if not _MAC_HEX.fullmatch(hex_digits):
+        return None
+    return ':'.join(hex_digits[i:i+2] for i in range(0, 12, 2))
+
+
+# サーバー側検索が使えない場合にのみ使用するローカルのMAC -> Endpoint IDの索引
+_endpoint_id_index = TTLCache(
+    maxsize=get_settings().mac_index_maxsize,
+    ttl=get_settings().mac_index_ttl,
+    name='endpoint_id_index',
+)
+
+
+@on_settings_reload
+def _configure_endpoint_id_index(settings):
+    _endpoint_id_index.configure(settings.mac_index_maxsize, settings.mac_index_ttl)
+
+
+# サーバー側の検索API (endpoint/name、filter検索) が存在しない (古いISEなど) と判断するステータスコード
+_LOOKUP_UNSUPPORTED_STATUS = (404, 405, 501)
+
+
+def _is_ers_error_response(response):
+    """
+    ERS APIが返したエラー (本文がERSResponse) かどうか。
+    APIそのものが存在しない場合の404と、リソースが見つからない場合の404を区別するために使う。
+    """
+    try:
+        return 'ERSResponse' in response.json()
+    except (ValueError, AttributeError):
+        return False
+
+
+def _lookup_endpoint_id_by_name(client, mac_address):
+    """
+    GET /ers/config/endpoint/name/{mac} でEndpoint IDを取得する。
+    見つからない場合は (True, None) を、APIが使えない場合は (False, None) を返す。
+    それ以外のエラーはrequests.exceptions.HTTPErrorを送出する。
+    """
+    response = client.ers_request('GET', f"/ers/config/endpoint/name/{mac_address}")
+    if response.status_code == 404 and _is_ers_error_response(response):
+        return True, None # Endpointが存在しない
+    if response.status_code in _LOOKUP_UNSUPPORTED_STATUS:
+        logger.debug("endpoint/name APIが使用できません (Status Code: %s)", response.status_code)
+        return False, None
+    response.raise_for_status()
+    return True, response.json().get('ERSEndPoint', {}).get('id')
+
+
+def _lookup_endpoint_id_by_filter(client, mac_address):
+    """
+    GET /ers/config/endpoint?filter=mac.EQ.{mac} でEndpoint IDを取得する。
+    戻り値・例外は _lookup_endpoint_id_by_name と同じ。
+    """
+    response = client.ers_request('GET', "/ers/config/endpoint",
+                                  params={'filter': f"mac.EQ.{mac_address}"})
+    if response.status_code in _LOOKUP_UNSUPPORTED_STATUS:
+        logger.debug("endpoint filter検索が使用できません (Status Code: %s)", response.status_code)
+        return False, None
+    response.raise_for_status()
+    resources = response.json().get('SearchResult', {}).get('resources', [])
+    for endpoint_summary in resources:
+        if normalize_mac(endpoint_summary.get('name')) == mac_address:
+            return True, endpoint_summary.get('id')
+    return True, None
+
+
+def _lookup_endpoint_id_by_scan(client, mac_address):
+    """
+    ローカル索引を参照し、なければEndpoint一覧を全ページたどって索引を作りながら検索する。
+    """
+    endpoint_id = _endpoint_id_index.get(mac_address) or get_endpoint_inventory().find_id_by_mac(mac_address)
+    if endpoint_id is not None:
+        return endpoint_id
+    logger.debug("Endpoint一覧をたどってMAC %s を検索します。", mac_address)
+    for endpoint_summary in iter_ers_resources(client, "/ers/config/endpoint", prefetch=True):
+        summary_mac = normalize_mac(endpoint_summary.get('name'))
+        if summary_mac and endpoint_summary.get('id'):
+            _endpoint_id_index.set(summary_mac, endpoint_summary['id'])
+            if summary_mac == mac_address:
+                endpoint_id = endpoint_summary['id']
+    return endpoint_id
+
+
+def resolve_endpoint_id_by_mac(client, mac_address):
+    """
+    MACアドレスに一致するEndpointのIDを返す。見つからない場合はNoneを返す。
+    まずサーバー側の検索 (endpoint/name API、filter検索) を使い、
+    どちらも使えない古いISE (404/405/501) の場合のみ一覧をたどるローカル索引にフォールバックする。
+    検索APIがそれ以外のエラー (401、500など) を返した場合はrequests.exceptions.HTTPErrorを送出する。
+    mac_addressは normalize_mac() で正規化済みであること。
+    """
+    for lookup in (_lookup_endpoint_id_by_name, _lookup_endpoint_id_by_filter):
+        try:
+            supported, endpoint_id = lookup(client, mac_address)
+        except json.JSONDecodeError:
+            supported, endpoint_id = False, None
+        if supported:
+            return endpoint_id
+    return _lookup_endpoint_id_by_scan(client, mac_address)
+
+
+# =====================================================
+# Endpointの一括追加・一括削除 (ERS Bulk API)
+# =====================================================
+
+ERS_BULK_NAMESPACE = 'identity.ers.ise.cisco.com'
+ERS_ENDPOINT_MEDIA_TYPE = 'vnd.com.cisco.ise.identity.endpoint.1.0+xml'
+ET.register_namespace('identity', ERS_BULK_NAMESPACE)
+# Bulk APIが存在しない (古いISEなど) と判断するステータスコード
+_BULK_UNSUPPORTED_STATUS = (404, 405, 415, 501)
+# Bulk処理が終了したことを示すexecutionStatus
+_BULK_FINISHED_STATUS = ('COMPLETED', 'COMPLETED_WITH_ERRORS', 'ABORTED', 'FAILED')
+
+
+def _build_endpoint_bulk_xml(operation_type, items):
+    """
+    ERS Bulk API (endpointBulkRequest) のXMLリクエストボディを組み立てる。
+    create の場合はEndpoint情報の一覧を、delete の場合はEndpoint IDの一覧を含める。
+    """
+    root = ET.Element(f'{{{ERS_BULK_NAMESPACE}}}endpointBulkRequest', {
+        'operationType': operation_type,
+        'resourceMediaType': ERS_ENDPOINT_MEDIA_TYPE,
+    })
+    if operation_type == 'create':
+        resources_list = ET.SubElement(root, f'{{{ERS_BULK_NAMESPACE}}}resourcesList')
+        for item in items:
+            endpoint = ET.SubElement(resources_list, f'{{{ERS_BULK_NAMESPACE}}}endpoint')
+            ET.SubElement(endpoint, 'groupId').text = item['endpoint_group_id']
+            ET.SubElement(endpoint, 'mac').text = item['mac']
+            ET.SubElement(endpoint, 'staticGroupAssignment').text = 'true'
+    else:
+        id_list = ET.SubElement(root, 'idList')
+        for item in items:
+            ET.SubElement(id_list, 'id').text = item['endpoint_id']
+    return ET.tostring(root, encoding='utf-8', xml_declaration=True)
+
+
+def submit_endpoint_bulk(client, operation_type, items):
+    """
+    PUT /ers/config/endpoint/bulk/submit でBulk処理を登録し、Bulk IDを返す。
+    Bulk APIが使用できない場合はNoneを返す。
+    """
+    response = client.ers_request(
+        'PUT',
+        "/ers/config/endpoint/bulk/submit",
+        headers={'Content-Type': 'application/xml', 'Accept': 'application/xml'},
+        data=_build_endpoint_bulk_xml(operation_type, items),
+    )
+    if response.status_code in _BULK_UNSUPPORTED_STATUS:
+        logger.info("ERS Bulk APIが使用できません (Status Code: %s)", response.status_code)
+        return None
+    response.raise_for_status()
+    # Locationヘッダーの末尾がBulk ID (/ers/config/endpoint/bulk/{bulkId})
+    location = response.headers.get('Location', '')
+    bulk_id = location.rstrip('/').rsplit('/', 1)[-1]
+    if not bulk_id:
+        raise ValueError("Bulk処理のLocationヘッダーがありません")
+    logger.debug("Bulk処理を登録しました: %s, %s件, Bulk ID: %s", operation_type, len(items), bulk_id)
+    return bulk_id
+
+
+def wait_endpoint_bulk(client, bulk_id):
+    """
+    Bulk処理の状態 (GET /ers/config/endpoint/bulk/{bulkId}) を終了するまでポーリングし、
+    bulkStatus の辞書を返す。ISE_BULK_TIMEOUT 秒以内に終わらない場合は最後の状態を返す。
+    現在の処理期限 (ISE_DEADLINE_MARGIN 秒前) までに終わらない場合はDeadlineExceededを送出する。
+    """
+    settings = get_settings()
+    poll_interval = settings.bulk_poll_interval
+    give_up_at = time.monotonic() + settings.bulk_timeout
+    bulk_status = {}
+    while True:
+        response = client.ers_request('GET', f"/ers/config/endpoint/bulk/{bulk_id}", primary=True) # Bulk処理を登録したprimary PANに問い合わせる
+        response.raise_for_status()
+        data = response.json()
+        bulk_status = data.get('BulkStatus', data.get('bulkStatus', {}))
+        execution_status = str(bulk_status.get('executionStatus', '')).upper()
+        if execution_status in _BULK_FINISHED_STATUS:
+            return bulk_status
+        if not _deadline_allows(poll_interval + settings.deadline_margin):
+            raise DeadlineExceeded(f"処理期限までにBulk処理 {bulk_id} が終了しませんでした (executionStatus: {execution_status})")
+        if time.monotonic() + poll_interval > give_up_at:
+            logger.warning("Bulk処理 %s が時間内に終了しませんでした (executionStatus: %s)", bulk_id, execution_status)
+            return bulk_status
+        time.sleep(poll_interval)
+
+
+def _apply_bulk_status(items, bulk_status, key):
+    """
+    bulkStatus.resourcesStatus の結果を各itemの結果 (status, message) に反映する。
+    keyはresourcesStatusと突き合わせる項目 ('mac' または 'endpoint_id')。
+    """
+    by_key = {}
+    for resource_status in bulk_status.get('resourcesStatus', []) or []:
+        if key == 'mac':
+            resource_key = normalize_mac(resource_status.get('name'))
+        else:
+            resource_key = resource_status.get('id')
+        by_key[resource_key] = resource_status
+
+    execution_status = str(bulk_status.get('executionStatus', 'UNKNOWN')).upper()
+    for item in items:
+        resource_status = by_key.get(item[key])
+        if resource_status is not None:
+            succeeded = str(resource_status.get('resourceExecutionStatus', '')).upper() == 'SUCCESS'
+            item['status'] = 'success' if succeeded else 'failed'
+            if succeeded and resource_status.get('id'):
+                item['endpoint_id'] = resource_status['id']
+            item['message'] = resource_status.get('status') or resource_status.get('resourceExecutionStatus', '')
+        elif execution_status == 'COMPLETED' and not bulk_status.get('failCount'):
+            item['status'] = 'success'
+            item['message'] = 'COMPLETED'
+        else:
+            item['status'] = 'unknown'
+            item['message'] = f"Bulk処理の状態: {execution_status}"
+
+
+def _add_endpoint_single(client, item):
+    """
+    Bulk APIが使えない場合に1件ずつEndpointを作成する (POST /ers/config/endpoint)。
+    """
+    payload = {
+        "ERSEndPoint": {
+            "mac": item['mac'],
+            "groupId": item['endpoint_group_id'],
+            "staticGroupAssignment": True
+        }
+    }
+    try:
+        response = client.ers_request('POST', "/ers/config/endpoint",
+                                      headers={'Content-Type': 'application/json'},
+                                      data=json.dumps(payload))
+        response.raise_for_status()
+        item['endpoint_id'] = response.headers.get('Location', '').rstrip('/').rsplit('/', 1)[-1] or None
+        item['status'], item['message'] = 'success', 'created'
+    except DeadlineExceeded:
+        item['status'], item['message'] = 'timeout', '処理期限までに結果を確認できませんでした'
+    except requests.exceptions.RequestException as e:
+        item['status'], item['message'] = 'failed', f"追加失敗 ({_status_code_of(e)})"
+    return item
+
+
+def _delete_endpoint_single(client, item):
+    """
+    Bulk APIが使えない場合に1件ずつEndpointを削除する (DELETE /ers/config/endpoint/{id})。
+    """
+    try:
+        response = client.ers_request('DELETE', f"/ers/config/endpoint/{item['endpoint_id']}")
+        response.raise_for_status()
+        item['status'], item['message'] = 'success', 'deleted'
+    except DeadlineExceeded:
+        item['status'], item['message'] = 'timeout', '処理期限までに結果を確認できませんでした'
+    except requests.exceptions.RequestException as e:
+        item['status'], item['message'] = 'failed', f"削除失敗 ({_status_code_of(e)})"
+    return item
+
+
+def run_endpoint_bulk(client, operation_type, items):
+    """
+    itemsをISE_BULK_CHUNK_SIZE件ずつBulk APIで処理し、各itemに結果を設定する。
+    Bulk APIが使用できない場合は単体APIを並行に呼び出して処理する。
+    処理期限を過ぎた場合、送信済みで結果を確認できなかったものと未送信のものは status を 'timeout' とする。
+    処理方式 ('bulk' または 'single') を返す。
+    """
+    chunk_size = max(1, get_settings().bulk_chunk_size)
+    key = 'mac' if operation_type == 'create' else 'endpoint_id'
+    chunk, bulk_id = [], None
+    try:
+        for start in range(0, len(items), chunk_size):
+            chunk, bulk_id = items[start:start + chunk_size], None
+            bulk_id = submit_endpoint_bulk(client, operation_type, chunk)
+            if bulk_id is None:
+                # Bulk APIが非対応と分かった時点で、残りを単体APIで処理する
+                remaining = items[start:]
+                single = _add_endpoint_single if operation_type == 'create' else _delete_endpoint_single
+                workers = max(1, get_settings().max_workers)
+                with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='ise-bulk') as executor:
+                    # 処理期限などのcontextvarsをワーカースレッドへ引き継ぐ
+                    futures = [executor.submit(contextvars.copy_context().run, single, client, item)
+                               for item in remaining]
+                    for future in futures:
+                        future.result()
+                return 'single'
+            _apply_bulk_status(chunk, wait_endpoint_bulk(client, bulk_id), key)
+    except DeadlineExceeded:
+        submitted = {id(item) for item in chunk} if bulk_id is not None else set()
+        skipped = 0
+        for item in items:
+            if 'status' in item:
+                continue
+            if id(item) in submitted:
+                item['status'], item['message'] = 'timeout', f"処理期限までにBulk処理 {bulk_id} の結果を確認できませんでした"
+            else:
+                item['status'], item['message'] = 'timeout', '処理期限のため送信しませんでした'
+                skipped += 1
+        logger.warning("処理期限によりBulk処理を打ち切りました (未送信 %s件 / %s件)", skipped, len(items))
+    return 'bulk'
+
+
+class BulkRequestError(ValueError):
+    """
+    一括処理APIのリクエストの形式が不正 (400で応答する)。
+    """
+
+
+def _bulk_request_row(entry, default_group_id, position):
+    """
+    JSONの1項目 (MACアドレスの文字列、または {"mac_address", "endpoint_group_id"} の辞書) を
+    {'mac_address', 'endpoint_group_id'} にする。形式が不正な場合はBulkRequestErrorを送出する。
+    """
+    if isinstance(entry, str):
+        entry = {'mac_address': entry}
+    if not isinstance(entry, dict):
+        raise BulkRequestError(f"{position} はMACアドレスの文字列またはオブジェクトで指定してください: {json.dumps(entry, ensure_ascii=False)}")
+    mac_address = entry.get('mac_address', '')
+    group_id = entry.get('endpoint_group_id') or default_group_id
+    if not isinstance(mac_address, str):
+        raise BulkRequestError(f"{position} の mac_address は文字列で指定してください: {json.dumps(mac_address, ensure_ascii=False)}")
+    if group_id is not None and not isinstance(group_id, str):
+        raise BulkRequestError(f"{position} の endpoint_group_id は文字列で指定してください: {json.dumps(group_id, ensure_ascii=False)}")
+    return {'mac_address': mac_address, 'endpoint_group_id': group_id}
+
+
+def _json_list(data, key):
+    value = data.get(key, [])
+    if not isinstance(value, list):
+        raise BulkRequestError(f"{key} は配列で指定してください")
+    return value
+
+
+def _read_bulk_request_items():
+    """
+    一括処理APIのリクエストから処理対象の一覧を読み取る。
+    JSON ({"endpoints": [{"mac_address", "endpoint_group_id"}, ...]}、
+    {"mac_addresses": [...], "endpoint_group_id": ...}、または項目の配列そのもの) と、
+    CSVファイルのアップロード (列: mac_address[, endpoint_group_id]) に対応する。
+    [{'mac_address': 入力値, 'endpoint_group_id': 値またはNone}, ...] を返す。
+    JSONの形式が不正な場合は、不正な項目を示すBulkRequestErrorを送出する。
+    """
+    rows = []
+    if 'file' in request.files:
+        default_group_id = request.form.get('endpoint_group_id')
+        text = request.files['file'].read().decode('utf-8-sig')
+        for row in csv.reader(io.StringIO(text)):
+            if not row or not row[0].strip():
+                continue
+            mac_address = row[0].strip()
+            if not rows and normalize_mac(mac_address) is None and mac_address.lower() in ('mac', 'mac_address', 'macaddress'):
+                continue # ヘッダー行
+            group_id = row[1].strip() if len(row) > 1 and row[1].strip() else default_group_id
+            rows.append({'mac_address': mac_address, 'endpoint_group_id': group_id})
+        return rows
+
+    data = request.get_json(silent=True)
+    if data is None:
+        data = {}
+    items_name = 'endpoints'
+    if isinstance(data, list):
+        data, items_name = {'endpoints': data}, '' # 項目の配列そのもの
+    if not isinstance(data, dict):
+        raise BulkRequestError('リクエストボディはJSONのオブジェクトまたは配列で指定してください')
+    default_group_id = data.get('endpoint_group_id')
+    if default_group_id is not None and not isinstance(default_group_id, str):
+        raise BulkRequestError('endpoint_group_id は文字列で指定してください')
+    for i, endpoint in enumerate(_json_list(data, 'endpoints')):
+        rows.append(_bulk_request_row(endpoint, default_group_id, f"{items_name}[{i}]"))
+    for i, mac_address in enumerate(_json_list(data, 'mac_addresses')):
+        if not isinstance(mac_address, str):
+            raise BulkRequestError(f"mac_addresses[{i}] は文字列で指定してください: {json.dumps(mac_address, ensure_ascii=False)}")
+        rows.append({'mac_address': mac_address, 'endpoint_group_id': default_group_id})
+    return rows
+
+
+def _bulk_response(results, mode):
+    """
+    一括処理APIのレスポンス (項目ごとの結果と集計) を作成する。
+    """
+    summary = {'total': len(results)}
+    for result in results:
+        summary[result['status']] = summary.get(result['status'], 0) + 1
+    response = {'mode': mode, 'summary': summary, 'results': results}
+    if summary.get('timeout'):
+        response['incomplete'] = True # 処理期限により結果が揃っていない
+    return jsonify(response)
+
+
+# =====================================================
+# MnT (Active Session) XMLの解析
+# =====================================================
+
+# レスポンスボディを読み込む単位 (バイト)
+MNT_READ_CHUNK_SIZE = _env_int('ISE_MNT_READ_CHUNK_SIZE', 64 * 1024)
+
+MNT_ACTIVE_LIST_PATH = "/admin/API/mnt/Session/ActiveList"
+
+
+def _iter_xml_chunks(xml_source, chunk_size=MNT_READ_CHUNK_SIZE):
+    """
+    XMLの入力元をバイト列のチャンクに分けて順に返す。
+    xml_sourceはバイト列/文字列、requestsのResponse (stream=Trueで取得したもの)、
+    ファイルライクオブジェクト、またはバイト列のイテラブル。
+    """
+    if isinstance(xml_source, str):
+        xml_source = xml_source.encode('utf-8')
+    if isinstance(xml_source, bytes):
+        yield xml_source
+    elif isinstance(xml_source, requests.Response):
+        # 本文全体を文字列にせず、受信したチャンクをそのまま渡す (gzip等は展開済み)
+        yield from xml_source.iter_content(chunk_size=chunk_size)
+    elif hasattr(xml_source, 'read'):
+        while True:
+            chunk = xml_source.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    else:
+        yield from xml_source
+
+
+class XmlRecordParser:
+    """
+    MnTのXMLレスポンスをXMLPullParserで先頭から順に解析し、
+    record_tag要素ごとに {子要素名: テキスト} の辞書を取り出すパーサー。
+    受信したチャンクをfeed()で渡すと、そのチャンクまでで完結したレコードを返す。
+    処理済みの要素はその都度破棄するため、メモリ使用量は文書全体ではなく1レコード分に収まる。
+    root_attribに辞書を渡すと、ルート要素の属性 (noOfActiveSession など) を設定する。
+    ルート要素自体がrecord_tagの場合 (単一レコードの応答) はルートを1件として返す。
+    """
+
+    def __init__(self, record_tag, root_attrib=None):
+        self.record_tag = record_tag
+        self.root_attrib = root_attrib
+        self._parser = ET.XMLPullParser(events=('start', 'end'))
+        self._root = None
+
+    def feed(self, chunk):
+        self._parser.feed(chunk)
+        return self._read_records()
+
+    def close(self):
+        self._parser.close() # 文書が途中で終わっている場合はET.ParseError
+        return self._read_records()
+
+    def _read_records(self):
+        records = []
+        for event, element in self._parser.read_events():
+            if event == 'start':
+                if self._root is None:
+                    self._root = element
+                    if self.root_attrib is not None:
+                        self.root_attrib.update(element.attrib)
+                continue
+            if element.tag == self.record_tag:
+                records.append({child.tag: (child.text or '').strip() for child in element})
+                element.clear()
+                if element is not self._root:
+                    self._root.clear() # 処理済みのレコードをルートからも外す
+        return records
+
+
+def iter_xml_records(xml_source, record_tag, root_attrib=None, chunk_size=MNT_READ_CHUNK_SIZE):
+    """
+    xml_sourceをチャンク単位で読みながらXmlRecordParserで解析し、
+    record_tag要素ごとの辞書を1件ずつ返すジェネレータ。
+    """
+    parser = XmlRecordParser(record_tag, root_attrib)
+    for chunk in _iter_xml_chunks(xml_source, chunk_size):
+        yield from parser.feed(chunk)
+    yield from parser.close()
+
+
+def iter_active_sessions(xml_source, root_attrib=None):
+    """
+    MnTのActiveList XML (<activeList><activeSession>...</activeSession>...) を解析し、
+    activeSessionごとに {'calling_station_id', 'framed_ip_address', 'user_name', 'nas_ip_address', ...}
+    の辞書を返すジェネレータ。辞書のキーはactiveSessionの子要素名そのもの。
+    """
+    return iter_xml_records(xml_source, 'activeSession', root_attrib)
+
+
+def fetch_active_sessions(client, root_attrib=None):
+    """
+    ISEからActive Session一覧をストリーミングで取得し、セッションを1件ずつ返すジェネレータ。
+    レスポンスは受信しながら解析し、本文全体をメモリに保持しない。
+    HTTPエラーはrequests.exceptions.HTTPError、XMLの不正はET.ParseErrorとして送出される。
+    """
+    response = client.mnt_request('GET', MNT_ACTIVE_LIST_PATH, stream=True)
+    try:
+        response.raise_for_status()
+        yield from iter_active_sessions(response, root_attrib)
+    finally:
+        response.close() # 途中で打ち切った場合も接続をプールへ返す
+
+
+def read_xml_root_attrib(xml_source):
+    """
+    XMLのルート要素の属性だけを読み取る (要素ツリーは構築しない)。
+    """
+    parser = ET.XMLPullParser(events=('start',))
+    for chunk in _iter_xml_chunks(xml_source):
+        parser.feed(chunk)
+        for _, element in parser.read_events():
+            return dict(element.attrib)
+    parser.close()
+    return {}
+
+
+def _session_mac_matcher(mac_filter):
+    """
+    セッションのMACアドレス (calling_station_id) の絞り込み条件を作る。
+    MACアドレスとして解釈できる場合は表記を揃えて完全一致、それ以外は部分一致 (大文字小文字を区別しない)。
+    """
+    normalized = normalize_mac(mac_filter)
+    if normalized:
+        return lambda session: normalize_mac(session.get('calling_station_id')) == normalized
+    mac_filter = mac_filter.lower()
+    return lambda session: mac_filter in session.get('calling_station_id', '').lower()
+
+
+# =====================================================
+# MACアドレスによるActive Session検索 (MnT Session/MACAddress)
+# =====================================================
+
+MNT_SESSION_BY_MAC_PATH = "/admin/API/mnt/Session/MACAddress/{mac}"
+
+# MACアドレス -> セッション属性の辞書 (アクティブなセッションがない場合はFalse) の短期キャッシュ
+# オンライン・オフラインの確認用のため、有効期間は短くする
+_session_by_mac_cache = TTLCache(
+    maxsize=get_settings().session_lookup_cache_maxsize,
+    ttl=get_settings().session_lookup_cache_ttl,
+    name='session_by_mac',
+)
+
+
+@on_settings_reload
+def _configure_session_by_mac_cache(settings):
+    _session_by_mac_cache.configure(settings.session_lookup_cache_maxsize, settings.session_lookup_cache_ttl)
+
+
+def fetch_session_by_mac(client, mac_address):
+    """
+    MnT API (GET /admin/API/mnt/Session/MACAddress/{mac}) で1台分のセッションを取得し、
+    <sessionParameters> の子要素を {要素名: テキスト} の辞書にして返す。
+    アクティブなセッションがない場合 (404、または子要素のない応答) はNoneを返す。
+    mac_addressは正規化済み (AA:BB:CC:DD:EE:FF) であること。
+    """
+    response = client.mnt_request('GET', MNT_SESSION_BY_MAC_PATH.format(mac=mac_address))
+    if response.status_code == 404:
+        return None
+    response.raise_for_status()
+    if not response.content.strip():
+        return None
+    for session in iter_xml_records(response.content, 'sessionParameters'):
+        if session:
+            return session
+    return None
+
+
+def lookup_session_by_mac(client, mac_address, use_cache=True):
+    """
+    キャッシュを使ってMACアドレスのセッションを返す。(セッションまたはNone, キャッシュから返したか) のタプル。
+    """
+    if use_cache:
+        cached = _session_by_mac_cache.get(mac_address)
+        if cached is not None:
+            return cached or None, True
+    session = fetch_session_by_mac(client, mac_address)
+    _session_by_mac_cache.set(mac_address, session or False)
+    return session, False
+
+
+def lookup_sessions_by_mac(client, mac_addresses, use_cache=True, workers=None):
+    """
+    複数のMACアドレスのセッションを並行に検索し、(入力と同じ順番の結果のリスト, 途中で打ち切ったか) を返す。
+    各結果は {'mac_address': 入力値, 'mac': 正規化後, 'active': bool, 'session': 辞書またはNone, 'cached': bool}、
+    失敗した場合は 'error' を含む。同じMACアドレスが並行に含まれていてもISEへの問い合わせは1回にまとまる。
+    処理期限が近づいた場合は、それまでに検索できた分だけを返す。
+    """
+    def lookup(mac_address):
+        result = {'mac_address': mac_address, 'mac': normalize_mac(mac_address)}
+        if not result['mac']:
+            result['error'] = 'MACアドレスの形式が不正です'
+            return result
+        try:
+            session, cached = lookup_session_by_mac(client, result['mac'], use_cache)
+        except DeadlineExceeded:
+            raise # エラー行にせず、ここで検索を打ち切って部分的な結果を返す
+        except requests.exceptions.RequestException as e:
+            result['error'] = f"Session検索失敗 ({_status_code_of(e)})"
+            return result
+        except ET.ParseError as e:
+            result['error'] = f"Session XML Parse Error: {e}"
+            return result
+        result.update({'active': session is not None, 'session': session, 'cached': cached})
+        return result
+
+    results = []
+    try:
+        for result in iter_ordered_parallel(mac_addresses, lookup, _worker_count(workers)):
+            results.append(result)
+    except DeadlineExceeded:
+        logger.warning("処理期限によりSession検索を打ち切りました (%s/%s件)", len(results), len(mac_addresses))
+        return results, True
+    return results, False
+
+
+# =====================================================
+# Endpointインベントリ (スナップショット)
+# =====================================================
+
+class _InventoryRefreshRun:
+    """
+    実行中のインベントリ更新1回分。更新用のスレッドが取得したEndpointを records に追加し、
+    iter_refresh の呼び出し元はそれぞれのペースで records を読み進める
+    (遅い呼び出し元が更新や他の呼び出し元を待たせないようにする)。
+    """
+
+    def __init__(self):
+        self.records = []
+        self.done = False
+        self.error = None
+        self.condition = threading.Condition()
+
+    def add(self, record):
+        with self.condition:
+            self.records.append(record)
+            self.condition.notify_all()
+
+    def finish(self, error=None):
+        with self.condition:
+            self.done = True
+            self.error = error
+            self.condition.notify_all()
+
+
+class EndpointInventory:
+    """
+    ISEのEndpoint一覧 (MAC, Group ID, Group Name) をサーバー側に保持するスナップショット。
+    メモリ上ではEndpoint IDをキーとしたタプルの辞書とMACアドレスの索引で保持し、
+    SQLiteファイルに永続化して再起動後も前回の内容から応答できるようにする。
+    更新は差分で行い、一覧APIのID集合を比較して追加されたEndpointのみ詳細を取得する。
+    更新は専用のスレッドで行い、呼び出し元の処理期限切れや切断に関係なく最後まで続ける。
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._rows = {} # Endpoint ID -> (mac, group_id, group_name) ※一覧APIの順番を保持
+        self._by_mac = {} # MACアドレス (正規化済み) -> Endpoint ID
+        self.refreshed_at = None # 最終更新時刻 (time.time)
+        self.last_full_refresh_at = None
+        self.last_refresh_stats = {}
+        self._run = None # 実行中の更新 (_InventoryRefreshRun)
+        self._upserted = {} # 更新中に upsert されたEndpoint (Endpoint ID -> 行)
+        self._removed_macs = set() # 更新中に remove_mac されたMACアドレス
+        self._lock = threading.Lock() # _rows/_by_mac/_run などの参照・更新用
+        self._load()
+
+    # ---------- 永続化 ----------
+
+    def _connect(self):
+        connection = sqlite3.connect(self.db_path)
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS endpoints ("
+            "id TEXT PRIMARY KEY, position INTEGER, mac TEXT, group_id TEXT, group_name TEXT)"
+        )
+        connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        return connection
+
+    def _load(self):
+        """
+        SQLiteファイルから前回のスナップショットを読み込む。
+        """
+        if not self.db_path or not os.path.exists(self.db_path):
+            return
+        try:
+            connection = self._connect()
+            try:
+                rows = connection.execute(
+                    "SELECT id, mac, group_id, group_name FROM endpoints ORDER BY position"
+                ).fetchall()
+                meta = dict(connection.execute("SELECT key, value FROM meta").fetchall())
+            finally:
+                connection.close()
+        except sqlite3.Error as e:
+            logger.error("Endpointインベントリの読み込みに失敗しました (%s): %s", self.db_path, e)
+            return
+        with self._lock:
+            self._rows = {endpoint_id: (mac, group_id, group_name)
+                          for endpoint_id, mac, group_id, group_name in rows}
+            self._by_mac = {normalize_mac(row[0]): endpoint_id for endpoint_id, row in self._rows.items()}
+        if meta.get('refreshed_at'):
+            self.refreshed_at = float(meta['refreshed_at'])
+        if meta.get('last_full_refresh_at'):
+            self.last_full_refresh_at = float(meta['last_full_refresh_at'])
+        logger.info("Endpointインベントリを読み込みました: %s件 (%s)", len(self._rows), self.db_path)
+
+    def _save(self):
+        """
+        現在のスナップショットをSQLiteファイルに書き出す。
+        """
+        if not self.db_path:
+            return
+        with self._lock:
+            rows = [(endpoint_id, position, *row)
+                    for position, (endpoint_id, row) in enumerate(self._rows.items())]
+        try:
+            connection = self._connect()
+            try:
+                with connection:
+                    connection.execute("DELETE FROM endpoints")
+                    connection.executemany("INSERT INTO endpoints VALUES (?, ?, ?, ?, ?)", rows)
+                    connection.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)", [
+                        ('refreshed_at', str(self.refreshed_at)),
+                        ('last_full_refresh_at', str(self.last_full_refresh_at)),
+                    ])
+            finally:
+                connection.close()
+        except sqlite3.Error as e:
+            logger.error("Endpointインベントリの保存に失敗しました (%s): %s", self.db_path, e)
+
+    # ---------- 参照 ----------
+
+    @property
+    def loaded(self):
+        return self.refreshed_at is not None
+
+    @property
+    def refreshing(self):
+        return self._run is not None
+
+    def age(self):
+        """
+        最終更新からの経過秒数を返す。未取得の場合はNone。
+        """
+        if self.refreshed_at is None:
+            return None
+        return time.time() - self.refreshed_at
+
+    def records(self):
+        """
+        スナップショットの全Endpointを一覧APIの順番で返す。
+        """
+        with self._lock:
+            return [{'mac': mac, 'group_id': group_id, 'group_name': group_name}
+                    for mac, group_id, group_name in self._rows.values()]
+
+    def find_id_by_mac(self, mac_address):
+        with self._lock:
+            endpoint_id = self._by_mac.get(mac_address)
+        count_cache_lookup('inventory_mac', endpoint_id is not None)
+        return endpoint_id
+
+    def status(self):
+        """
+        スナップショットの状態 (件数、最終更新時刻、経過秒数、更新中かどうか) を返す。
+        """
+        age = self.age()
+        return {
+            'count': len(self._rows),
+            'refreshed_at': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.refreshed_at)) if self.refreshed_at else None,
+            'age_seconds': round(age, 1) if age is not None else None,
+            'refreshing': self.refreshing,
+        }
+
+    # ---------- 更新 ----------
+
+    def upsert(self, endpoint_id, mac_address, group_id, group_name):
+        """
+        Endpoint追加APIの成功時などに1件だけスナップショットへ反映する。
+        更新中の場合は、更新の完了時にも反映し直す (更新前の一覧で上書きしないように)。
+        """
+        row = (mac_address, group_id, group_name)
+        mac_address = normalize_mac(mac_address)
+        with self._lock:
+            self._rows[endpoint_id] = row
+            self._by_mac[mac_address] = endpoint_id
+            if self._run is not None:
+                self._upserted[endpoint_id] = row
+                self._removed_macs.discard(mac_address)
+
+    def remove_mac(self, mac_address):
+        """
+        Endpoint削除APIの成功時などに1件だけスナップショットから削除する。
+        更新中の場合は、更新の完了時にも削除し直す。
+        """
+        with self._lock:
+            endpoint_id = self._by_mac.pop(mac_address, None)
+            if endpoint_id is not None:
+                self._rows.pop(endpoint_id, None)
+            if self._run is not None:
+                self._removed_macs.add(mac_address)
+                self._upserted = {endpoint_id: row for endpoint_id, row in self._upserted.items()
+                                  if normalize_mac(row[0]) != mac_address}
+
+    def refresh(self, client, full=False, workers=None):
+        """
+        ISEの一覧APIからスナップショットを更新し、更新内容の件数を返す。
+        詳細は iter_refresh を参照。
+        """
+        for _ in self.iter_refresh(client, full, workers):
+            pass
+        return self.last_refresh_stats
+
+    def iter_refresh(self, client, full=False, workers=None):
+        """
+        スナップショットを更新しながら、更新後のEndpointを一覧APIの順に1件ずつ返すジェネレータ。
+        既知のEndpointは詳細を取得し直さず (Group名のみキャッシュから引き直して) すぐに返し、
+        新規のEndpointは詳細を並行に取得して返す。
+        full=True、または前回の全件更新から ISE_INVENTORY_FULL_REFRESH_INTERVAL 秒以上
+        経過している場合は全Endpointの詳細を取得し直す (Group変更の反映用)。
+        更新は専用のスレッドで行い、他の呼び出し元が更新中の場合はその更新に合流して最初から返す。
+        処理期限 (deadline_scope) が近づくとDeadlineExceededを送出するが、更新自体は裏で最後まで続ける。
+        途中で反復をやめた場合も同様。
+        """
+        run = self._start_refresh(client, full, workers)
+        position = 0
+        while True:
+            with run.condition:
+                while position >= len(run.records) and not run.done:
+                    run.condition.wait(deadline_wait_timeout())
+                records = run.records[position:]
+                done, error = run.done, run.error
+            position += len(records)
+            # ロックを持たずに返す (呼び出し元が遅くても更新用のスレッドは止まらない)
+            yield from records
+            if done:
+                break
+        if error is not None:
+            raise error
+
+    def _start_refresh(self, client, full, workers):
+        """
+        更新中でなければ更新用のスレッドを起動する。実行中 (または起動した) 更新を返す。
+        """
+        with self._lock:
+            if self._run is not None:
+                return self._run
+            run = self._run = _InventoryRefreshRun()
+            self._upserted, self._removed_macs = {}, set()
+        threading.Thread(target=self._run_refresh, args=(run, client, full, workers),
+                         name='inventory-refresh', daemon=True).start()
+        return run
+
+    @traced('inventory.refresh', lambda self, run, client, full, workers: {'ise.inventory.full': full})
+    def _run_refresh(self, run, client, full, workers):
+        error = None
+        try:
+            for record in self._iter_refresh(client, full, workers):
+                run.add(record)
+        except Exception as e:
+            error = e
+            logger.error("Endpointインベントリの更新に失敗しました: %s", e)
+        finally:
+            with self._lock:
+                self._run = None
+            run.finish(error)
+
+    def _iter_refresh(self, client, full, workers):
+        started_at = time.time()
+        full_interval = get_settings().inventory_full_refresh_interval
+        if self.last_full_refresh_at is None or started_at - self.last_full_refresh_at >= full_interval:
+            full = True
+
+        with self._lock:
+            known = dict(self._rows)
+
+        def needs_fetch(summary):
+            # 詳細の取得が必要なもの: 新規のEndpointと、前回取得に失敗していたEndpoint
+            return full or summary['id'] not in known or known[summary['id']][1] in ('エラー', '不明')
+
+        def build_row(args):
+            index, summary = args
+            if needs_fetch(summary):
+                result = fetch_endpoint_with_group(client, index, summary)
+                return summary['id'], (result['mac'], result['group_id'], result['group_name']), True
+            mac_address, group_id, group_name = known[summary['id']]
+            if group_id and group_id not in ('N/A', 'エラー', '不明'):
+                group_name = get_group_name_by_id(client, group_id)
+            return summary['id'], (mac_address, group_id, group_name), False
+
+        endpoints_summary = (summary for summary in
+                             iter_ers_resources(client, "/ers/config/endpoint", prefetch=True)
+                             if summary.get('id'))
+        new_rows = {}
+        fetched = 0
+        for endpoint_id, row, was_fetched in iter_ordered_parallel(
+                enumerate(endpoints_summary), build_row, _worker_count(workers),
+                needs_worker=lambda args: needs_fetch(args[1])):
+            new_rows[endpoint_id] = row
+            fetched += was_fetched
+            yield {'mac': row[0], 'group_id': row[1], 'group_name': row[2]}
+
+        with self._lock:
+            # 更新中に行われた追加・削除を反映し直す
+            new_rows.update(self._upserted)
+            if self._removed_macs:
+                new_rows = {endpoint_id: row for endpoint_id, row in new_rows.items()
+                            if normalize_mac(row[0]) not in self._removed_macs}
+            self._upserted, self._removed_macs = {}, set()
+            self._rows = new_rows
+            self._by_mac = {normalize_mac(row[0]): endpoint_id for endpoint_id, row in new_rows.items()}
+        self.refreshed_at = started_at
+        if full:
+            self.last_full_refresh_at = started_at
+        self._save()
+
+        self.last_refresh_stats = {
+            'total': len(new_rows),
+            'fetched': fetched,
+            'added': len(set(new_rows) - set(known)),
+            'removed': len(set(known) - set(new_rows)),
+            'full': full,
+        }
+        logger.info("Endpointインベントリを更新しました: %s (%.1f秒)", self.last_refresh_stats, time.time() - started_at)
+
+    def refresh_in_background(self, client):
+        """
+        更新中でなければ、別スレッドでスナップショットを更新する。
+        """
+        if self.refreshing:
+            return False
+        self._start_refresh(client, False, None)
+        return True
+
+
+_endpoint_inventory = None
+_endpoint_inventory_lock = threading.Lock()
+
+def get_endpoint_inventory():
+    """
+    プロセス共通のEndpointインベントリを返す。初回呼び出し時に生成してSQLiteファイルを読み込む
+    (import時にはファイルを作成・参照しない)。設定の再読み込みで保存先 (ISE_INVENTORY_DB) が
+    変わった場合は、新しい保存先から読み込み直す。
+    """
+    global _endpoint_inventory
+    db_path = get_settings().inventory_db
+    if _endpoint_inventory is None or _endpoint_inventory.db_path != db_path:
+        with _endpoint_inventory_lock:
+            if _endpoint_inventory is None or _endpoint_inventory.db_path != db_path:
+                _endpoint_inventory = EndpointInventory(db_path)
+    return _endpoint_inventory
+
+
+# =====================================================
+# Active Sessionのスナップショット
+# =====================================================
+
+def session_key(session):
+    """
+    Active Sessionの索引用のキー (正規化したMACアドレス)。MACアドレスがない場合はNone。
+    """
+    mac_address = session.get('calling_station_id')
+    return normalize_mac(mac_address) or (mac_address or None)
+
+
+def diff_sessions(old_index, new_index):
+    """
+    MACアドレスをキーとしたActive Sessionの索引を比較し、
+    [(種別 'added' / 'removed' / 'updated', MACアドレス, セッション), ...] を返す。
+    removedのセッションは最後に取得した内容。
+    """
+    changes = [('removed', key, session) for key, session in old_index.items() if key not in new_index]
+    for key, session in new_index.items():
+        previous = old_index.get(key)
+        if previous is None:
+            changes.append(('added', key, session))
+        elif previous != session:
+            changes.append(('updated', key, session))
+    return changes
+
+
+class SessionChangeLog:
+    """
+    Active Sessionの変化 (added / removed / updated) を連番 (seq) 付きで保持し、
+    変化を待っているクライアント (ロングポーリング・SSE) に通知する。
+    保持するのは直近 maxlen 件で、それより古い連番から要求された場合は取りこぼしとして扱う。
+    """
+
+    def __init__(self, maxlen=10000):
+        self._events = deque(maxlen=maxlen)
+        self.seq = 0 # 最後に発行した連番
+        self._condition = threading.Condition()
+
+    def publish(self, changes):
+        """
+        diff_sessions の結果を連番を付けて追加し、待機中のクライアントを起こす。
+        """
+        if not changes:
+            return
+        changed_at = time.strftime('%Y-%m-%d %H:%M:%S')
+        with self._condition:
+            for change_type, mac_address, session in changes:
+                self.seq += 1
+                self._events.append({'seq': self.seq, 'type': change_type, 'mac': mac_address,
+                                     'session': session, 'time': changed_at})
+            self._condition.notify_all()
+
+    def _since(self, seq):
+        # 保持している最古の変化より前、または発行済みより先 (再起動前の連番) からは続きを返せない
+        if seq > self.seq or seq < self.seq - len(self._events):
+            return [], True
+        start = len(self._events) - (self.seq - seq)
+        return list(itertools.islice(self._events, start, None)), False
+
+    def since(self, seq):
+        """
+        seqより後の変化を返す。(変化のリスト, 取りこぼしがあるか) のタプル。
+        """
+        with self._condition:
+            return self._since(seq)
+
+    def wait(self, seq, timeout):
+        """
+        seqより後の変化があるまで最大timeout秒待ち、since と同じ形式で返す。
+        """
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while self.seq == seq:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            return self._since(seq)
+
+
+class SessionSnapshot:
+    """
+    直近に取得したActive Session一覧 (MnT ActiveList) を保持するスナップショット。
+    /sessions はここから即座に応答し、ISE_SESSION_MAX_AGE 秒より古ければ
+    バックグラウンドで取得し直す (stale-while-revalidate)。
+    取得に失敗した場合は前回の内容を保持したまま last_error に記録する。
+    MACアドレスをキーとした索引も保持し、取得のたびに前回との差分を changes に追加する
+    (初回の取得は差分としない)。
+    絞り込み・ページングと差分の計算のために全セッションをメモリに保持する
+    (保持せずに受信しながら返す場合は /sessions?source=live を使う)。
+    """
+
+    def __init__(self, change_log_size=10000):
+        # (セッションのリスト, ActiveListのルート要素の属性, この内容に対応する変化の連番) ※まとめて差し替える
+        self._state = ([], {}, 0)
+        self._index = {} # MACアドレス -> セッション
+        self.changes = SessionChangeLog(change_log_size)
+        self.refreshed_at = None # 最終更新時刻 (time.time)
+        self.refreshing = False
+        self.last_error = None
+        self._completed_refreshes = 0
+        self._refresh_lock = threading.Lock() # 更新処理の多重実行防止用
+
+    @property
+    def loaded(self):
+        return self.refreshed_at is not None
+
+    def age(self):
+        """
+        最終更新からの経過秒数を返す。未取得の場合はNone。
+        """
+        if self.refreshed_at is None:
+            return None
+        return time.time() - self.refreshed_at
+
+    def state(self):
+        """
+        (セッションのリスト, ルート要素の属性, 変化の連番) を返す。返したリストは変更しないこと。
+        連番以降の変化は changes.since(連番) で取得できる。
+        """
+        return self._state
+
+    def status(self):
+        """
+        スナップショットの状態 (件数、最終更新時刻、経過秒数、更新中かどうか、直近の失敗) を返す。
+        """
+        age = self.age()
+        return {
+            'count': len(self._state[0]),
+            'refreshed_at': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.refreshed_at)) if self.refreshed_at else None,
+            'age_seconds': round(age, 1) if age is not None else None,
+            'refreshing': self.refreshing,
+            'last_error': self.last_error,
+            'seq': self._state[2],
+        }
+
+    @traced('sessions.refresh')
+    def refresh(self, client):
+        """
+        ISEからActive Session一覧を取得してスナップショットを置き換える。
+        他のスレッドが更新中の場合はその完了を待ち、取得し直さない。
+        """
+        completed_before = self._completed_refreshes
+        with self._refresh_lock:
+            if self._completed_refreshes != completed_before:
+                return # 待っている間に他のスレッドが更新済み
+            self.refreshing = True
+            started_at = time.time()
+            root_attrib = {}
+            sessions = []
+            index = {}
+            try:
+                # 受信しながら1件ずつスナップショットと索引に取り込む (ActiveList全体の文書や
+                # 解析結果の一時的なリストは保持しない)。完了するまで現在の内容は差し替えない
+                for session in fetch_active_sessions(client, root_attrib):
+                    sessions.append(session)
+                    key = session_key(session)
+                    if key is not None:
+                        index[key] = session
+            except Exception as e:
+                self.last_error = str(e)
+                raise
+            finally:
+                self.refreshing = False
+            changes = diff_sessions(self._index, index) if self.loaded else []
+            self.changes.publish(changes)
+            self._index = index
+            self._state = (sessions, root_attrib, self.changes.seq)
+            self.refreshed_at = started_at
+            self.last_error = None
+            self._completed_refreshes += 1
+        logger.debug("Active Sessionのスナップショットを更新しました: %s件, 変化 %s件 (%.1f秒)",
+                     len(sessions), len(changes), time.time() - started_at)
+
+    def refresh_if_stale(self, client):
+        """
+        未取得または ISE_SESSION_MAX_AGE 秒より古い場合に、バックグラウンドで取得し直す。
+        """
+        if not self.loaded or self.age() > get_settings().session_max_age:
+            return self.refresh_in_background(client)
+        return False
+
+    def refresh_in_background(self, client):
+        """
+        更新中でなければ、別スレッドでスナップショットを更新する。
+        """
+        if self.refreshing or self._refresh_lock.locked():
+            return False
+
+        def run():
+            try:
+                self.refresh(client)
+            except Exception as e:
+                logger.error("Active Sessionのバックグラウンド更新に失敗しました: %s", e)
+
+        threading.Thread(target=run, name='session-refresh', daemon=True).start()
+        return True
+
+
+session_snapshot = SessionSnapshot(change_log_size=max(1, _env_int('ISE_SESSION_CHANGE_LOG_SIZE', 10000)))
+
+
+# =====================================================
+# バックグラウンド更新 (定期実行)
+# =====================================================
+
+BACKGROUND_REFRESH_SECONDS = HistogramMetric(
+    'ise_client_background_refresh_duration_seconds',
+    'バックグラウンド更新1回 (Endpointインベントリ、Group名、Active Session) の所要時間',
+    ('task', 'status'), buckets=ROUTE_DURATION_BUCKETS,
+)
+
+
+class RefreshTask:
+    """
+    BackgroundRefresherが定期的に実行する処理1つ。実行間隔は Settings の属性から
+    実行のたびに読み直すため、設定の再読み込みで変更・有効化できる。
+    """
+
+    def __init__(self, name, interval_setting, func):
+        self.name = name
+        self.interval_setting = interval_setting # 実行間隔 (秒) を表すSettingsの属性名
+        self.func = func # func(client)
+        self.last_run_at = None # 最後に実行を終えた時刻 (time.time)
+        self.last_duration = None
+        self.last_error = None
+        self.next_run_at = None
+
+    def interval(self):
+        return getattr(get_settings(), self.interval_setting)
+
+    def status(self):
+        def timestamp(value):
+            return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(value)) if value else None
+
+        return {
+            'name': self.name,
+            'interval': self.interval(),
+            'last_run_at': timestamp(self.last_run_at),
+            'last_duration_seconds': round(self.last_duration, 2) if self.last_duration is not None else None,
+            'last_error': self.last_error,
+            'next_run_at': timestamp(self.next_run_at),
+        }
+
+
+class BackgroundRefresher:
+    """
+    ダッシュボード用のデータ (Endpointインベントリ、Group名、Active Session) を
+    ユーザーのリクエストとは別に定期的に取得し直す。ルートは取得済みの結果から即座に応答する。
+    タスクごとに1つのスレッドで実行し (長い全件更新が他のタスクを遅らせないように)、
+    実行間隔には ±ISE_REFRESH_JITTER の割合のゆらぎを加えて、複数のワーカープロセスの更新が
+    ISEへ同時に集中しないようにする。間隔が0のタスクは実行しない。
+    """
+    IDLE_POLL_INTERVAL = 5 # 無効なタスクが設定の変更を確認する間隔 (秒)
+
+    def __init__(self):
+        self.tasks = []
+        self._started = False
+        self._lock = threading.Lock()
+
+    def add_task(self, name, interval_setting, func):
+        task = RefreshTask(name, interval_setting, func)
+        self.tasks.append(task)
+        return task
+
+    def start(self):
+        """
+        タスクごとのスレッドを起動する。2回目以降の呼び出しは何もしない。
+        """
+        if self._started:
+            return
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        for task in self.tasks:
+            threading.Thread(target=self._run_loop, args=(task,), name=f"refresh-{task.name}", daemon=True).start()
+
+    def _run_loop(self, task):
+        first = True
+        while True:
+            interval = task.interval()
+            if interval <= 0:
+                task.next_run_at = None
+                first = True
+                time.sleep(self.IDLE_POLL_INTERVAL)
+                continue
+            jitter = get_settings().refresh_jitter
+            if first:
+                # 初回はすぐに実行する (複数プロセスが同時に起動した場合に備えてゆらぎの分だけずらす)
+                delay = random.uniform(0, interval * jitter)
+                first = False
+            else:
+                delay = interval * random.uniform(1 - jitter, 1 + jitter)
+            task.next_run_at = time.time() + delay
+            time.sleep(delay)
+            self.run_task(task)
+
+    def run_task(self, task):
+        """
+        タスクを1回実行する。失敗した場合はログに記録し、次回の実行で再試行する。
+        """
+        client = get_ise_client()
+        if client is None:
+            return # 接続設定の不足はget_ise_clientがログに記録済み
+        started = time.perf_counter()
+        status = 'ok'
+        try:
+            task.func(client)
+            task.last_error = None
+        except Exception as e:
+            status = 'error'
+            task.last_error = str(e)
+            logger.error("バックグラウンド更新 (%s) に失敗しました: %s", task.name, e)
+        finally:
+            task.last_duration = time.perf_counter() - started
+            task.last_run_at = time.time()
+            BACKGROUND_REFRESH_SECONDS.observe(task.last_duration, task=task.name, status=status)
+
+    def status(self):
+        return {'started': self._started, 'tasks': [task.status() for task in self.tasks]}
+
+
+background_refresher = BackgroundRefresher()
+background_refresher.add_task('inventory', 'inventory_refresh_interval', lambda client: get_endpoint_inventory().refresh(client))
+background_refresher.add_task('groups', 'group_refresh_interval', refresh_group_name_cache)
+background_refresher.add_task('sessions', 'session_refresh_interval', lambda client: session_snapshot.refresh(client))
+
+
+# =====================================================
+# 非同期ISEクライアント (asyncio)
+# =====================================================
+
+class AsyncISEClient:
+    """
+    ERS API / MnT API 呼び出しをasyncioで行うクライアント (httpx.AsyncClientを使用)。
+    ISEClientと同じ接続情報・ヘッダーでリクエストを送信し、
+    同時に処理中のリクエスト数をセマフォで max_concurrency 件までに制限する。
+    httpx.AsyncClientは生成したイベントループに紐づくため、Flaskの非同期ビューからは
+    専用のイベントループ上のプロセス共通のクライアントを使う (run_with_async_ise_client 参照)。
+    """
+
+    def __init__(self, ise_ip, username, password, http_proxy=None,
+                 max_connections=50, max_concurrency=50, rate_limiter=None, retry_policy=None,
+                 timeout=(5, 30), pan_pool=None, mnt_pool=None,
+                 scheme='https', ers_port=9060, mnt_port=443, response_cache=None):
+        if httpx is None:
+            raise RuntimeError('非同期クライアントにはhttpxが必要です (pip install httpx)')
+        self.ise_ip = ise_ip
+        self.ers_url_template = ise_url_template(scheme, ers_port)
+        self.mnt_url_template = ise_url_template(scheme, mnt_port)
+        self.ers_headers = MappingProxyType({
+            'Accept': 'application/json',
+            'authorization': get_basic_auth_header(username, password),
+        })
+        self.mnt_headers = MappingProxyType({
+            'Accept': 'application/xml',
+            'cache-control': "no-cache",
+        })
+        # 同期クライアントと同じNodePoolを渡すと、ノードの稼働状況 (サーキットブレーカー) も共有する
+        self.pan_pool = pan_pool or NodePool('PAN', [ise_ip])
+        self.mnt_pool = mnt_pool or NodePool('MnT', [ise_ip])
+        self.username = username
+        self.password = password
+        self.max_concurrency = max_concurrency
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._group_warm_lock = asyncio.Lock() # Group名キャッシュの一覧取得を1回にまとめる
+        self._single_flight = AsyncSingleFlight('ise_request_async') # 同じURLへの並行なGETをまとめる
+        self.response_cache = response_cache # 同期クライアントのキャッシュを渡すと共有する
+        # 同期クライアントと同じリミッターを渡すと、プロセス全体でISEへの流量をまとめて制御できる
+        self.rate_limiter = rate_limiter or AdaptiveRateLimiter()
+        self.retry_policy = retry_policy or RetryPolicy()
+        self._client = httpx.AsyncClient(
+            verify=False, # 自己署名証明書を想定 (本番環境では証明書検証を有効にしてください)
+            proxy=http_proxy or None,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            timeout=httpx.Timeout(timeout[1], connect=timeout[0]),
+        )
+        self.timeout = timeout
+
+    @classmethod
+    def from_client(cls, client):
+        """
+        同期クライアント (ISEClient) と同じ接続情報で非同期クライアントを作成する。
+        同時実行数は ISE_ASYNC_MAX_CONCURRENCY、接続数の上限は ISE_ASYNC_MAX_CONNECTIONS。
+        """
+        settings = client.settings or get_settings()
+        http_proxy = client.proxies['https'] if client.proxies else None
+        return cls(
+            client.ise_ip, client.username, client.password, http_proxy,
+            max_connections=settings.async_max_connections,
+            max_concurrency=settings.async_max_concurrency,
+            rate_limiter=client.rate_limiter,
+            retry_policy=client.retry_policy,
+            timeout=client.timeout,
+            pan_pool=client.pan_pool,
+            mnt_pool=client.mnt_pool,
+            scheme=client.scheme,
+            ers_port=client.ers_port,
+            mnt_port=client.mnt_port,
+            response_cache=client.response_cache,
+        )
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    async def node_request(self, pool, url_template, method, path, primary_only=False, **kwargs):
+        """
+        poolのノードへリクエストを送信し、レスポンス本文まで読み込んだhttpx.Responseを返す。
+        ノードの選択・フェイルオーバーはISEClient.node_request、
+        レート制御と429/503の再試行はISEClient.requestと同じ。
+        """
+        async with self._semaphore:
+            response = await self._send_to_node(pool, url_template, method, path, primary_only, **kwargs)
+            await response.aread()
+            return response
+
+    async def _send_to_node(self, pool, url_template, method, path, primary_only=False, auth=None, **kwargs):
+        """
+        poolのノードへ順に送信し、本文を読み込まずにレスポンスを返す。
+        接続エラー・タイムアウト・502/504の場合はノードの失敗として記録して次のノードへ送る。
+        """
+        last_error = None
+        nodes = pool.candidates(primary_only)
+        for position, node in enumerate(nodes):
+            if not pool.acquire(node):
+                continue # half-openで他のリクエストが試行中
+            request = self._client.build_request(method, url_template.format(node=node, path=path), **kwargs)
+            api = ise_api_family(request.url.path)
+            try:
+                with tracer.start_span(f"ISE {request.method} {api}", SPAN_KIND_CLIENT, {
+                    'http.request.method': request.method,
+                    'server.address': node,
+                    'url.path': request.url.path,
+                    'ise.api': api,
+                    'ise.retry_count': 0,
+                }) as span:
+                    response = await self._send_with_retry(request, span, auth=auth)
+                    span.set_attribute('http.response.status_code', response.status_code)
+            except DeadlineExceeded:
+                pool.release(node) # 処理期限切れはノードの障害として扱わない
+                raise
+            except httpx.TransportError as e: # 接続エラー・タイムアウト
+                pool.record_failure(node, e)
+                last_error = e
+                continue
+            except BaseException: # キャンセルを含む
+                pool.release(node)
+                raise
+            if response.status_code in NODE_FAILURE_STATUS:
+                pool.record_failure(node, f"HTTP {response.status_code}")
+                if position < len(nodes) - 1:
+                    await response.aclose()
+                    continue
+                return response
+            pool.record_success(node)
+            return response
+        raise last_error or NodeUnavailable(f"{pool.role} ノード ({', '.join(nodes)}) は全て一時的に遮断中です")
+
+    async def _send_with_retry(self, request, span, **kwargs):
+        """
+        レートリミッターの送信枠を取得して送信し、429/503の場合は待ってから再送する。
+        本文は読み込まずにレスポンスを返す (stream=True で送信)。再試行回数はspanに記録する。
+        """
+        api = ise_api_family(request.url.path)
+        attempt = 0
+        while True:
+            call_timeout = _call_timeout(self.timeout)
+            connect_timeout, read_timeout = call_timeout
+            request.extensions['timeout'] = httpx.Timeout(read_timeout, connect=connect_timeout).as_dict()
+            await self.rate_limiter.acquire_async()
+            throttled, retry_after = False, None
+            try:
+                with observe_ise_call(api, request.method) as call:
+                    try:
+                        response = await self._client.send(request, stream=True, **kwargs)
+                    except httpx.TimeoutException as e:
+                        if _timeout_from_deadline(self.timeout, call_timeout):
+                            raise DeadlineExceeded(f"処理期限までにISEから応答がありませんでした ({request.method} {request.url.path})") from e
+                        raise
+                    call['status'] = response.status_code
+                throttled = response.status_code in RETRYABLE_STATUS
+                if throttled:
+                    retry_after = _parse_retry_after(response.headers.get('Retry-After'))
+            finally:
+                self.rate_limiter.release(throttled, retry_after)
+            if not self.retry_policy.should_retry(response.status_code, attempt):
+                return response
+            delay = self.retry_policy.delay(attempt, retry_after)
+            if not _deadline_allows(delay):
+                return response # 待つと処理期限に間に合わないため再試行しない
+            ISE_API_RETRIES.inc(api=api, status=response.status_code)
+            logger.warning("ISEが %s を返しました (%s %s)。%.1f秒後に再試行します (%s/%s)。", response.status_code, request.method, request.url.path, delay, attempt + 1, self.retry_policy.max_retries)
+            await response.aclose()
+            await asyncio.sleep(delay)
+            attempt += 1
+            span.set_attribute('ise.retry_count', attempt)
+
+    async def ers_request(self, method, path, headers=None, primary=None, **kwargs):
+        """
+        ERS API (既定はポート9060) へリクエストを送信する。ISEClient.ers_requestに対応。
+        """
+        cache = self.response_cache
+        method = method.upper()
+        if cache is not None and method == 'GET' and not headers and cache.cacheable(path, kwargs):
+            return await self._cached_ers_get(cache, path, primary)
+        response = await self._send_ers(method, path, headers, primary, **kwargs)
+        if cache is not None and method in ERS_MUTATING_METHODS:
+            cache.invalidate_for_mutation(path)
+        return response
+
+    async def _send_ers(self, method, path, headers, primary, **kwargs):
+        request_headers = {**self.ers_headers, **headers} if headers else self.ers_headers
+        if primary is None:
+            primary = method not in ('GET', 'HEAD')
+        send = functools.partial(self.node_request, self.pan_pool, self.ers_url_template, method, path,
+                                 primary_only=primary, headers=request_headers, **kwargs)
+        key = single_flight_key(method, path, headers=headers, **kwargs)
+        if key is None:
+            return await send()
+        return await self._single_flight.do(('ers', primary) + key, send)
+
+    async def _cached_ers_get(self, cache, path, primary):
+        """
+        ISEClient._cached_ers_getに対応。
+        """
+        entry = cache.get(path)
+        if entry is not None and entry.fresh():
+            record_http_cache_result('hit')
+            return entry.to_httpx_response(path)
+        response = await self._send_ers('GET', path, entry.conditional_headers() if entry else None, primary)
+        if response.status_code == 304 and entry is not None:
+            record_http_cache_result('revalidated')
+            return cache.revalidated(path, entry, response.headers).to_httpx_response(path)
+        record_http_cache_result('miss')
+        if response.status_code == 200:
+            cache.store(path, response.headers, response.content)
+        elif response.status_code == 404:
+            cache.invalidate(path)
+        return response
+
+    def _mnt_headers(self, headers):
+        return {**self.mnt_headers, **headers} if headers else self.mnt_headers
+
+    async def mnt_request(self, method, path, headers=None, **kwargs):
+        """
+        MnT API (XML API) へリクエストを送信する。ISEClient.mnt_requestに対応。
+        """
+        send = functools.partial(self.node_request, self.mnt_pool, self.mnt_url_template, method, path,
+                                 headers=self._mnt_headers(headers), auth=(self.username, self.password), **kwargs)
+        key = single_flight_key(method, path, headers=headers, **kwargs)
+        if key is None:
+            return await send()
+        return await self._single_flight.do(('mnt',) + key, send)
+
+    @contextlib.asynccontextmanager
+    async def mnt_stream(self, method, path, headers=None, **kwargs):
+        """
+        MnT APIのレスポンスを本文を読み込まずに返す (async with で使用)。
+        本文は response.aiter_bytes() で受信しながら処理する。
+        """
+        async with self._semaphore:
+            response = await self._send_to_node(
+                self.mnt_pool, self.mnt_url_template, method, path,
+                headers=self._mnt_headers(headers), auth=(self.username, self.password), **kwargs,
+            )
+            try:
+                yield response
+            finally:
+                await response.aclose()
+
+    async def aclose(self):
+        await self._client.aclose()
+
+
+_async_ise_loop = None
+_async_ise_loop_lock = threading.Lock()
+_async_ise_client = None
+_async_ise_client_source = None # _async_ise_client の生成元の同期クライアント
+
+
+def _get_async_ise_loop():
+    """
+    AsyncISEClient専用のイベントループを返す。初回呼び出し時にデーモンスレッドで起動する。
+    """
+    global _async_ise_loop
+    if _async_ise_loop is None:
+        with _async_ise_loop_lock:
+            if _async_ise_loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name='ise-async-loop', daemon=True).start()
+                _async_ise_loop = loop
+    return _async_ise_loop
+
+
+def get_async_ise_client():
+    """
+    プロセス共通のAsyncISEClientを返す (専用のイベントループ上でのみ呼び出す)。
+    get_ise_client() のクライアントが作り直された場合 (設定の再読み込み) は同じ接続情報で作り直す。
+    必須の設定が不足している場合はNoneを返す。
+    """
+    global _async_ise_client, _async_ise_client_source
+    client = get_ise_client()
+    if client is None:
+        return None
+    if _async_ise_client is None or _async_ise_client_source is not client:
+        # 処理中のリクエストが使用している可能性があるため、古いクライアントは閉じずに破棄する
+        _async_ise_client = AsyncISEClient.from_client(client)
+        _async_ise_client_source = client
+    return _async_ise_client
+
+
+async def run_with_async_ise_client(func):
+    """
+    func(aclient) (コルーチン関数) をプロセス共通のAsyncISEClientで実行し、結果を返す。
+    Flaskの非同期ビューはリクエストごとに別のイベントループで動くため、専用のイベントループで実行して
+    接続プールと同時実行数の上限 (ISE_ASYNC_MAX_CONCURRENCY) をリクエスト間で共有する。
+    処理期限などのcontextvarsは呼び出し元から引き継ぐ。
+    """
+    async def run():
+        aclient = get_async_ise_client()
+        if aclient is None:
+            raise RuntimeError('ISEへの接続情報が設定されていません')
+        return await func(aclient)
+
+    future = asyncio.run_coroutine_threadsafe(run(), _get_async_ise_loop())
+    return await asyncio.wrap_future(future)
+
+
+async def async_iter_ers_resources(aclient, path, params=None, page_size=ERS_MAX_PAGE_SIZE):
+    """
+    iter_ers_resources の非同期版。ERS一覧APIの全ページをたどり、
+    SearchResult.resources の要素を1件ずつ返す非同期ジェネレータ。
+    現在ページの要素を返している間に次ページを先読みする。
+    """
+    @traced('ers.page', _ers_page_span_attributes)
+    async def fetch_page(page_path, page_params):
+        response = await aclient.ers_request('GET', page_path, params=page_params)
+        response.raise_for_status()
+        return response.json().get('SearchResult', {})
+
+    query = dict(params or {})
+    query.setdefault('size', page_size)
+    query.setdefault('page', 1)
+
+    search_result = await fetch_page(path, query)
+    logger.debug("ERS一覧取得 (async) %s: total=%s", path, search_result.get('total', 'N/A'))
+    while True:
+        resources = search_result.get('resources', [])
+        next_request = _next_page_request(search_result) if resources else None
+        next_task = asyncio.ensure_future(fetch_page(*next_request)) if next_request else None
+        try:
+            for resource in resources:
+                yield resource
+        except BaseException:
+            if next_task is not None:
+                next_task.cancel() # 途中で反復を打ち切った場合、先読み中のページは破棄する
+            raise
+        if next_task is None:
+            break
+        search_result = await next_task
+
+
+async def async_ensure_group_name_cache(aclient):
+    """
+    ensure_group_name_cache の非同期版。Group名キャッシュ (同期版と共有) が
+    未取得またはTTL切れの場合にEndpoint Group一覧を取得して温める。
+    並行に呼び出されても一覧取得は1回だけ行う。
+    """
+    global _group_cache_next_warm_at, _group_cache_warmed_at
+    if time.monotonic() < _group_cache_next_warm_at:
+        return
+    async with aclient._group_warm_lock:
+        if time.monotonic() < _group_cache_next_warm_at:
+            return # 他のタスクが取得済み
+        try:
+            started_at = time.time()
+            count = 0
+            async for group in async_iter_ers_resources(aclient, "/ers/config/endpointgroup"):
+                if group.get('id') and group.get('name'):
+                    _group_name_cache.set(group['id'], group['name'])
+                    count += 1
+            _group_cache_next_warm_at = time.monotonic() + _group_name_cache.ttl
+            _group_cache_warmed_at = started_at
+            logger.debug("Group名キャッシュを更新しました (async): %s件", count)
+        except Exception as e:
+            # 失敗時は個別取得にフォールバックし、一覧取得は少し待ってから再試行する
+            logger.error("Endpoint Group一覧の取得に失敗しました: %s", e)
+            _group_cache_next_warm_at = time.monotonic() + min(30, _group_name_cache.ttl)
+
+
+@traced('endpoint_group.lookup', lambda aclient, group_id: {'ise.group.id': group_id})
+async def async_get_group_name_by_id(aclient, group_id):
     """
-    Endpoint GroupのIDを使って、そのGroupの名前を取得するヘルパー関数。
+    get_group_name_by_id の非同期版。Group名キャッシュにない場合のみ個別にGroup詳細を取得する。
+    一覧でのキャッシュの温めは呼び出し元 (async_get_endpoints_with_group) で事前に行う。
     """
     if not group_id:
         return 'N/A (IDなし)'
 
-    # ヘッダーとプロキシ設定を取得
-    headers = {"Accept": "application/json"} # Endpoint Group詳細はJSONを期待
-    auth_header_value = get_basic_auth_header(username, password) # 'Basic <encoded>' 形式の文字列を取得
-    if auth_header_value:
-         headers['authorization'] = auth_header_value # ヘッダー辞書に追加
-    else:
-         # 認証ヘッダーが生成できなかった場合はエラーを返す
-         return "名前取得失敗 (認証情報不足)"
+    group_name = _group_name_cache.get(group_id)
+    if group_name is not None:
+        return group_name
+
+    try:
+        response = await aclient.ers_request('GET', f"/ers/config/endpointgroup/{group_id}")
+        response.raise_for_status()
+        group_name = response.json().get('EndPointGroup', {}).get('name')
+        if group_name is None:
+            return '名前不明 (キーなし)'
+        _group_name_cache.set(group_id, group_name)
+        return group_name
+    except DeadlineExceeded:
+        raise # 処理期限切れはエラー行にせず、呼び出し元で部分的な結果として扱う
+    except httpx.HTTPError as e:
+        logger.error("Group詳細情報 (ID: %s) の取得に失敗しました: %s", group_id, e)
+        return f"取得失敗 ({_status_code_of(e)})"
+    except json.JSONDecodeError:
+        logger.error("Group詳細情報 (ID: %s) のレスポンスがJSON形式ではありません。", group_id)
+        return "不明 (不正なレスポンス)"
+    except Exception as e:
+        logger.error("Group詳細情報 (ID: %s) 取得中に予期しないエラーが発生しました: %s", group_id, e)
+        return f"予期しないエラー ({e})"
 
-    proxies = get_proxies() # ヘルパー関数を使う
 
+@traced('endpoint.enrich', lambda aclient, index, endpoint_summary: _endpoint_span_attributes(index, endpoint_summary))
+async def async_fetch_endpoint_with_group(aclient, index, endpoint_summary):
+    """
+    fetch_endpoint_with_group の非同期版。戻り値の形式も同じ。
+    """
+    endpoint_id = endpoint_summary.get('id')
+    endpoint_mac_summary = endpoint_summary.get('name', 'MAC不明 (簡易リスト)')
 
-    group_url = f"https://{ise_ip}:9060/ers/config/endpointgroup/{group_id}"
-    logger.debug(f"  Group詳細取得 (ID: {group_id}): {group_url}") # デバッグ用コメント
+    if not endpoint_id:
+        logger.warning("Endpoint簡易情報 %s: IDが見つかりません。スキップします。", index+1)
+        return None
 
+    debug_sampled('endpoint_detail', "  Endpoint詳細取得 (%s, ID: %s)", endpoint_mac_summary, endpoint_id)
     try:
-        response = requests.get(group_url, headers=headers, verify=False, proxies=proxies)
-        response.raise_for_status()
-        group_data = response.json()
+        detail_response = await aclient.ers_request('GET', f"/ers/config/endpoint/{endpoint_id}")
+        detail_response.raise_for_status()
+        endpoint_detail = detail_response.json().get('ERSEndPoint', {})
+        mac_address = endpoint_detail.get('mac', endpoint_mac_summary)
+        group_id = endpoint_detail.get('groupId', 'N/A')
 
-        # Endpoint Group詳細レスポンスの構造に合わせて名前を抽出
-        # 前回の調査結果に基づき、'EndPointGroup' キーの下に 'name' があると想定
-        group_detail = group_data.get('EndPointGroup', {})
-        group_name = group_detail.get('name', '名前不明 (キーなし)')
+        group_name = 'N/A'
+        if group_id and group_id != 'N/A':
+            group_name = await async_get_group_name_by_id(aclient, group_id)
 
-        return group_name
+        return {
+            'mac': mac_address,
+            'group_id': group_id,
+            'group_name': group_name
+        }
 
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Group詳細情報 (ID: {group_id}) の取得に失敗しました: {e}")
-        return f"取得失敗 ({e.response.status_code if hasattr(e, 'response') and e.response is not None else 'N/A'})"
+    except DeadlineExceeded:
+        raise # 処理期限切れはエラー行にせず、呼び出し元で部分的な結果として扱う
+    except httpx.HTTPError as e:
+        logger.error("Endpoint詳細情報 (%s, ID: %s) の取得に失敗しました: %s", endpoint_mac_summary, endpoint_id, e)
+        return {
+            'mac': endpoint_mac_summary,
+            'group_id': 'エラー',
+            'group_name': f'取得失敗 ({_status_code_of(e)})'
+        }
     except json.JSONDecodeError:
-        logger.error(f"Group詳細情報 (ID: {group_id}) のレスポンスがJSON形式ではありません。")
-        return "不明 (不正なレスポンス)"
+        logger.error("Endpoint詳細情報 (%s, ID: %s) のレスポンスがJSON形式ではありません。", endpoint_mac_summary, endpoint_id)
+        return {
+            'mac': endpoint_mac_summary,
+            'group_id': '不明',
+            'group_name': '不明 (不正なレスポンス)'
+        }
     except Exception as e:
-        logger.error(f"Group詳細情報 (ID: {group_id}) 取得中に予期しないエラーが発生しました: {e}")
-        return f"予期しないエラー ({e})"
+        logger.error("Endpoint詳細情報 (%s, ID: %s) 取得中に予期しないエラーが発生しました: %s", endpoint_mac_summary, endpoint_id, e)
+        return {
+            'mac': endpoint_mac_summary,
+            'group_id': 'エラー',
+            'group_name': f'予期しないエラー ({e})'
+        }
+
+
+async def async_get_endpoints_with_group(aclient):
+    """
+    Endpoint一覧を全件取得し、各Endpointの詳細とGroup名を並行に取得して
+    (入力と同じ順番のリスト, 処理期限により途中で打ち切ったかどうか) を返す。
+    一覧の各ページをキューに入れ、aclient.max_concurrency 個のワーカーが順に詳細を取得する
+    (Endpoint数に関係なくタスク数とメモリ使用量を一定に保つ)。
+    IDがなくスキップされたEndpointは含まれない。
+    処理期限 (deadline_scope) が近づいた場合は、それまでに揃った先頭からの結果を返し、
+    未完了の取得は取り消す。
+    """
+    await async_ensure_group_name_cache(aclient)
+    worker_count = max(1, aclient.max_concurrency)
+    queue = asyncio.Queue(maxsize=worker_count * 2)
+    fetched = {} # 一覧での位置 -> 詳細 (IDがない場合はNone)
+
+    async def produce():
+        count = 0
+        async for endpoint_summary in async_iter_ers_resources(aclient, "/ers/config/endpoint"):
+            # 一覧の次ページを待つ間もワーカーは詳細取得を進める
+            await queue.put((count, endpoint_summary))
+            count += 1
+        for _ in range(worker_count):
+            await queue.put(None) # ワーカーの終了
+        return count
+
+    async def work():
+        while True:
+            entry = await queue.get()
+            if entry is None:
+                return
+            index, endpoint_summary = entry
+            fetched[index] = await async_fetch_endpoint_with_group(aclient, index, endpoint_summary)
+
+    producer = asyncio.ensure_future(produce())
+    tasks = [producer] + [asyncio.ensure_future(work()) for _ in range(worker_count)]
+    incomplete = False
+    try:
+        # ワーカーが処理期限切れで止まった場合に一覧の取得が待ち続けないよう、最初の例外で打ち切る
+        _, pending = await asyncio.wait(tasks, timeout=deadline_wait_timeout(),
+                                        return_when=asyncio.FIRST_EXCEPTION)
+        incomplete = bool(pending)
+    except DeadlineExceeded:
+        incomplete = True
+    finally:
+        # 途中で失敗・打ち切りになった場合は未完了の取得を取り消す
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True) # 取り消しの完了を待つ
+
+    for task in tasks:
+        if task.cancelled() or task.exception() is None:
+            continue
+        if not isinstance(task.exception(), DeadlineExceeded):
+            raise task.exception() # 一覧の取得失敗など
+        incomplete = True
+    total = producer.result() if producer.done() and not producer.cancelled() and producer.exception() is None else None
+
+    results = []
+    index = 0
+    while index in fetched: # 順番を保つため、最初の未完了以降は返さない
+        if fetched[index] is not None:
+            results.append(fetched[index])
+        index += 1
+    if total is None or index < total:
+        incomplete = True
+    return results, incomplete
+
+
+async def async_fetch_active_sessions(aclient, root_attrib=None):
+    """
+    fetch_active_sessions の非同期版。Active Session一覧を受信しながら解析し、
+    セッションのリストを返す。HTTPエラーはhttpx.HTTPStatusError、XMLの不正はET.ParseError。
+    """
+    parser = XmlRecordParser('activeSession', root_attrib)
+    sessions = []
+    async with aclient.mnt_stream('GET', MNT_ACTIVE_LIST_PATH) as response:
+        response.raise_for_status()
+        async for chunk in response.aiter_bytes(MNT_READ_CHUNK_SIZE):
+            sessions.extend(parser.feed(chunk))
+    sessions.extend(parser.close())
+    return sessions
 
 
 # =====================================================
@@ -138,7 +4286,7 @@ def get_group_name_by_id(ise_ip, username, password, http_proxy, group_id):
 
 @app.route('/', methods=['GET']) # POSTメソッドは.envから読み込むため不要
 def index():
-    logger.debug(f"Request URL: {request.url}")
+    logger.debug("Request URL: %s", request.url)
 
     # .envファイルから読み込んだIPとユーザー名をテンプレートに渡します
     # check_env APIから取得する方がJavaScriptで扱いやすいので、
@@ -151,56 +4299,189 @@ def check_env():
     """
     .envファイルが存在するかどうかを確認し、ISE_IPとISE_USERNAMEの値をJSONレスポンスで返す
     """
-    logger.debug(f"Request URL: {request.url}")
+    logger.debug("Request URL: %s", request.url)
     env_exists = os.path.exists('.env')
-    # 環境変数が設定されているかを確認し、値またはデフォルト値を返す
-    ise_ip_value = os.getenv('ISE_IP', '設定されていません')
-    ise_username_value = os.getenv('ISE_USERNAME', '設定されていません')
-    logger.debug(f".env exists: {env_exists}, ISE_IP: {ise_ip_value}, ISE_USERNAME:{ise_username_value}")
-    return jsonify({'exists': env_exists, 'ise_ip': ise_ip_value, 'ise_username':ise_username_value})
+    # 設定されているかを確認し、値またはデフォルト値を返す
+    settings = get_settings()
+    ise_ip_value = settings.ise_ip or '設定されていません'
+    ise_username_value = settings.username or '設定されていません'
+    logger.debug(".env exists: %s, ISE_IP: %s, ISE_USERNAME:%s", env_exists, ise_ip_value, ise_username_value)
+    return jsonify({'exists': env_exists, 'ise_ip': ise_ip_value, 'ise_username':ise_username_value,
+                    'pan_nodes': list(settings.pan_nodes), 'mnt_nodes': list(settings.mnt_nodes)})
+
+
+@app.route('/reload_settings', methods=['POST'])
+def reload_settings_route():
+    """
+    .envを読み込み直して設定を反映するAPI。ISEの認証情報を変更した場合などに呼び出す。
+    変更された項目の名前を返す (値は返さない)。
+    """
+    changed = reload_settings()
+    return jsonify({'message': '設定を再読み込みしました。', 'changed': changed})
+
+
+@app.route('/ise_nodes')
+def ise_nodes():
+    """
+    PAN / MnTノードごとの稼働状況 (サーキットブレーカーの状態、成功・失敗回数) と
+    レートリミッターの状態を返すAPI。
+    """
+    client = get_ise_client()
+    if client is None:
+        return jsonify({'error': '.envファイルにISE_IP、ISE_USERNAMEまたはISE_PASSWORDが設定されていません'}), 500
+    return jsonify({
+        'pan': client.pan_pool.status(),
+        'mnt': client.mnt_pool.status(),
+        'rate_limiter': client.rate_limiter.status(),
+    })
+
+
+@app.before_request
+def _start_background_refresh():
+    # 定期更新はアプリの起動後、最初のリクエストで開始する (設定の間隔が0のタスクは実行されない)
+    background_refresher.start()
+
+
+@app.route('/data_status')
+def data_status():
+    """
+    ルートが応答に使う取得済みデータ (Endpointインベントリ、Group名キャッシュ、Active Session) の
+    経過時間と、バックグラウンド更新のタスクごとの状態 (最終実行、所要時間、失敗、次回予定) を返すAPI。
+    """
+    return jsonify({
+        'inventory': get_endpoint_inventory().status(),
+        'group_names': group_name_cache_status(),
+        'sessions': session_snapshot.status(),
+        'background_refresh': background_refresher.status(),
+    })
+
+
+@app.before_request
+def _start_route_metrics():
+    g.metrics_route = request.url_rule.rule if request.url_rule else 'unmatched' # パスそのものは使わない (ラベル数の抑制)
+    g.metrics_started = time.perf_counter()
+    ROUTE_IN_FLIGHT.inc(route=g.metrics_route)
+    if tracer.enabled:
+        # ルートごとのスパン。ISEへのAPIコールなどはこのスパンの子スパンになる。
+        # 呼び出し元がtraceparentヘッダーを送った場合はそのトレースに含める
+        g.trace_span = tracer.start_detached_span(f"{request.method} {g.metrics_route}", SPAN_KIND_SERVER, {
+            'http.request.method': request.method,
+            'http.route': g.metrics_route,
+            'url.path': request.path,
+        }, context=extract_trace_context(request.headers))
+        otel_context.attach(otel_trace.set_span_in_context(g.trace_span, otel_context.Context()))
+
+
+def _pop_route_observation():
+    """
+    before_requestで g に保存した計測情報を取り出し、処理時間の記録とルートスパンの終了を行う関数を返す。
+    既に取り出し済みの場合はNoneを返す。
+    """
+    route = g.pop('metrics_route', None)
+    if route is None:
+        return None
+    started = g.pop('metrics_started')
+    span = g.pop('trace_span', None)
+    method = request.method
+    status = g.get('metrics_status', 500)
+
+    def finish(exc=None):
+        ROUTE_IN_FLIGHT.dec(route=route)
+        ROUTE_REQUEST_SECONDS.observe(time.perf_counter() - started, route=route, method=method, status=status)
+        if span is not None:
+            if exc is not None:
+                span.record_exception(exc)
+                mark_span_error(span, f"{type(exc).__name__}: {exc}")
+            span.end()
+            if tracer.enabled:
+                otel_context.attach(otel_context.Context())
+
+    return finish
+
+
+@app.after_request
+def _record_route_status(response):
+    g.metrics_status = response.status_code
+    span = g.get('trace_span')
+    if span is not None and span.is_recording():
+        span.set_attribute('http.response.status_code', response.status_code)
+        if response.status_code >= 500:
+            mark_span_error(span)
+        response.headers['X-Trace-Id'] = otel_trace.format_trace_id(span.get_span_context().trace_id)
+    if response.is_streamed:
+        # ストリーミングの場合はリクエストの終了後も送信が続くため、送信完了 (close) 時に記録する
+        finish = _pop_route_observation()
+        if finish is not None:
+            response.call_on_close(finish)
+    return response
+
+
+@app.teardown_request
+def _finish_route_metrics(exc):
+    """
+    ルートの処理時間を記録し、ルートスパンを終了する (ストリーミングの場合は_record_route_statusで登録済み)。
+    """
+    finish = _pop_route_observation()
+    if finish is not None:
+        finish(exc)
 
 
+@app.route('/metrics')
+def metrics_route():
+    """
+    Prometheus形式のメトリクスを返すAPI。
+    ISE APIコールの種別 (api) ・ステータスコードごとの所要時間、送信中の件数、再試行回数、
+    ルートごとの処理時間、キャッシュのヒット・ミス回数、レートリミッターとノードの状態を含む。
+    """
+    if prometheus_client is None:
+        return jsonify({'error': 'メトリクスにはprometheus_clientが必要です (pip install prometheus_client)'}), 501
+    client = _ise_client # メトリクス取得のためだけにクライアントを生成しない
+    if client is not None:
+        limiter_status = client.rate_limiter.status()
+        RATE_LIMITER_CONCURRENCY_LIMIT.set(limiter_status['concurrency_limit'])
+        RATE_LIMITER_IN_FLIGHT.set(limiter_status['in_flight'])
+        NODE_UP.clear() # 設定の再読み込みで外れたノードを残さない
+        for pool in (client.pan_pool, client.mnt_pool):
+            for node in pool.status():
+                NODE_UP.set(0 if node['state'] == 'open' else 1, role=pool.role, node=node['node'])
+    return Response(prometheus_client.generate_latest(metrics_registry), content_type=prometheus_client.CONTENT_TYPE_LATEST)
+
+
+@app.route('/invalidate_group_cache', methods=['POST'])
+def invalidate_group_cache():
+    """
+    Endpoint Group名キャッシュを破棄するAPI。
+    ISE側でGroup名を変更した場合などに呼び出す。
+    """
+    invalidate_group_name_cache()
+    return jsonify({'message': 'Endpoint Group名キャッシュを破棄しました。'})
+
 
 @app.route('/get_sessions')
+@with_route_deadline
 def get_sessions():
     """
     ISEからActive Session一覧を取得し、セッション数とRaw XMLを返すAPI。
     XML APIを使用。
     """
-    # ヘルパー関数で接続情報を取得
-    ise_ip, username, password, http_proxy = get_ise_connection_details()
-    if not ise_ip:
+    # 共有クライアントを取得 (接続情報は生成時に.envから読み込み済み)
+    client = get_ise_client()
+    if client is None:
         return jsonify({'error': '.envファイルにISE_IP、ISE_USERNAMEまたはISE_PASSWORDが設定されていません'}), 500
-    if not username or not password:
-         return jsonify({'error': 'ISE_USERNAMEまたはISE_PASSWORDが設定されていません'}), 500
 
-
-    url = f"https://{ise_ip}/admin/API/mnt/Session/ActiveList"
-    logger.debug(f"Request URL: {request.url}, Target URL: {url}")
+    path = MNT_ACTIVE_LIST_PATH
+    logger.debug("Request URL: %s, Target Path: %s", request.url, path)
 
     # XML APIは認証情報をHTTP Headerではなく、requestsのauthパラメータで渡します。
-    # ERS APIとは認証方法が異なることに注意。
-    headers = {
-        'Accept': 'application/xml',  # Acceptヘッダーをapplication/xmlに設定
-        'cache-control': "no-cache",
-    }
-    proxies = get_proxies() # ヘルパー関数を使う
-
+    # ERS APIとは認証方法が異なることに注意。(client.mnt_request内で設定)
     try:
-        response = requests.get(
-            url,
-            auth=(username, password), # XML APIはauthタプルを使用
-            headers=headers,
-            verify=False,
-            proxies=proxies,
-        )
+        response = client.mnt_request('GET', path)
         response.raise_for_status()
         xml_data = response.text  # レスポンスはXML
 
-        # --- XMLをパースしてセッション数を取得 ---
-        root = ET.fromstring(xml_data)
-        no_of_active_session = root.attrib.get('noOfActiveSession', "N/A")
-        logger.debug(f"Number of active sessions: {no_of_active_session}")
+        # --- XMLのルート要素だけを読んでセッション数を取得 (要素ツリーは構築しない) ---
+        no_of_active_session = read_xml_root_attrib(response.content).get('noOfActiveSession', "N/A")
+        logger.debug("Number of active sessions: %s", no_of_active_session)
         # ----------------------------------------
 
         # セッション情報からMACアドレスなども抽出できますが、
@@ -211,140 +4492,467 @@ def get_sessions():
         # セッション数とRaw XMLデータを返す
         return jsonify({'noOfActiveSession': no_of_active_session, 'raw_xml': xml_data})
     except requests.exceptions.RequestException as e:
-        logger.error(f"Request failed: {e}")
+        logger.error("Request failed: %s", e)
         error_message = str(e)
         if hasattr(e, 'response') and e.response is not None:
             error_message += f" Status Code: {e.response.status_code}" # XMLレスポンスボディは長いため除外
         return jsonify({'error': f'Active Session取得失敗: {error_message}'}), 500
     except ET.ParseError as e:
-        logger.error(f"XML Parse Error: {e}")
+        logger.error("XML Parse Error: %s", e)
         return jsonify({'error': f'Active Session XML Parse Error: {e}'}), 500
     except Exception as e:
-        logger.error(f"An unexpected error occurred during get_sessions: {e}")
+        logger.error("An unexpected error occurred during get_sessions: %s", e)
         return jsonify({'error': f'Active Session取得中に予期しないエラー: {e}'}), 500
 
 
-
-@app.route('/get_endpoints')  # エンドポイント一覧取得API (Group名付き)
-def get_endpoints():
+@app.route('/sessions')
+@with_route_deadline
+def sessions():
     """
-    ISEからEndpoint一覧を取得し、各Endpointの詳細情報および所属Groupの名前を取得して返すAPI。
-    ERS APIを使用。
+    ISEからActive Session一覧を取得し、セッションごとの情報を構造化して返すAPI。
+    XML APIを使用。
+    通常はActive Sessionのスナップショットから即座に返し、経過時間などを 'snapshot' に含める
+    (ISE_SESSION_MAX_AGE 秒より古ければ返した後にバックグラウンドで取得し直す)。
+      mac    : calling_station_id での絞り込み (MACアドレス形式なら完全一致、それ以外は部分一致)
+      offset, limit : ページング
+      refresh=1 : ISEから取得し直してから返す
+      source=live : スナップショットを使わずにISEから受信しながら返す
+      raw=1  : Raw XMLもあわせて返す (既定では返さない、ISEから取得する)
     """
-    # ヘルパー関数で接続情報を取得
-    ise_ip, username, password, http_proxy = get_ise_connection_details()
-    if not ise_ip:
+    client = get_ise_client()
+    if client is None:
         return jsonify({'error': '.envファイルにISE_IP、ISE_USERNAMEまたはISE_PASSWORDが設定されていません'}), 500
-    if not username or not password:
-         return jsonify({'error': 'ISE_USERNAMEまたはISE_PASSWORDが設定されていません'}), 500
 
+    mac_filter = (request.args.get('mac') or '').strip()
+    offset = max(0, request.args.get('offset', 0, type=int))
+    limit = request.args.get('limit', type=int)
+    include_raw = bool(request.args.get('raw'))
 
-    # ヘッダーとプロキシ設定を取得
-    headers = {"Accept": "application/json"} # Endpoint一覧はJSONを期待
-    auth_header_value = get_basic_auth_header(username, password)
-    if auth_header_value:
-         headers['authorization'] = auth_header_value
-    else:
-         # 認証ヘッダーが生成できなかった場合はエラーを返す
-         return jsonify({'error': '認証情報が不足しているためAPIリクエストヘッダーを生成できません'}), 500
+    try:
+        root_attrib = {}
+        if include_raw:
+            # Raw XMLを返す場合は本文全体が必要なため、まとめて受信してから解析する
+            response = client.mnt_request('GET', MNT_ACTIVE_LIST_PATH)
+            response.raise_for_status()
+            session_iter = iter_active_sessions(response.content, root_attrib)
+        elif request.args.get('source') == 'live':
+            # 受信しながら解析し、該当ページ分のセッションだけを保持する
+            session_iter = fetch_active_sessions(client, root_attrib)
+        else:
+            if request.args.get('refresh') or not session_snapshot.loaded:
+                session_snapshot.refresh(client) # 初回と明示的な更新要求の場合のみISEの応答を待つ
+            else:
+                session_snapshot.refresh_if_stale(client)
+            session_iter, root_attrib, snapshot_seq = session_snapshot.state()
+
+        matches = _session_mac_matcher(mac_filter) if mac_filter else None
+        total = 0
+        page = []
+        for session in session_iter:
+            if matches is not None and not matches(session):
+                continue
+            # 該当ページに含まれるものだけを保持する
+            if total >= offset and (limit is None or len(page) < limit):
+                page.append(session)
+            total += 1
+
+        result = {
+            'noOfActiveSession': root_attrib.get('noOfActiveSession', "N/A"),
+            'total': total, # 絞り込み後の件数
+            'sessions': page,
+        }
+        if include_raw:
+            result['raw_xml'] = response.text
+        elif request.args.get('source') != 'live':
+            # seq は返した一覧に対応する連番 (/sessions/changes?since=seq で以降の変化を受け取れる)
+            result['snapshot'] = {**session_snapshot.status(), 'seq': snapshot_seq}
+        return jsonify(result)
+    except requests.exceptions.RequestException as e:
+        logger.error("Request failed: %s", e)
+        return jsonify({'error': f'Active Session取得失敗: {e} Status Code: {_status_code_of(e)}'}), 500
+    except ET.ParseError as e:
+        logger.error("XML Parse Error: %s", e)
+        return jsonify({'error': f'Active Session XML Parse Error: {e}'}), 500
+    except Exception as e:
+        logger.error("An unexpected error occurred during sessions: %s", e)
+        return jsonify({'error': f'Active Session取得中に予期しないエラー: {e}'}), 500
 
-    proxies = get_proxies() # ヘルパー関数を使う
 
+# /sessions/changes の待機時間 (秒)
+SESSION_CHANGES_DEFAULT_TIMEOUT = 25
+SESSION_CHANGES_MAX_TIMEOUT = 60
+SESSION_CHANGES_POLL_INTERVAL = 5 # 待機中にスナップショットの鮮度を確認する最長の間隔
+SSE_KEEPALIVE_INTERVAL = 15 # 切断を検出するためのコメント行の送信間隔
 
-    # Step 1: Endpointの簡易リストを取得 (IDとMACを含む)
-    list_url = f"https://{ise_ip}:9060/ers/config/endpoint"
-    logger.debug(f"Endpoint簡易リスト取得: {list_url}")
+
+def _wait_session_changes(client, since, timeout):
+    """
+    sinceより後のActive Sessionの変化を最大timeout秒待つ。
+    待っている間はスナップショットが古くなるたびにバックグラウンドで取得し直すため、
+    定期更新 (ISE_SESSION_REFRESH_INTERVAL) を設定していなくても変化を検出できる。
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        session_snapshot.refresh_if_stale(client)
+        remaining = max(0, deadline - time.monotonic())
+        # 次にスナップショットが古くなる時刻まで待つ (取得中などは短い間隔で確認し直す)
+        stale_in = get_settings().session_max_age - (session_snapshot.age() or 0)
+        wait = min(remaining, SESSION_CHANGES_POLL_INTERVAL, max(0.5, stale_in))
+        changes, reset = session_snapshot.changes.wait(since, wait)
+        if changes or reset or remaining <= wait:
+            return changes, reset
+
+
+def _stream_session_changes(client, since):
+    """
+    Active Sessionの変化をServer-Sent Eventsで送り続けるレスポンスを作成する。
+    変化ごとに id: 連番、event: added / removed / updated、data: 変化のJSON を送る。
+    取りこぼしがあった場合は event: reset を送り (クライアントは /sessions で一覧を取得し直す)、
+    接続直後には現在の連番を event: ready で送る。
+    """
+    def event(name, data, event_id=None):
+        lines = [f"id: {event_id}"] if event_id is not None else []
+        lines += [f"event: {name}", f"data: {json.dumps(data, ensure_ascii=False)}"]
+        return '\n'.join(lines) + '\n\n'
+
+    def generate():
+        seq = since
+        if seq is None:
+            seq = session_snapshot.changes.seq
+            yield event('ready', {'seq': seq, 'snapshot': session_snapshot.status()}, seq)
+        while True:
+            changes, reset = _wait_session_changes(client, seq, SSE_KEEPALIVE_INTERVAL)
+            if reset:
+                seq = session_snapshot.changes.seq
+                yield event('reset', {'seq': seq}, seq)
+            elif not changes:
+                yield ': keepalive\n\n'
+            for change in changes:
+                seq = change['seq']
+                yield event(change['type'], change, seq)
+
+    # 送信中はリクエストの情報を使わないため、stream_with_contextは使わない
+    return Response(
+        generate(),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
+
+
+@app.route('/sessions/changes')
+def session_changes():
+    """
+    Active Sessionの変化 (added / removed / updated、MACアドレス単位) を返すAPI。
+    /sessions のスナップショットを取得し直すたびに前回との差分を連番付きで記録しており、
+    一覧全体を取得し直さずに変化だけを受け取れる。
+      since   : この連番より後の変化を返す (/sessions の snapshot.seq、または前回の応答の seq)
+      timeout : 変化がない場合に待つ秒数 (既定25、上限60、ロングポーリング)
+      Accept: text/event-stream または stream=1 : Server-Sent Eventsで送り続ける
+                                                 (再接続時は Last-Event-ID から再開する)
+    since を省略した場合は待たずに現在の連番を返す。
+    reset が true の場合は変化を取りこぼしているため、/sessions で一覧を取得し直すこと。
+    """
+    client = get_ise_client()
+    if client is None:
+        return jsonify({'error': '.envファイルにISE_IP、ISE_USERNAMEまたはISE_PASSWORDが設定されていません'}), 500
+
+    # EventSourceの再接続時はURLのsinceより後に受信済みの連番 (Last-Event-ID) を優先する
+    since = request.headers.get('Last-Event-ID', type=int)
+    if since is None:
+        since = request.args.get('since', type=int)
+    if request.args.get('stream') or request.accept_mimetypes.best == 'text/event-stream':
+        return _stream_session_changes(client, since)
+
+    if since is None:
+        session_snapshot.refresh_if_stale(client)
+        return jsonify({'seq': session_snapshot.changes.seq, 'changes': [], 'snapshot': session_snapshot.status()})
+    timeout = request.args.get('timeout', SESSION_CHANGES_DEFAULT_TIMEOUT, type=float)
+    changes, reset = _wait_session_changes(client, since, min(max(0, timeout), SESSION_CHANGES_MAX_TIMEOUT))
+    result = {
+        'seq': changes[-1]['seq'] if changes else session_snapshot.changes.seq if reset else since,
+        'changes': changes,
+        'snapshot': session_snapshot.status(),
+    }
+    if reset:
+        result['reset'] = True
+    return jsonify(result)
+
+
+@app.route('/session/<mac_address>')
+@with_route_deadline
+def session_by_mac(mac_address):
+    """
+    1台分のActive Sessionを返すAPI。ActiveList全体ではなく、MnT API
+    (Session/MACAddress/{mac}) で指定したMACアドレスのセッションだけを取得する。
+    結果は ISE_SESSION_LOOKUP_CACHE_TTL 秒キャッシュする (?refresh=1 でキャッシュを使わない)。
+    アクティブなセッションがない場合は active: false を返す。
+    """
+    mac = normalize_mac(mac_address)
+    if mac is None:
+        return jsonify({'error': f'MACアドレスの形式が不正です: {mac_address}'}), 400
+    client = get_ise_client()
+    if client is None:
+        return jsonify({'error': '.envファイルにISE_IP、ISE_USERNAMEまたはISE_PASSWORDが設定されていません'}), 500
 
     try:
-        response = requests.get(list_url, headers=headers, verify=False, proxies=proxies)
-        response.raise_for_status()
-        list_data = response.json()
+        session, cached = lookup_session_by_mac(client, mac, use_cache=not request.args.get('refresh'))
     except requests.exceptions.RequestException as e:
-        logger.error(f"Endpoint簡易リストの取得に失敗しました: {e}")
+        logger.error("Request failed: %s", e)
+        return jsonify({'error': f'Session取得失敗: {e} Status Code: {_status_code_of(e)}'}), 500
+    except ET.ParseError as e:
+        logger.error("XML Parse Error: %s", e)
+        return jsonify({'error': f'Session XML Parse Error: {e}'}), 500
+    return jsonify({'mac': mac, 'active': session is not None, 'session': session, 'cached': cached})
+
+
+@app.route('/sessions/lookup', methods=['POST'])
+@with_route_deadline
+def sessions_lookup():
+    """
+    複数のMACアドレスのActive Sessionを並行に検索するAPI (/session/<mac> の一括版)。
+    JSON ({"mac_addresses": [...]} またはMACアドレスの配列) またはCSVファイルのアップロード (file) で指定する。
+    ?refresh=1 でキャッシュを使わない。?workers= で並行数を指定できる。
+    """
+    try:
+        rows = _read_bulk_request_items()
+    except BulkRequestError as e:
+        return jsonify({'error': str(e)}), 400
+    if not rows:
+        return jsonify({'error': '検索するMACアドレスの一覧が必要です'}), 400
+    max_items = get_settings().session_lookup_max_items
+    if len(rows) > max_items:
+        return jsonify({'error': f'一度に検索できるMACアドレスは{max_items}件までです'}), 400
+    client = get_ise_client()
+    if client is None:
+        return jsonify({'error': '.envファイルにISE_IP、ISE_USERNAMEまたはISE_PASSWORDが設定されていません'}), 500
+
+    results, incomplete = lookup_sessions_by_mac(client, [row['mac_address'] for row in rows],
+                                                 use_cache=not request.args.get('refresh'),
+                                                 workers=request.args.get('workers', type=int))
+    response = {
+        'results': results,
+        'total': len(results),
+        'active': sum(1 for result in results if result.get('active')),
+        'failed': sum(1 for result in results if 'error' in result),
+    }
+    if incomplete:
+        response['incomplete'] = True # 処理期限までに検索できた分のみ
+    return jsonify(response)
+
+
+# /get_endpoints のsortで指定できる項目
+_ENDPOINT_SORT_KEYS = ('mac', 'group_id', 'group_name')
+
+
+def query_endpoint_records(records, args):
+    """
+    Endpoint一覧にクエリパラメータの絞り込み・並べ替え・ページングを適用する。
+      q      : MAC, Group ID, Group Nameの部分一致 (大文字小文字を区別しない)
+      group  : Group IDまたはGroup Nameの完全一致 (大文字小文字を区別しない)
+      sort   : mac / group_id / group_name (先頭に'-'を付けると降順)
+      offset, limit : ページング
+    (該当件数, 該当ページのリスト) を返す。
+    """
+    q = (args.get('q') or '').strip().lower()
+    if q:
+        records = [record for record in records
+                   if q in record['mac'].lower()
+                   or q in str(record['group_id']).lower()
+                   or q in str(record['group_name']).lower()]
+
+    group = (args.get('group') or '').strip().lower()
+    if group:
+        records = [record for record in records
+                   if str(record['group_id']).lower() == group or str(record['group_name']).lower() == group]
+
+    sort = args.get('sort') or ''
+    sort_key = sort.lstrip('-')
+    if sort_key in _ENDPOINT_SORT_KEYS:
+        records = sorted(records, key=lambda record: str(record[sort_key]).lower(),
+                         reverse=sort.startswith('-'))
+
+    total = len(records)
+    offset = max(0, args.get('offset', 0, type=int))
+    limit = args.get('limit', type=int)
+    if limit is not None and limit >= 0:
+        records = records[offset:offset + limit]
+    elif offset:
+        records = records[offset:]
+    return total, records
+
+
+def _endpoint_list_error_response(e):
+    """
+    Endpoint簡易リスト取得時の例外をエラーレスポンスに変換する。
+    """
+    if isinstance(e, requests.exceptions.RequestException):
+        logger.error("Endpoint簡易リストの取得に失敗しました: %s", e)
         error_message = str(e)
         if hasattr(e, 'response') and e.response is not None:
             error_message += f" Status Code: {e.response.status_code}, Body: {e.response.text}"
         return jsonify({'error': f"Endpoint簡易リスト取得失敗: {error_message}"}), 500
-    except json.JSONDecodeError:
+    if isinstance(e, json.JSONDecodeError):
         logger.error("Endpoint簡易リストのレスポンスがJSON形式ではありません。")
         return jsonify({'error': "Endpoint簡易リストのレスポンスが不正です。"}), 500
-    except Exception as e:
-        logger.error(f"Endpoint簡易リスト取得中に予期しないエラーが発生しました: {e}")
-        return jsonify({'error': f"Endpoint簡易リスト取得中に予期しないエラー: {str(e)}"}), 500
+    logger.error("Endpoint簡易リスト取得中に予期しないエラーが発生しました: %s", e)
+    return jsonify({'error': f"Endpoint簡易リスト取得中に予期しないエラー: {str(e)}"}), 500
+
+
+def crawl_endpoints_with_group(client, workers=None):
+    """
+    ISEからEndpoint一覧を全件取得し、各Endpointの詳細情報および所属Groupの名前を取得して
+    ([{'mac', 'group_id', 'group_name'}, ...], 途中で打ち切ったかどうか) を返す。
+    一覧の取得に失敗した場合は例外を送出する。
+    """
+    # Step 1: Endpointの簡易リストを取得 (IDとMACを含む)
+    list_path = "/ers/config/endpoint"
+    logger.debug("Endpoint簡易リスト取得: %s", list_path)
 
+    # 全ページをたどって取得 (1ページ100件、次ページは先読み)
+    with ROUTE_PHASE_SECONDS.time(route='/get_endpoints', phase='list'):
+        endpoints_summary = list(iter_ers_resources(client, list_path, prefetch=True))
 
-    endpoints_summary = list_data.get('SearchResult', {}).get('resources', [])
     if not endpoints_summary:
         logger.info("取得できるEndpoint情報がありませんでした。")
-        return jsonify({'endpoints': []}) # 空のリストを返す
+        return [], False
 
-    logger.debug(f"取得したEndpoint簡易情報数: {len(endpoints_summary)}")
+    logger.debug("取得したEndpoint簡易情報数: %s", len(endpoints_summary))
 
-    # Step 2 & 3: 各Endpointの詳細情報とGroup名を順番に取得
+    # Step 2 & 3: 各Endpointの詳細情報とGroup名を取得 (workers=1の場合は順番に)
+    # IDがなくスキップされたEndpointは含まれない
     endpoint_results = []
-    for i, endpoint_summary in enumerate(endpoints_summary):
-        endpoint_id = endpoint_summary.get('id')
-        # 簡易リストのnameはMACアドレスを期待
-        endpoint_mac_summary = endpoint_summary.get('name', 'MAC不明 (簡易リスト)')
+    try:
+        with ROUTE_PHASE_SECONDS.time(route='/get_endpoints', phase='details'):
+            for endpoint_result in iter_endpoints_with_group(client, endpoints_summary, workers):
+                endpoint_results.append(endpoint_result)
+    except DeadlineExceeded:
+        # 処理期限が近いため、取得できた分だけを返す (残りの取得は取り消される)
+        logger.warning("処理期限によりEndpoint詳細の取得を打ち切りました: %s/%s件", len(endpoint_results), len(endpoints_summary))
+        return endpoint_results, True
+    return endpoint_results, False
 
-        if not endpoint_id:
-            logger.warning(f"Endpoint簡易情報 {i+1}: IDが見つかりません。スキップします。")
-            continue
 
-        # Endpoint詳細取得 (2番目のAPIコール)
-        # time.sleep(0.05) # 必要に応じて短い待機
-        detail_url = f"https://{ise_ip}:9060/ers/config/endpoint/{endpoint_id}"
-        try:
-            detail_response = requests.get(detail_url, headers=headers, verify=False, proxies=proxies)
-            detail_response.raise_for_status()
-            detail_data = detail_response.json()
+# 同時に要求されたEndpoint一覧の全件取得 (/get_endpoints?source=live) を1回にまとめる
+_endpoint_crawl_flight = SingleFlight('endpoint_crawl')
 
-            endpoint_detail = detail_data.get('ERSEndPoint', {})
-            # 詳細情報にあればそちらのMACを使用、なければ簡易リストから
-            mac_address = endpoint_detail.get('mac', endpoint_mac_summary)
-            # 詳細情報からgroupIdを取得
-            group_id = endpoint_detail.get('groupId', 'N/A')
 
-            group_name = 'N/A'
-            if group_id and group_id != 'N/A':
-                # Group名取得 (3番目のAPIコール)
-                # time.sleep(0.05) # 必要に応じて短い待機
-                group_name = get_group_name_by_id(ise_ip, username, password, http_proxy, group_id)
+def _get_endpoints_live(client, workers):
+    """
+    ISEから取得したEndpoint一覧 (詳細情報と所属Groupの名前付き) を返す。(/get_endpoints?source=live)
+    他のリクエストが全件取得中の場合はその結果を共有し、絞り込み等だけをリクエストごとに行う。
+    共有するのは最後まで取得できた結果のみで、取得した側の処理期限で途中までになった結果は使わずに取得し直す。
+    """
+    try:
+        endpoint_results, incomplete = _endpoint_crawl_flight.do(
+            'endpoints', lambda: crawl_endpoints_with_group(client, workers),
+            shareable=lambda result: not result[1])
+    except DeadlineExceeded as e:
+        logger.error("Endpoint簡易リストの取得が処理期限までに完了しませんでした: %s", e)
+        return jsonify({'endpoints': [], 'total': 0, 'incomplete': True})
+    except Exception as e:
+        return _endpoint_list_error_response(e)
 
+    total, endpoint_results = query_endpoint_records(endpoint_results, request.args)
+    result = {'endpoints': endpoint_results, 'total': total}
+    if incomplete:
+        result['incomplete'] = True
+    with ROUTE_PHASE_SECONDS.time(route='/get_endpoints', phase='serialize'):
+        return jsonify(result)
 
-            endpoint_results.append({
-                'mac': mac_address,
-                'group_id': group_id,
-                'group_name': group_name
-            })
 
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Endpoint詳細情報 ({endpoint_mac_summary}, ID: {endpoint_id}) の取得に失敗しました: {e}")
-            endpoint_results.append({
-                'mac': endpoint_mac_summary,
-                'group_id': 'エラー',
-                'group_name': f'取得失敗 ({e.response.status_code if hasattr(e, 'response') and e.response is not None else 'N/A'})'
-            })
-        except json.JSONDecodeError:
-             logger.error(f"Endpoint詳細情報 ({endpoint_mac_summary}, ID: {endpoint_id}) のレスポンスがJSON形式ではありません。")
-             endpoint_results.append({
-                 'mac': endpoint_mac_summary,
-                 'group_id': '不明',
-                 'group_name': '不明 (不正なレスポンス)'
-             })
+def _stream_endpoints(client, workers, live):
+    """
+    Endpoint一覧をNDJSON (1行1JSON) で逐次返すレスポンスを作成する。
+    各Endpointは詳細とGroup名が揃った時点で {"endpoint": {...}} として送信し、
+    最後に {"done": true, "count": 件数} を、失敗した場合は {"error": "..."} を送信する。
+    live=Falseの場合はEndpointインベントリを差分更新しながら返す。
+    """
+    def generate():
+        count = 0
+        try:
+            if live:
+                endpoints_summary = iter_ers_resources(client, "/ers/config/endpoint", prefetch=True)
+                records = iter_endpoints_with_group(client, endpoints_summary, workers)
+            else:
+                records = get_endpoint_inventory().iter_refresh(client, full=bool(request.args.get('full')), workers=workers)
+            for record in records:
+                count += 1
+                yield json.dumps({'endpoint': record}, ensure_ascii=False) + '\n'
+            done = {'done': True, 'count': count}
+            if not live:
+                done['snapshot'] = get_endpoint_inventory().status()
+            yield json.dumps(done, ensure_ascii=False) + '\n'
         except Exception as e:
-            logger.error(f"Endpoint詳細情報 ({endpoint_mac_summary}, ID: {endpoint_id}) 取得中に予期しないエラーが発生しました: {e}")
-            endpoint_results.append({
-                'mac': endpoint_mac_summary,
-                'group_id': 'エラー',
-                'group_name': f'予期しないエラー ({e})'
-            })
+            logger.error("Endpoint一覧のストリーミング中にエラーが発生しました: %s", e)
+            yield json.dumps({'error': f"Endpoint一覧取得失敗: {e}", 'count': count}, ensure_ascii=False) + '\n'
 
+    return Response(
+        stream_with_context(generate()),
+        mimetype='application/x-ndjson',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}, # プロキシでのバッファリングを抑止
+    )
+
+
+@app.route('/get_endpoints')  # エンドポイント一覧取得API (Group名付き)
+@with_route_deadline
+def get_endpoints():
+    """
+    Endpoint一覧 (MAC, Group ID, Group Name) を返すAPI。ERS APIを使用。
+    通常はサーバー側のEndpointインベントリ (スナップショット) から即座に返し、
+    スナップショットの経過時間と更新中かどうかを 'snapshot' に含める。
+    ?refresh=1 の場合はISEから差分更新してから返し (?full=1 で全件更新)、
+    ?source=live の場合はスナップショットを使わずにISEから全件取得する。
+    q, group, sort, offset, limit で絞り込み・並べ替え・ページングができる (query_endpoint_records参照)。
+    ?stream=1 の場合は取得できたEndpointから順にNDJSONで返す (絞り込み等は行わない)。
+    """
+    # 共有クライアントを取得 (接続情報は生成時に.envから読み込み済み)
+    client = get_ise_client()
+    if client is None:
+        return jsonify({'error': '.envファイルにISE_IP、ISE_USERNAMEまたはISE_PASSWORDが設定されていません'}), 500
 
-    return jsonify({'endpoints': endpoint_results})
+    workers = request.args.get('workers', type=int)
+    if request.args.get('stream'):
+        return _stream_endpoints(client, workers, live=request.args.get('source') == 'live')
+    if request.args.get('source') == 'live':
+        return _get_endpoints_live(client, workers)
+
+    inventory = get_endpoint_inventory()
+    partial_records = None
+    try:
+        if request.args.get('refresh') or not inventory.loaded:
+            # 初回 (スナップショットなし) と明示的な更新要求の場合のみISEの応答を待つ
+            count_cache_lookup('endpoint_snapshot', False)
+            partial_records = []
+            with ROUTE_PHASE_SECONDS.time(route='/get_endpoints', phase='refresh'):
+                for record in inventory.iter_refresh(client, full=bool(request.args.get('full')), workers=workers):
+                    partial_records.append(record)
+            partial_records = None # 最後まで更新できた
+        else:
+            count_cache_lookup('endpoint_snapshot', True)
+            if inventory.age() > get_settings().inventory_max_age:
+                # 古くなっている場合は現在のスナップショットを返しつつ裏で更新する
+                inventory.refresh_in_background(client)
+    except DeadlineExceeded:
+        # 処理期限までに更新が終わらなかった場合は手元の結果を返す (更新は裏で最後まで続く)
+        logger.warning("処理期限によりEndpointインベントリの更新待ちを打ち切りました。更新はバックグラウンドで続けます。")
+    except Exception as e:
+        return _endpoint_list_error_response(e)
+
+    # 絞り込み・並べ替え・ページングはスナップショット上で行うため、ISEへの通信は発生しない
+    if partial_records is not None and not inventory.loaded:
+        records = partial_records # 初回の更新途中: 取得できた分だけ
+    else:
+        records = inventory.records()
+    total, endpoint_results = query_endpoint_records(records, request.args)
+    result = {'endpoints': endpoint_results, 'total': total, 'snapshot': inventory.status()}
+    if partial_records is not None:
+        result['incomplete'] = True # 最新の状態を反映しきれていない
+    with ROUTE_PHASE_SECONDS.time(route='/get_endpoints', phase='serialize'):
+        return jsonify(result)
 
 
 @app.route('/delete_endpoint', methods=['POST'])
+@with_route_deadline
 def delete_endpoint():
     """
     指定されたMACアドレスのEndpointを削除するAPI。
@@ -360,53 +4968,24 @@ def delete_endpoint():
     if not mac_address: # 削除に必要なのはMACアドレスのみ
          return jsonify({'error': 'MACアドレスが必要です'}), 400
 
-    # ヘルパー関数で接続情報を取得
-    ise_ip, username, password, http_proxy = get_ise_connection_details()
-    if not ise_ip:
+    # 共有クライアントを取得 (接続情報は生成時に.envから読み込み済み)
+    client = get_ise_client()
+    if client is None:
         return jsonify({'error': '.envファイルにISE_IP、ISE_USERNAMEまたはISE_PASSWORDが設定されていません'}), 500
-    if not username or not password:
-         return jsonify({'error': 'ISE_USERNAMEまたはISE_PASSWORDが設定されていません'}), 500
-
-
-    # ヘッダーとプロキシ設定を取得
-    headers = {"Accept": "application/json"} # Endpoint検索レスポンスはJSONを期待
-    auth_header_value = get_basic_auth_header(username, password)
-    if auth_header_value:
-         headers['authorization'] = auth_header_value
-    else:
-         # 認証ヘッダーが生成できなかった場合はエラーを返す
-         return jsonify({'error': '認証情報が不足しているためAPIリクエストヘッダーを生成できません'}), 500
 
-    proxies = get_proxies() # ヘルパー関数を使う
+    # 'aa-bb-cc-dd-ee-ff' などの表記もISEの標準表記に揃えてから検索する
+    normalized_mac = normalize_mac(mac_address)
+    if not normalized_mac:
+        return jsonify({'error': f'MACアドレスの形式が不正です: {mac_address}'}), 400
 
     logger.debug(
-        f"Attempting to find Endpoint ID for MAC: {mac_address}"
+        "Attempting to find Endpoint ID for MAC: %s", normalized_mac
     )
 
     # Step 1: MACアドレスに一致するEndpointのIDを取得
-    # フィルター検索がうまくいかないため、全件リストを取得してPythonで検索する
-    list_url = f"https://{ise_ip}:9060/ers/config/endpoint"
-    logger.debug(f"Getting full endpoint list to find ID: {list_url}")
+    # サーバー側の検索APIで1件だけ取得する (使えない場合のみ一覧を検索)
     try:
-        response = requests.get(
-            list_url,
-            headers=headers,
-            verify=False,
-            proxies=proxies,
-        )
-        response.raise_for_status()
-        list_data = response.json()
-        logger.debug(f"Full endpoint list received. Searching for MAC: {mac_address}")
-
-        endpoint_id = None
-        # SearchResult.resources はEndpoint簡易情報のリストを期待
-        endpoints_list = list_data.get('SearchResult', {}).get('resources', [])
-
-        for endpoint_summary in endpoints_list:
-            # 簡易リストのnameがMACアドレスであることを期待して比較
-            if endpoint_summary.get('name', '').lower() == mac_address.lower():
-                endpoint_id = endpoint_summary.get('id')
-                break # MAC一致するものが見つかったらループを抜ける
+        endpoint_id = resolve_endpoint_id_by_mac(client, normalized_mac)
 
         if not endpoint_id:
             message = f'MACアドレス {mac_address} に一致するEndpointが見つかりませんでした。'
@@ -414,45 +4993,39 @@ def delete_endpoint():
             # Endpointが見つからなかった場合は404を返す
             return jsonify({'message': message}), 404
 
-        logger.debug(f"Found Endpoint ID: {endpoint_id} for MAC: {mac_address}")
+        logger.debug("Found Endpoint ID: %s for MAC: %s", endpoint_id, mac_address)
 
         # Step 2: Endpointリソース自体を削除するためのAPI呼び出し (DELETEメソッド)
         # ユーザー情報とドキュメント（後者の形式）に基づき、/ers/config/endpoint/{endpointId} にDELETE
-        delete_url = f"https://{ise_ip}:9060/ers/config/endpoint/{endpoint_id}"
-        logger.debug(f"Delete URL: {delete_url}")
+        delete_path = f"/ers/config/endpoint/{endpoint_id}"
+        logger.debug("Delete Path: %s", delete_path)
 
         # DELETEメソッドも認証ヘッダーが必要です。Acceptヘッダーも通常必要です。
         # 削除APIはレスポンスボディがないことが多いですが、AcceptはJSONで送るのが無難です。
-        delete_headers = {"Accept": "application/json"}
-        if auth_header_value:
-            delete_headers['authorization'] = auth_header_value
-        # Content-TypeはDELETEでは通常不要
-
-        response = requests.delete(
-            delete_url,
-            headers=delete_headers, # DELETEメソッドもheadersが必要
-            verify=False,
-            proxies=proxies,
-        )
+        # (いずれもclient.ers_request内で付与。Content-TypeはDELETEでは通常不要)
+        response = client.ers_request('DELETE', delete_path)
         # DELETE成功時は通常204 No Contentが返されます。
         # raise_for_status() は204でも例外を発生させません。
         response.raise_for_status()
-        logger.info(f"Successfully deleted Endpoint with MAC {mac_address} (ID: {endpoint_id})")
+        _endpoint_id_index.invalidate(normalized_mac)
+        get_endpoint_inventory().remove_mac(normalized_mac)
+        logger.info("Successfully deleted Endpoint with MAC %s (ID: %s)", mac_address, endpoint_id)
         # 成功レスポンスとしてメッセージを返す
         return jsonify({'message': f'MACアドレス {mac_address} のEndpointを削除しました。'})
 
     except requests.exceptions.RequestException as e:
-        logger.error(f"Endpoint削除リクエスト失敗: {e}")
+        logger.error("Endpoint削除リクエスト失敗: %s", e)
         error_message = str(e)
         if hasattr(e, 'response') and e.response is not None:
             error_message += f" Status Code: {e.response.status_code}, Body: {e.response.text}"
         return jsonify({'error': f'Endpoint削除失敗: {error_message}'}), 500
     except Exception as e:
-        logger.error(f"Endpoint削除中に予期しないエラーが発生しました: {e}")
+        logger.error("Endpoint削除中に予期しないエラーが発生しました: %s", e)
         return jsonify({'error': f'Endpoint削除中に予期しないエラー: {str(e)}'}), 500
 
 
 @app.route('/add_endpoint', methods=['POST'])
+@with_route_deadline
 def add_endpoint():
     """
     指定されたMACアドレスのEndpointを指定されたGroupに追加するAPI。
@@ -464,31 +5037,16 @@ def add_endpoint():
     if not mac_address or not endpoint_group_id:
          return jsonify({'error': 'MACアドレスとEndpoint Group IDが必要です'}), 400
 
-    # ヘルパー関数で接続情報を取得
-    ise_ip, username, password, http_proxy = get_ise_connection_details()
-    if not ise_ip:
+    # 共有クライアントを取得 (接続情報は生成時に.envから読み込み済み)
+    client = get_ise_client()
+    if client is None:
         return jsonify({'error': '.envファイルにISE_IP、ISE_USERNAMEまたはISE_PASSWORDが設定されていません'}), 500
-    if not username or not password:
-         return jsonify({'error': 'ISE_USERNAMEまたはISE_PASSWORDが設定されていません'}), 500
 
-
-    # ヘッダーとプロキシ設定を取得
     # POSTリクエストなので Content-Type: application/json が必要
-    headers = {
-        'Content-Type': 'application/json',
-        'Accept': 'application/json', # AcceptもJSONが一般的
-    }
-    auth_header_value = get_basic_auth_header(username, password)
-    if auth_header_value:
-         headers['authorization'] = auth_header_value
-    else:
-         # 認証ヘッダーが生成できなかった場合はエラーを返す
-         return jsonify({'error': '認証情報が不足しているためAPIリクエストヘッダーを生成できません'}), 500
-
-    proxies = get_proxies() # ヘルパー関数を使う
+    headers = {'Content-Type': 'application/json'}
 
     # --- 修正: Endpointリソースを作成するAPIエンドポイントを使用 ---
-    url = f"https://{ise_ip}:9060/ers/config/endpoint"
+    path = "/ers/config/endpoint"
     # ---------------------------------------------------------
 
     # 追加するEndpointの情報ペイロード
@@ -503,34 +5061,225 @@ def add_endpoint():
         }
     }
     # -----------------------------------------------------
-    logger.debug(f"Add Endpoint Payload: {json.dumps(payload)}")
-    logger.debug(f"Add Endpoint URL: {url}")
+    logger.debug("Add Endpoint Payload: %s", json.dumps(payload))
+    logger.debug("Add Endpoint Path: %s", path)
 
 
     try:
-        response = requests.post(
-            url,
+        response = client.ers_request(
+            'POST',
+            path,
             headers=headers,
             data=json.dumps(payload), # Python辞書をJSON文字列に変換
-            verify=False,
-            proxies=proxies,
         )
         # POST成功時は通常201 Createdが返されます
         response.raise_for_status()
-        logger.info(f"Successfully added MAC {mac_address} to Group ID {endpoint_group_id}")
+        logger.info("Successfully added MAC %s to Group ID %s", mac_address, endpoint_group_id)
+        # 作成されたEndpointのID (Locationヘッダーの末尾) が分かればスナップショットにも反映する
+        new_endpoint_id = response.headers.get('Location', '').rstrip('/').rsplit('/', 1)[-1]
+        if new_endpoint_id and normalize_mac(mac_address):
+            get_endpoint_inventory().upsert(new_endpoint_id, normalize_mac(mac_address), endpoint_group_id,
+                                      get_group_name_by_id(client, endpoint_group_id))
         # 成功レスポンスとしてメッセージを返す
         return jsonify({'message': f'MACアドレス {mac_address} をEndpointGroupに追加しました。'})
     except requests.exceptions.RequestException as e:
-        logger.error(f"Endpoint追加リクエスト失敗: {e}")
+        logger.error("Endpoint追加リクエスト失敗: %s", e)
         error_message = str(e)
         if hasattr(e, 'response') and e.response is not None:
             error_message += f" Status Code: {e.response.status_code}, Body: {e.response.text}"
         return jsonify({'error': f'Endpoint追加失敗: {error_message}'}), 500
     except Exception as e:
-        logger.error(f"Endpoint追加中に予期しないエラーが発生しました: {e}")
+        logger.error("Endpoint追加中に予期しないエラーが発生しました: %s", e)
         return jsonify({'error': f'Endpoint追加中に予期しないエラー: {str(e)}'}), 500
 
 
+@app.route('/bulk_add_endpoints', methods=['POST'])
+@with_route_deadline
+def bulk_add_endpoints():
+    """
+    複数のMACアドレスのEndpointをまとめて追加するAPI。
+    JSONまたはCSVファイルで受け取り、ERS Bulk API (/ers/config/endpoint/bulk/submit) で
+    チャンクごとに処理して、MACアドレスごとの結果を返す。
+    """
+    try:
+        rows = _read_bulk_request_items()
+    except BulkRequestError as e:
+        return jsonify({'error': str(e)}), 400
+    if not rows:
+        return jsonify({'error': '追加するMACアドレスの一覧が必要です'}), 400
+
+    client = get_ise_client()
+    if client is None:
+        return jsonify({'error': '.envファイルにISE_IP、ISE_USERNAMEまたはISE_PASSWORDが設定されていません'}), 500
+
+    # 入力チェックで不正なものは送信せずに結果へ含める
+    results, items = [], []
+    for row in rows:
+        result = {'mac_address': row['mac_address'], 'mac': normalize_mac(row['mac_address']),
+                  'endpoint_group_id': row['endpoint_group_id']}
+        if not result['mac']:
+            result['status'], result['message'] = 'invalid', 'MACアドレスの形式が不正です'
+        elif not result['endpoint_group_id']:
+            result['status'], result['message'] = 'invalid', 'Endpoint Group IDが必要です'
+        else:
+            items.append(result)
+        results.append(result)
+
+    logger.debug("Bulk Add Endpoints: %s件 (入力 %s件)", len(items), len(rows))
+    try:
+        mode = run_endpoint_bulk(client, 'create', items) if items else 'none'
+        # 作成されたEndpointのIDが分かるものはスナップショットにも反映する
+        try:
+            for item in items:
+                if item['status'] == 'success' and item.get('endpoint_id'):
+                    get_endpoint_inventory().upsert(item['endpoint_id'], item['mac'], item['endpoint_group_id'],
+                                                    get_group_name_by_id(client, item['endpoint_group_id']))
+        except DeadlineExceeded:
+            pass # Group名を取得できなかった分は次回のインベントリ更新で反映される
+        return _bulk_response(results, mode)
+    except requests.exceptions.RequestException as e:
+        logger.error("Endpoint一括追加リクエスト失敗: %s", e)
+        return jsonify({'error': f'Endpoint一括追加失敗: {e}'}), 500
+    except Exception as e:
+        logger.error("Endpoint一括追加中に予期しないエラーが発生しました: %s", e)
+        return jsonify({'error': f'Endpoint一括追加中に予期しないエラー: {str(e)}'}), 500
+
+
+@app.route('/bulk_delete_endpoints', methods=['POST'])
+@with_route_deadline
+def bulk_delete_endpoints():
+    """
+    複数のMACアドレスのEndpointをまとめて削除するAPI。
+    各MACアドレスのEndpoint IDを並行に検索した後、ERS Bulk APIでまとめて削除し、
+    MACアドレスごとの結果を返す。
+    """
+    try:
+        rows = _read_bulk_request_items()
+    except BulkRequestError as e:
+        return jsonify({'error': str(e)}), 400
+    if not rows:
+        return jsonify({'error': '削除するMACアドレスの一覧が必要です'}), 400
+
+    client = get_ise_client()
+    if client is None:
+        return jsonify({'error': '.envファイルにISE_IP、ISE_USERNAMEまたはISE_PASSWORDが設定されていません'}), 500
+
+    results = [{'mac_address': row['mac_address'], 'mac': normalize_mac(row['mac_address'])} for row in rows]
+
+    def resolve(result):
+        if not result['mac']:
+            result['status'], result['message'] = 'invalid', 'MACアドレスの形式が不正です'
+            return result
+        try:
+            result['endpoint_id'] = resolve_endpoint_id_by_mac(client, result['mac'])
+        except DeadlineExceeded:
+            result['status'], result['message'] = 'timeout', '処理期限のためIDを検索できませんでした'
+            return result
+        except requests.exceptions.RequestException as e:
+            result['status'], result['message'] = 'failed', f"ID検索失敗 ({_status_code_of(e)})"
+            return result
+        if not result['endpoint_id']:
+            result['status'], result['message'] = 'not_found', '一致するEndpointが見つかりませんでした'
+        return result
+
+    try:
+        # Step 1: MACアドレス -> Endpoint IDを並行に解決
+        workers = max(1, get_settings().max_workers)
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='ise-resolve') as executor:
+            futures = [executor.submit(contextvars.copy_context().run, resolve, result) for result in results]
+            for future in futures:
+                future.result()
+        items = [result for result in results if 'status' not in result]
+
+        # Step 2: 見つかったEndpointをまとめて削除
+        logger.debug("Bulk Delete Endpoints: %s件 (入力 %s件)", len(items), len(rows))
+        mode = run_endpoint_bulk(client, 'delete', items) if items else 'none'
+        for item in items:
+            if item['status'] == 'success':
+                _endpoint_id_index.invalidate(item['mac'])
+                get_endpoint_inventory().remove_mac(item['mac'])
+        return _bulk_response(results, mode)
+    except requests.exceptions.RequestException as e:
+        logger.error("Endpoint一括削除リクエスト失敗: %s", e)
+        return jsonify({'error': f'Endpoint一括削除失敗: {e}'}), 500
+    except Exception as e:
+        logger.error("Endpoint一括削除中に予期しないエラーが発生しました: %s", e)
+        return jsonify({'error': f'Endpoint一括削除中に予期しないエラー: {str(e)}'}), 500
+
+
+# --- 非同期ルート (Flaskの非同期ビュー: pip install "Flask[async]" httpx) ---
+
+@app.route('/async/get_endpoints')
+@with_route_deadline
+async def async_get_endpoints():
+    """
+    /get_endpoints?source=live の非同期版。ISEからEndpoint一覧を全件取得し、
+    各Endpointの詳細とGroup名をスレッドを使わずに並行取得して返す。
+    q, group, sort, offset, limit は /get_endpoints と同じ。
+    """
+    client = get_ise_client()
+    if client is None:
+        return jsonify({'error': '.envファイルにISE_IP、ISE_USERNAMEまたはISE_PASSWORDが設定されていません'}), 500
+    if httpx is None:
+        return jsonify({'error': '非同期ルートにはhttpxが必要です (pip install httpx)'}), 501
+
+    try:
+        endpoint_results, incomplete = await run_with_async_ise_client(async_get_endpoints_with_group)
+    except httpx.HTTPError as e:
+        logger.error("Endpoint簡易リストの取得に失敗しました (async): %s", e)
+        return jsonify({'error': f"Endpoint簡易リスト取得失敗: {e} Status Code: {_status_code_of(e)}"}), 500
+    except Exception as e:
+        return _endpoint_list_error_response(e)
+
+    total, endpoint_results = query_endpoint_records(endpoint_results, request.args)
+    result = {'endpoints': endpoint_results, 'total': total}
+    if incomplete:
+        result['incomplete'] = True # 処理期限までに取得できた分のみ
+    return jsonify(result)
+
+
+@app.route('/async/sessions')
+@with_route_deadline
+async def async_sessions():
+    """
+    /sessions の非同期版 (raw=1 は非対応)。mac, offset, limit は /sessions と同じ。
+    """
+    client = get_ise_client()
+    if client is None:
+        return jsonify({'error': '.envファイルにISE_IP、ISE_USERNAMEまたはISE_PASSWORDが設定されていません'}), 500
+    if httpx is None:
+        return jsonify({'error': '非同期ルートにはhttpxが必要です (pip install httpx)'}), 501
+
+    mac_filter = (request.args.get('mac') or '').strip()
+    offset = max(0, request.args.get('offset', 0, type=int))
+    limit = request.args.get('limit', type=int)
+
+    try:
+        root_attrib = {}
+        session_list = await run_with_async_ise_client(
+            lambda aclient: async_fetch_active_sessions(aclient, root_attrib))
+    except httpx.HTTPError as e:
+        logger.error("Request failed (async): %s", e)
+        return jsonify({'error': f'Active Session取得失敗: {e} Status Code: {_status_code_of(e)}'}), 500
+    except ET.ParseError as e:
+        logger.error("XML Parse Error: %s", e)
+        return jsonify({'error': f'Active Session XML Parse Error: {e}'}), 500
+    except Exception as e:
+        logger.error("An unexpected error occurred during async_sessions: %s", e)
+        return jsonify({'error': f'Active Session取得中に予期しないエラー: {e}'}), 500
+
+    if mac_filter:
+        session_list = list(filter(_session_mac_matcher(mac_filter), session_list))
+    page = session_list[offset:]
+    if limit is not None:
+        page = page[:max(0, limit)]
+    return jsonify({
+        'noOfActiveSession': root_attrib.get('noOfActiveSession', "N/A"),
+        'total': len(session_list), # 絞り込み後の件数
+        'sessions': page,
+    })
+
+
 if __name__ == '__main__':
     # debug=True は開発時のみ使用し、本番環境ではFalseにしてください。
     # host='0.0.0.0' は全てのインターフェースでリッスンします。本番環境では特定のIPに制限することを検討してください。
@@ -0,0 +1,81 @@
+"""
+テストの共通設定。benchmark/mock_ise.py の模擬ISEをテストごとに起動し、ise_api_client をそこへ接続する。
+"""
+import dataclasses
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'benchmark')]
+
+# ise_api_client は読み込み時に設定を読むため、先に環境変数を設定する (.envの値より優先される)
+os.environ.update({
+    'ISE_IP': '127.0.0.1',
+    'ISE_USERNAME': 'admin',
+    'ISE_PASSWORD': 'admin',
+    'HTTP_PROXY': '',
+    'ISE_SCHEME': 'http',
+    'ISE_INVENTORY_DB': '', # インベントリはメモリのみ (リポジトリのSQLiteファイルを使わない)
+    'ISE_HTTP_CACHE_DB': '',
+    'ISE_SETTINGS_WATCH_INTERVAL': '0',
+    'ISE_TRACE_EXPORTER': 'none',
+    'ISE_LOG_LEVEL': 'WARNING',
+})
+
+import pytest
+
+import ise_api_client as ise
+import mock_ise
+
+
+@pytest.fixture
+def start_mock():
+    """
+    模擬ISEを起動する関数を返す。引数は MockISEData (endpoints, groups, sessions) と
+    create_app (latency, rate, retry_after, bulk_delay など) のもの。
+    戻り値のFlaskアプリは data (MockISEData)、calls (ルートごとの受付件数)、port を持つ。
+    """
+    servers = []
+
+    def start(endpoints=50, groups=5, sessions=None, **options):
+        data = mock_ise.MockISEData(endpoints, groups, sessions=sessions)
+        app = mock_ise.create_app(data, 'admin', 'admin', **options)
+        server, app.port = mock_ise.serve_in_background(app)
+        servers.append(server)
+        return app
+
+    yield start
+    for server in servers:
+        server.shutdown()
+
+
+@pytest.fixture
+def mock_settings():
+    """
+    模擬ISEへ接続するSettingsを作成する関数を返す。キーワード引数で設定項目を上書きできる。
+    """
+    def make(mock, **overrides):
+        return dataclasses.replace(ise.Settings.from_env(), ers_port=mock.port, mnt_port=mock.port, **overrides)
+    return make
+
+
+@pytest.fixture
+def use_mock(monkeypatch, mock_settings):
+    """
+    アプリ全体 (get_settings / get_ise_client とルート) を模擬ISEへ向ける関数を返す。
+    プロセス共通のキャッシュ・スナップショットも空の状態に戻す。
+    """
+    def use(mock, **overrides):
+        monkeypatch.setattr(ise, '_settings', mock_settings(mock, **overrides))
+        monkeypatch.setattr(ise, '_endpoint_inventory', None)
+        monkeypatch.setattr(ise, 'session_snapshot', ise.SessionSnapshot())
+        ise.invalidate_group_name_cache()
+        ise._endpoint_id_index.invalidate()
+        ise._session_by_mac_cache.invalidate()
+        return ise.get_ise_client()
+    return use
+
+
+@pytest.fixture
+def app_client():
+    return ise.app.test_client()
@@ -0,0 +1,33 @@
+"""
+非同期ルート (/async/get_endpoints, /async/sessions) のテスト。
+"""
+import pytest
+
+pytest.importorskip('httpx')
+pytest.importorskip('asgiref') # Flaskの非同期ビューに必要
+
+
+def test_async_get_endpoints(start_mock, use_mock, app_client):
+    mock = start_mock(endpoints=150, groups=4)
+    use_mock(mock)
+    expected = [{'mac': mac, 'group_id': group_id, 'group_name': mock.data.groups[group_id]}
+                for mac, group_id in (mock.data.endpoints[endpoint_id] for endpoint_id in mock.data.endpoint_ids())]
+
+    body = app_client.get('/async/get_endpoints?limit=20').get_json()
+
+    assert body['total'] == 150
+    assert body['endpoints'] == expected[:20]
+    assert 'incomplete' not in body
+
+
+def test_async_sessions(start_mock, use_mock, app_client):
+    mock = start_mock(endpoints=30, sessions=25)
+    use_mock(mock)
+
+    body = app_client.get('/async/sessions?offset=5&limit=10').get_json()
+    filtered = app_client.get('/async/sessions?mac=02-00-00-00-00-07').get_json()
+
+    assert body['noOfActiveSession'] == '25'
+    assert body['total'] == 25
+    assert [session['user_name'] for session in body['sessions']] == [f'user{i:05d}' for i in range(5, 15)]
+    assert [session['calling_station_id'] for session in filtered['sessions']] == ['02:00:00:00:00:07']
@@ -0,0 +1,61 @@
+"""
+バックグラウンド更新 (BackgroundRefresher) と取得済みデータからの応答 (stale-while-revalidate) のテスト。
+"""
+import time
+
+import ise_api_client as ise
+
+
+def _wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "タイムアウトしました"
+        time.sleep(0.02)
+
+
+def test_background_tasks_fill_the_data_served_by_routes(start_mock, use_mock, app_client):
+    mock = start_mock(endpoints=20, groups=3, sessions=7)
+    use_mock(mock)
+
+    for task in ise.background_refresher.tasks:
+        ise.background_refresher.run_task(task)
+    calls = sum(mock.calls.values())
+    endpoints = app_client.get('/get_endpoints').get_json()
+    sessions = app_client.get('/sessions').get_json()
+    status = app_client.get('/data_status').get_json()
+
+    assert sum(mock.calls.values()) == calls # ルートはISEへ問い合わせずに応答する
+    assert endpoints['total'] == 20
+    assert sessions['total'] == 7
+    assert status['inventory']['count'] == 20
+    assert status['group_names']['count'] == 3
+    assert status['sessions']['count'] == 7
+    assert all(task['last_run_at'] and task['last_error'] is None for task in status['background_refresh']['tasks'])
+
+
+def test_stale_sessions_are_served_while_refreshing(start_mock, use_mock, app_client):
+    mock = start_mock(endpoints=20, sessions=7)
+    use_mock(mock, session_max_age=0)
+    app_client.get('/sessions')
+    mock.data.session_count = 3
+
+    body = app_client.get('/sessions').get_json()
+
+    assert body['total'] == 7 # 古い内容をすぐに返し、裏で取得し直す
+    assert body['snapshot']['age_seconds'] is not None
+    _wait_until(lambda: ise.session_snapshot.status()['count'] == 3)
+
+
+def test_failed_task_keeps_the_last_good_data(start_mock, use_mock, app_client):
+    mock = start_mock(endpoints=20, sessions=7)
+    use_mock(mock)
+    task = next(task for task in ise.background_refresher.tasks if task.name == 'sessions')
+    ise.background_refresher.run_task(task)
+    mock.view_functions['active_list'] = lambda: ('', 500)
+
+    ise.background_refresher.run_task(task)
+
+    assert task.last_error
+    assert ise.session_snapshot.status()['count'] == 7
+    assert ise.session_snapshot.status()['last_error']
+    assert app_client.get('/sessions').get_json()['total'] == 7
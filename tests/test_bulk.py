@@ -0,0 +1,102 @@
+"""
+Endpointの一括追加・一括削除 (/bulk_add_endpoints, /bulk_delete_endpoints) のテスト。
+"""
+import io
+
+import pytest
+
+
+def test_bulk_add_endpoints(start_mock, use_mock, app_client):
+    mock = start_mock(endpoints=5)
+    use_mock(mock)
+    existing_mac = mock.data.endpoints[mock.data.endpoint_ids()[0]][0]
+
+    body = app_client.post('/bulk_add_endpoints', json={
+        'mac_addresses': ['aa-bb-cc-00-00-01', 'aabb.cc00.0002', existing_mac, 'not-a-mac'],
+        'endpoint_group_id': mock.data.group_ids[0],
+    }).get_json()
+
+    assert body['mode'] == 'bulk'
+    assert [result['status'] for result in body['results']] == ['success', 'success', 'failed', 'invalid']
+    assert body['summary'] == {'total': 4, 'success': 2, 'failed': 1, 'invalid': 1}
+    assert {'AA:BB:CC:00:00:01', 'AA:BB:CC:00:00:02'} <= set(mock.data.ids_by_mac)
+    assert mock.calls['PUT /ers/config/endpoint/bulk/submit'] == 1
+
+
+def test_bulk_add_accepts_a_list_body_and_csv(start_mock, use_mock, app_client):
+    mock = start_mock(endpoints=5)
+    use_mock(mock)
+    group_id = mock.data.group_ids[1]
+
+    listed = app_client.post('/bulk_add_endpoints', json=[
+        'AA:BB:CC:00:00:01',
+        {'mac_address': 'AA:BB:CC:00:00:02', 'endpoint_group_id': group_id},
+    ]).get_json()
+    uploaded = app_client.post('/bulk_add_endpoints', data={
+        'file': (io.BytesIO(f"mac_address,endpoint_group_id\nAA:BB:CC:00:00:03,{group_id}\n".encode()), 'macs.csv'),
+    }).get_json()
+
+    assert [result['status'] for result in listed['results']] == ['invalid', 'success'] # 1件目はGroup IDなし
+    assert [result['status'] for result in uploaded['results']] == ['success']
+    assert mock.data.endpoints[mock.data.ids_by_mac['AA:BB:CC:00:00:03']][1] == group_id
+
+
+def test_bulk_delete_endpoints(start_mock, use_mock, app_client):
+    mock = start_mock(endpoints=5)
+    use_mock(mock)
+    macs = [mock.data.endpoints[endpoint_id][0] for endpoint_id in mock.data.endpoint_ids()[:2]]
+
+    body = app_client.post('/bulk_delete_endpoints', json={
+        'mac_addresses': macs + ['AA:BB:CC:00:00:99'],
+    }).get_json()
+
+    assert body['mode'] == 'bulk'
+    assert [result['status'] for result in body['results']] == ['success', 'success', 'not_found']
+    assert len(mock.data.endpoints) == 3
+    assert not set(macs) & set(mock.data.ids_by_mac)
+
+
+def test_bulk_falls_back_to_single_calls(start_mock, use_mock, app_client):
+    mock = start_mock(endpoints=5)
+    use_mock(mock)
+    mock.view_functions['bulk_submit'] = lambda: ('', 404) # Bulk APIのないISE
+
+    body = app_client.post('/bulk_add_endpoints', json={
+        'mac_addresses': ['AA:BB:CC:00:00:01', 'AA:BB:CC:00:00:02'],
+        'endpoint_group_id': mock.data.group_ids[0],
+    }).get_json()
+
+    assert body['mode'] == 'single'
+    assert body['summary'] == {'total': 2, 'success': 2}
+    assert mock.calls['POST /ers/config/endpoint'] == 2
+
+
+def test_bulk_add_marks_unconfirmed_items_on_deadline(start_mock, use_mock, app_client):
+    mock = start_mock(endpoints=5, bulk_delay=10)
+    use_mock(mock, deadline_margin=0.2)
+
+    body = app_client.post('/bulk_add_endpoints?deadline=1', json={
+        'mac_addresses': ['AA:BB:CC:00:00:01', 'AA:BB:CC:00:00:02'],
+        'endpoint_group_id': mock.data.group_ids[0],
+    }).get_json()
+
+    assert body['incomplete'] is True
+    assert [result['status'] for result in body['results']] == ['timeout', 'timeout']
+
+
+@pytest.mark.parametrize('route', ['/bulk_add_endpoints', '/bulk_delete_endpoints'])
+@pytest.mark.parametrize('payload, bad_entry', [
+    ({'endpoints': [5]}, 'endpoints[0]'),
+    ({'endpoints': [{'mac_address': 'AA:BB:CC:00:00:01'}, {'mac_address': 123}]}, 'endpoints[1]'),
+    ({'mac_addresses': ['AA:BB:CC:00:00:01', 123]}, 'mac_addresses[1]'),
+    ({'mac_addresses': 'AA:BB:CC:00:00:01'}, 'mac_addresses'),
+    ([None], '[0]'),
+    ('AA:BB:CC:00:00:01', 'JSON'),
+])
+def test_bulk_routes_reject_malformed_json(start_mock, use_mock, app_client, route, payload, bad_entry):
+    use_mock(start_mock(endpoints=5))
+
+    response = app_client.post(route, json=payload)
+
+    assert response.status_code == 400
+    assert bad_entry in response.get_json()['error']
@@ -0,0 +1,73 @@
+"""
+プロセス内キャッシュ (TTLCache、Group名キャッシュ) のテスト。
+"""
+import time
+
+import pytest
+
+import ise_api_client as ise
+
+
+def test_ttl_cache_expires_entries():
+    cache = ise.TTLCache(maxsize=10, ttl=0.1)
+    cache.set('a', 1)
+    cache.set('b', 2, ttl=60)
+
+    assert cache.get('a') == 1
+    time.sleep(0.15)
+    assert cache.get('a') is None
+    assert cache.get('b') == 2
+
+
+def test_ttl_cache_evicts_least_recently_used():
+    cache = ise.TTLCache(maxsize=2, ttl=60)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a') # bが最も長く参照されていない
+    cache.set('c', 3)
+
+    assert cache.get('b') is None
+    assert (cache.get('a'), cache.get('c')) == (1, 3)
+
+
+def test_group_names_come_from_one_listing(start_mock, use_mock, app_client):
+    mock = start_mock(endpoints=50, groups=5)
+    use_mock(mock)
+
+    app_client.get('/get_endpoints?source=live')
+    app_client.get('/get_endpoints?source=live')
+
+    assert mock.calls['GET /ers/config/endpointgroup'] == 1
+    assert mock.calls['GET /ers/config/endpointgroup/<group_id>'] == 0
+
+
+def test_invalidate_group_cache_lists_groups_again(start_mock, use_mock, app_client):
+    mock = start_mock(endpoints=10, groups=2)
+    use_mock(mock)
+    app_client.get('/get_endpoints?source=live')
+
+    assert app_client.post('/invalidate_group_cache').status_code == 200
+    app_client.get('/get_endpoints?source=live')
+
+    assert mock.calls['GET /ers/config/endpointgroup'] == 2
+
+
+def _group_name_lookups(result):
+    return ise.metrics_registry.get_sample_value(
+        'ise_client_cache_requests_total', {'cache': 'group_name', 'result': result}) or 0
+
+
+def test_cold_group_lookup_is_counted_once(start_mock, use_mock):
+    pytest.importorskip('prometheus_client')
+    mock = start_mock(endpoints=5, groups=2)
+    client = use_mock(mock)
+    hits, misses = _group_name_lookups('hit'), _group_name_lookups('miss')
+
+    assert ise.get_group_name_by_id(client, mock.data.group_ids[0]) == mock.data.groups[mock.data.group_ids[0]]
+    assert (_group_name_lookups('hit') - hits, _group_name_lookups('miss') - misses) == (1, 0) # 一覧取得で温めてから参照
+
+    mock.data.group_ids.append('new-group')
+    mock.data.groups['new-group'] = 'NewGroup'
+    assert ise.get_group_name_by_id(client, 'new-group') == 'NewGroup' # 一覧取得後に作成されたGroup
+    assert _group_name_lookups('miss') - misses == 1
+    assert mock.calls['GET /ers/config/endpointgroup/<group_id>'] == 1
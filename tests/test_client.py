@@ -0,0 +1,357 @@
+"""
+ISEClient (共有HTTPクライアント、流量制御、処理期限、サーキットブレーカー、HTTPキャッシュ) のテスト。
+"""
+import asyncio
+import socket
+import threading
+import time
+
+import pytest
+import requests
+
+import ise_api_client as ise
+
+
+@pytest.fixture
+def make_client(mock_settings):
+    def make(mock, **overrides):
+        return ise.ISEClient.from_settings(mock_settings(mock, **overrides))
+    return make
+
+
+def _unused_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+# ---------- 共有HTTPクライアント ----------
+
+def test_requests_to_a_host_share_one_pooled_session(start_mock, make_client):
+    mock = start_mock()
+    client = make_client(mock)
+
+    client.ers_request('GET', '/ers/config/endpointgroup')
+    client.mnt_request('GET', ise.MNT_ACTIVE_LIST_PATH)
+
+    assert list(client._sessions) == [f'127.0.0.1:{mock.port}'] # ERSとMnTが同じポートのため1つ
+    session = client._sessions[f'127.0.0.1:{mock.port}']
+    assert session.get_adapter(f'http://127.0.0.1:{mock.port}/')._pool_maxsize == client.pool_maxsize
+
+
+def test_get_ise_client_returns_the_shared_client(start_mock, use_mock):
+    client = use_mock(start_mock())
+
+    assert ise.get_ise_client() is client
+
+
+# ---------- ERS一覧のページング ----------
+
+@pytest.mark.parametrize('prefetch', [False, True])
+def test_iter_ers_resources_follows_next_page(start_mock, make_client, prefetch):
+    mock = start_mock(endpoints=45)
+    client = make_client(mock)
+
+    resources = list(ise.iter_ers_resources(client, '/ers/config/endpoint', page_size=20, prefetch=prefetch))
+
+    assert [resource['id'] for resource in resources] == mock.data.endpoint_ids()
+    assert mock.calls['GET /ers/config/endpoint'] == 3
+
+
+def test_iter_ers_resources_fetches_only_the_pages_consumed(start_mock, make_client):
+    mock = start_mock(endpoints=100)
+    client = make_client(mock)
+
+    resources = ise.iter_ers_resources(client, '/ers/config/endpoint', page_size=20)
+    first = [next(resources) for _ in range(25)]
+    resources.close()
+
+    assert len(first) == 25
+    assert mock.calls['GET /ers/config/endpoint'] == 2
+
+
+# ---------- 429 / Retry-After ----------
+
+def test_throttled_request_waits_for_retry_after(start_mock, make_client):
+    mock = start_mock(rate=1, burst=1, retry_after=1)
+    client = make_client(mock, retry_base_delay=0.1)
+    assert client.ers_request('GET', '/ers/config/endpointgroup').status_code == 200
+
+    started = time.monotonic()
+    response = client.ers_request('GET', '/ers/config/endpointgroup') # 受付枠を使い切っているため429
+
+    assert response.status_code == 200
+    assert mock.calls['throttled'] == 1
+    assert time.monotonic() - started >= 1.0
+
+
+def test_throttled_response_is_returned_when_retries_are_exhausted(start_mock, make_client):
+    mock = start_mock(rate=1, burst=1, retry_after=1)
+    client = make_client(mock, retry_max=0)
+    client.ers_request('GET', '/ers/config/endpointgroup')
+
+    response = client.ers_request('GET', '/ers/config/endpointgroup')
+
+    assert response.status_code == 429
+    assert response.headers['Retry-After'] == '1'
+
+
+def test_throttled_request_is_not_retried_past_the_deadline(start_mock, make_client):
+    mock = start_mock(rate=1, burst=1, retry_after=5)
+    client = make_client(mock)
+    client.ers_request('GET', '/ers/config/endpointgroup')
+
+    started = time.monotonic()
+    with ise.deadline_scope(1.0):
+        response = client.ers_request('GET', '/ers/config/endpointgroup')
+
+    assert response.status_code == 429
+    assert time.monotonic() - started < 1.0
+
+
+def _paused_limiter(seconds):
+    limiter = ise.AdaptiveRateLimiter()
+    limiter.acquire()
+    limiter.release(throttled=True, retry_after=seconds) # seconds秒間は送信を止める
+    return limiter
+
+
+def test_rate_limiter_does_not_wait_past_the_deadline():
+    limiter = _paused_limiter(30)
+
+    started = time.monotonic()
+    with ise.deadline_scope(0.3):
+        with pytest.raises(ise.DeadlineExceeded):
+            limiter.acquire()
+
+    assert 0.3 <= time.monotonic() - started < 1.0
+
+
+def test_async_rate_limiter_does_not_wait_past_the_deadline():
+    limiter = _paused_limiter(30)
+
+    async def acquire():
+        with ise.deadline_scope(0.3):
+            await limiter.acquire_async()
+
+    started = time.monotonic()
+    with pytest.raises(ise.DeadlineExceeded):
+        asyncio.run(acquire())
+
+    assert time.monotonic() - started < 1.0
+
+
+def test_parse_retry_after():
+    assert ise._parse_retry_after('3') == 3.0
+    assert ise._parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT') == 0.0 # 過去の日時は待たない
+    assert ise._parse_retry_after('soon') is None
+    assert ise._parse_retry_after(None) is None
+
+
+# ---------- 処理期限 ----------
+
+def test_request_after_deadline_is_not_sent(start_mock, make_client):
+    mock = start_mock()
+    client = make_client(mock)
+
+    with ise.deadline_scope(0.01):
+        time.sleep(0.02)
+        with pytest.raises(ise.DeadlineExceeded):
+            client.ers_request('GET', '/ers/config/endpointgroup')
+    assert mock.calls['GET /ers/config/endpointgroup'] == 0
+
+
+def test_request_timeout_is_capped_at_the_deadline(start_mock, make_client):
+    mock = start_mock(latency=5)
+    client = make_client(mock)
+
+    started = time.monotonic()
+    with ise.deadline_scope(0.5):
+        with pytest.raises(requests.exceptions.Timeout):
+            client.ers_request('GET', '/ers/config/endpointgroup')
+
+    assert time.monotonic() - started < 1.5
+
+
+# ---------- サーキットブレーカー ----------
+
+def test_circuit_breaker_opens_after_consecutive_failures(start_mock, make_client):
+    mock = start_mock()
+    mock.port = _unused_port() # 接続できないポート
+    client = make_client(mock, node_failure_threshold=2, node_cooldown=30, read_timeout=1)
+
+    for _ in range(2):
+        with pytest.raises(requests.exceptions.ConnectionError):
+            client.ers_request('GET', '/ers/config/endpointgroup')
+    assert client.pan_pool.status()[0]['state'] == 'open'
+    with pytest.raises(ise.NodeUnavailable):
+        client.ers_request('GET', '/ers/config/endpointgroup')
+    assert client.pan_pool.status()[0]['failure_count'] == 2 # 遮断中は送信しない
+
+
+def test_circuit_breaker_allows_a_single_half_open_probe():
+    breaker = ise.CircuitBreaker(failure_threshold=1, cooldown=0.2)
+    breaker.record_failure('connection refused')
+    assert breaker.state() == 'open'
+    assert not breaker.acquire()
+
+    time.sleep(0.25)
+    assert breaker.state() == 'half-open'
+    assert breaker.acquire() # 1件だけ試行を許可する
+    assert not breaker.acquire()
+    assert not breaker.available()
+
+    breaker.release() # 結果が出ないまま終わった試行は枠を返す
+    assert breaker.acquire()
+    breaker.record_success()
+    assert breaker.state() == 'closed'
+    assert breaker.acquire() and breaker.acquire()
+
+
+def test_half_open_node_recovers_after_successful_probe(start_mock, make_client):
+    mock = start_mock()
+    client = make_client(mock, node_failure_threshold=1, node_cooldown=0.2)
+    client.pan_pool.record_failure('127.0.0.1', 'connection refused')
+    with pytest.raises(ise.NodeUnavailable):
+        client.ers_request('GET', '/ers/config/endpointgroup')
+
+    time.sleep(0.25)
+    assert client.ers_request('GET', '/ers/config/endpointgroup').status_code == 200
+    assert client.pan_pool.status()[0]['state'] == 'closed'
+
+
+def test_deadline_capped_timeout_does_not_trip_the_breaker(start_mock, make_client):
+    mock = start_mock(latency=1.0)
+    client = make_client(mock, node_failure_threshold=1)
+
+    with ise.deadline_scope(0.3):
+        with pytest.raises(ise.DeadlineExceeded):
+            client.ers_request('GET', '/ers/config/endpointgroup')
+
+    node = client.pan_pool.status()[0]
+    assert node['state'] == 'closed'
+    assert node['failure_count'] == 0
+
+
+# ---------- 同一リクエストの集約 (single-flight) ----------
+
+def test_concurrent_identical_gets_are_sent_once(start_mock, make_client):
+    mock = start_mock(latency=0.2)
+    client = make_client(mock)
+    path = f"/ers/config/endpoint/{mock.data.endpoint_ids()[0]}"
+    responses = []
+
+    threads = [threading.Thread(target=lambda: responses.append(client.ers_request('GET', path))) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert mock.calls['GET /ers/config/endpoint/<endpoint_id>'] == 1
+    assert [response.status_code for response in responses] == [200] * 5
+
+
+@pytest.mark.parametrize('shareable, expected', [
+    (None, ('partial', ['leader'])),
+    (lambda result: result != 'partial', ('complete', ['leader', 'follower'])), # 途中までの結果は共有しない
+])
+def test_single_flight_shares_only_acceptable_results(shareable, expected):
+    flight = ise.SingleFlight('test')
+    leader_started, release_leader = threading.Event(), threading.Event()
+    calls = []
+    results = {}
+
+    def leader_func():
+        calls.append('leader')
+        leader_started.set()
+        release_leader.wait(5)
+        return 'partial'
+
+    def follower_func():
+        calls.append('follower')
+        return 'complete'
+
+    leader = threading.Thread(target=lambda: results.setdefault('leader', flight.do('key', leader_func)))
+    leader.start()
+    leader_started.wait(5)
+    follower = threading.Thread(
+        target=lambda: results.setdefault('follower', flight.do('key', follower_func, shareable=shareable)))
+    follower.start()
+    time.sleep(0.1) # followerが実行中の処理を待ち始めるまで
+    release_leader.set()
+    leader.join()
+    follower.join()
+
+    assert results['leader'] == 'partial'
+    assert (results['follower'], calls) == expected
+
+
+# ---------- HTTPキャッシュ (ETagによる再検証と変更時の削除) ----------
+
+def test_unchanged_resource_is_revalidated_with_etag(start_mock, make_client):
+    mock = start_mock()
+    client = make_client(mock)
+    path = f"/ers/config/endpoint/{mock.data.endpoint_ids()[0]}"
+
+    first = client.ers_request('GET', path)
+    second = client.ers_request('GET', path)
+
+    assert first.headers.get('ETag')
+    assert mock.calls['not_modified'] == 1 # 2回目は304で本文を受信しない
+    assert getattr(second, 'from_cache', False)
+    assert second.status_code == 200
+    assert second.json() == first.json()
+
+
+def test_deleted_resource_is_not_served_from_cache(start_mock, make_client):
+    mock = start_mock()
+    client = make_client(mock, http_cache_ttl_endpoint=60) # 有効期間内は再検証しない
+    path = f"/ers/config/endpoint/{mock.data.endpoint_ids()[0]}"
+    client.ers_request('GET', path)
+
+    assert client.ers_request('DELETE', path).status_code == 204
+    assert client.ers_request('GET', path).status_code == 404
+    assert mock.calls['not_modified'] == 0
+
+
+def test_bulk_delete_invalidates_cached_endpoints(start_mock, use_mock, app_client):
+    mock = start_mock(endpoints=5)
+    client = use_mock(mock, http_cache_ttl_endpoint=60) # 有効期間内は再検証しない
+    endpoint_id = mock.data.endpoint_ids()[0]
+    path = f"/ers/config/endpoint/{endpoint_id}"
+    assert client.ers_request('GET', path).status_code == 200
+
+    body = app_client.post('/bulk_delete_endpoints', json={'mac_addresses': [mock.data.endpoints[endpoint_id][0]]}).get_json()
+
+    assert body['summary']['success'] == 1
+    assert client.ers_request('GET', path).status_code == 404
+
+
+def test_mutation_invalidates_the_resource_and_its_list_pages():
+    cache = ise.ERSResponseCache(default_ttl=60)
+    for path in ('/ers/config/endpoint/a', '/ers/config/endpoint/b', '/ers/config/endpoint',
+                 '/ers/config/endpoint?page=2', '/ers/config/endpointgroup/a'):
+        cache.store(path, {}, b'{}')
+
+    cache.invalidate_for_mutation('/ers/config/endpoint/a')
+    assert [path for path in ('/ers/config/endpoint/a', '/ers/config/endpoint/b', '/ers/config/endpoint',
+                              '/ers/config/endpoint?page=2', '/ers/config/endpointgroup/a')
+            if cache.get(path)] == ['/ers/config/endpoint/b', '/ers/config/endpointgroup/a']
+
+    cache.invalidate_for_mutation('/ers/config/endpoint/bulk/submit')
+    assert cache.get('/ers/config/endpoint/b') is None
+    assert cache.get('/ers/config/endpointgroup/a') is not None # 別の種別は残す
+
+
+def test_cache_reads_unflushed_and_persisted_entries(tmp_path):
+    db_path = str(tmp_path / 'http_cache.db')
+    cache = ise.ERSResponseCache(maxsize=1, default_ttl=60, db_path=db_path)
+    cache.store('/ers/config/endpoint/a', {'ETag': '"a"'}, b'{"a": 1}')
+    cache.store('/ers/config/endpoint/b', {'ETag': '"b"'}, b'{"b": 1}') # aはメモリから追い出される (未書き込み)
+
+    assert cache.get('/ers/config/endpoint/a').etag == '"a"'
+
+    cache.close()
+    restored = ise.ERSResponseCache(default_ttl=60, db_path=db_path)
+    assert restored.get('/ers/config/endpoint/b').body == b'{"b": 1}'
+    restored.close()
@@ -0,0 +1,77 @@
+"""
+MACアドレスの正規化と、MACアドレスからEndpoint IDを求める検索のテスト。
+"""
+import flask
+import pytest
+import requests
+
+import ise_api_client as ise
+
+
+@pytest.mark.parametrize('mac_address, expected', [
+    ('aa:bb:cc:dd:ee:ff', 'AA:BB:CC:DD:EE:FF'),
+    ('aa-bb-cc-dd-ee-ff', 'AA:BB:CC:DD:EE:FF'),
+    ('aabb.ccdd.eeff', 'AA:BB:CC:DD:EE:FF'),
+    ('AABBCCDDEEFF', 'AA:BB:CC:DD:EE:FF'),
+    (' aa:bb:cc:dd:ee:ff ', 'AA:BB:CC:DD:EE:FF'),
+    ('aa:bb:cc:dd:ee', None), # 桁が足りない
+    ('aa:bb:cc:dd:ee:ff:00', None), # 桁が多い
+    ('gg:bb:cc:dd:ee:ff', None), # 16進数でない
+    ('', None),
+    (None, None),
+])
+def test_normalize_mac(mac_address, expected):
+    assert ise.normalize_mac(mac_address) == expected
+
+
+def _first_endpoint(mock):
+    endpoint_id = mock.data.endpoint_ids()[0]
+    return endpoint_id, mock.data.endpoints[endpoint_id][0]
+
+
+def test_lookup_uses_the_name_api(start_mock, use_mock):
+    mock = start_mock(endpoints=30)
+    client = use_mock(mock)
+    endpoint_id, mac = _first_endpoint(mock)
+
+    assert ise.resolve_endpoint_id_by_mac(client, mac) == endpoint_id
+    assert ise.resolve_endpoint_id_by_mac(client, 'AA:BB:CC:00:00:99') is None
+    assert mock.calls['GET /ers/config/endpoint'] == 0 # 一覧をたどらない
+
+
+def test_lookup_falls_back_to_filter_then_scan(start_mock, use_mock):
+    mock = start_mock(endpoints=30)
+    client = use_mock(mock)
+    endpoint_id, mac = _first_endpoint(mock)
+    mock.view_functions['endpoint_by_name'] = lambda name: ('', 405) # name APIのないISE
+
+    assert ise.resolve_endpoint_id_by_mac(client, mac) == endpoint_id
+    assert mock.calls['GET /ers/config/endpoint'] == 1 # filter検索の1回のみ
+
+    list_endpoints = mock.view_functions['list_endpoints']
+    mock.view_functions['list_endpoints'] = (
+        lambda: ('', 501) if flask.request.args.get('filter') else list_endpoints())
+    assert ise.resolve_endpoint_id_by_mac(client, mac) == endpoint_id
+    assert mock.calls['GET /ers/config/endpoint'] == 3 # filter検索 (501) と一覧の1ページ
+
+
+def test_lookup_errors_are_not_treated_as_missing_api(start_mock, use_mock):
+    mock = start_mock(endpoints=30)
+    client = use_mock(mock)
+    mock.view_functions['endpoint_by_name'] = lambda name: (
+        flask.jsonify({'ERSResponse': {'messages': [{'title': 'Unauthorized'}]}}), 401)
+
+    with pytest.raises(requests.exceptions.HTTPError):
+        ise.resolve_endpoint_id_by_mac(client, _first_endpoint(mock)[1])
+    assert mock.calls['GET /ers/config/endpoint'] == 0
+
+
+def test_delete_endpoint_by_mac(start_mock, use_mock, app_client):
+    mock = start_mock(endpoints=5)
+    use_mock(mock)
+    endpoint_id, mac = _first_endpoint(mock)
+
+    response = app_client.post('/delete_endpoint', json={'mac_address': mac.replace(':', '-').lower()})
+
+    assert response.status_code == 200
+    assert endpoint_id not in mock.data.endpoints
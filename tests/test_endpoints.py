@@ -0,0 +1,105 @@
+"""
+Endpoint一覧 (/get_endpoints) のテスト。
+"""
+import json
+import time
+
+import pytest
+
+import ise_api_client as ise
+
+
+def _listing(mock):
+    """
+    模擬ISEの一覧順の [{'mac', 'group_id', 'group_name'}, ...]。
+    """
+    return [{'mac': mac, 'group_id': group_id, 'group_name': mock.data.groups[group_id]}
+            for mac, group_id in (mock.data.endpoints[endpoint_id] for endpoint_id in mock.data.endpoint_ids())]
+
+
+# ---------- 詳細とGroup名の並行取得 ----------
+
+def test_endpoint_details_are_fetched_concurrently(start_mock, use_mock, app_client):
+    mock = start_mock(endpoints=40, latency=0.05)
+    use_mock(mock)
+
+    started = time.monotonic()
+    body = app_client.get('/get_endpoints?source=live&workers=8').get_json()
+
+    assert body['endpoints'] == _listing(mock) # 一覧の順序のまま
+    assert time.monotonic() - started < 40 * 0.05 / 2 # 1件ずつ取得するより十分に速い
+
+
+# ---------- ページング ----------
+
+def test_get_endpoints_live_reads_every_page(start_mock, use_mock, app_client):
+    mock = start_mock(endpoints=250, groups=5)
+    use_mock(mock)
+
+    body = app_client.get('/get_endpoints?source=live').get_json()
+
+    assert body['total'] == 250
+    assert 'incomplete' not in body
+    assert body['endpoints'] == _listing(mock)
+    assert mock.calls['GET /ers/config/endpoint'] == 3 # 100件ずつ3ページ
+
+
+# ---------- 絞り込み・並べ替え・ページング ----------
+
+def test_get_endpoints_live_filters_and_pages(start_mock, use_mock, app_client):
+    mock = start_mock(endpoints=30, groups=3)
+    use_mock(mock)
+    group_name = mock.data.groups[mock.data.group_ids[1]]
+
+    body = app_client.get(f'/get_endpoints?source=live&group={group_name}&sort=-mac&offset=2&limit=3').get_json()
+
+    assert body['total'] == 10
+    macs = [endpoint['mac'] for endpoint in body['endpoints']]
+    expected = sorted((mac for mac, group_id in mock.data.endpoints.values() if group_id == mock.data.group_ids[1]),
+                      reverse=True)
+    assert macs == expected[2:5]
+
+
+def test_filtering_the_snapshot_does_not_call_ise(start_mock, use_mock, app_client):
+    mock = start_mock(endpoints=30, groups=3)
+    use_mock(mock)
+    app_client.get('/get_endpoints')
+    calls = sum(mock.calls.values())
+    mac = _listing(mock)[7]['mac']
+
+    bodies = [app_client.get(f'/get_endpoints?q={mac[:length]}').get_json() for length in range(2, len(mac) + 1)]
+
+    assert sum(mock.calls.values()) == calls # 入力のたびにISEへ問い合わせない
+    assert [endpoint['mac'] for endpoint in bodies[-1]['endpoints']] == [mac]
+    assert all(mac in [endpoint['mac'] for endpoint in body['endpoints']] for body in bodies)
+
+
+# ---------- NDJSONでの逐次応答 ----------
+
+@pytest.mark.parametrize('source', ['live', 'inventory'])
+def test_get_endpoints_streams_ndjson(start_mock, use_mock, app_client, source):
+    mock = start_mock(endpoints=30)
+    use_mock(mock)
+
+    response = app_client.get(f'/get_endpoints?stream=1&source={source}', buffered=False)
+    lines = [json.loads(line) for line in response.iter_encoded() if line.strip()]
+
+    assert response.mimetype == 'application/x-ndjson'
+    assert [line['endpoint'] for line in lines[:-1]] == _listing(mock)
+    assert lines[-1]['done'] is True
+    assert lines[-1]['count'] == 30
+
+
+# ---------- 処理期限 ----------
+
+def test_get_endpoints_live_returns_partial_results_on_deadline(start_mock, use_mock, app_client):
+    mock = start_mock(endpoints=200, latency=0.05)
+    use_mock(mock, deadline_margin=0.2)
+
+    started = time.monotonic()
+    body = app_client.get('/get_endpoints?source=live&workers=2&deadline=1').get_json()
+
+    assert body['incomplete'] is True
+    assert 0 < body['total'] < 200
+    assert body['endpoints'] == _listing(mock)[:body['total']] # 取得できた先頭から順に返す
+    assert time.monotonic() - started < 2
@@ -0,0 +1,51 @@
+"""
+Endpointインベントリ (サーバー側のスナップショット) のテスト。
+"""
+import ise_api_client as ise
+
+DETAIL = 'GET /ers/config/endpoint/<endpoint_id>'
+
+
+def test_get_endpoints_from_inventory(start_mock, use_mock, app_client):
+    mock = start_mock(endpoints=120)
+    use_mock(mock)
+
+    first = app_client.get('/get_endpoints').get_json()
+    calls = mock.calls['GET /ers/config/endpoint']
+    second = app_client.get('/get_endpoints?limit=5').get_json()
+
+    assert first['total'] == second['total'] == 120
+    assert len(second['endpoints']) == 5
+    assert mock.calls['GET /ers/config/endpoint'] == calls # 2回目はスナップショットから応答する
+    assert second['snapshot']['count'] == 120
+    assert second['snapshot']['refreshing'] is False
+    assert second['snapshot']['age_seconds'] is not None
+
+
+def test_refresh_fetches_details_of_new_endpoints_only(start_mock, use_mock, app_client):
+    mock = start_mock(endpoints=20)
+    use_mock(mock)
+    app_client.get('/get_endpoints')
+    added_id = mock.data.add_endpoint('AA:BB:CC:00:00:01', mock.data.group_ids[0])
+    mock.data.delete_endpoint(mock.data.endpoint_ids()[0])
+    details = mock.calls[DETAIL]
+
+    body = app_client.get('/get_endpoints?refresh=1').get_json()
+
+    assert body['total'] == 20
+    assert mock.calls[DETAIL] == details + 1 # 追加された1件だけ詳細を取得する
+    assert ise.get_endpoint_inventory().find_id_by_mac('AA:BB:CC:00:00:01') == added_id
+    assert ise.get_endpoint_inventory().last_refresh_stats == {
+        'total': 20, 'fetched': 1, 'added': 1, 'removed': 1, 'full': False,
+    }
+
+
+def test_inventory_is_persisted_to_sqlite(start_mock, use_mock, tmp_path):
+    mock = start_mock(endpoints=10)
+    client = use_mock(mock, inventory_db=str(tmp_path / 'inventory.db'))
+    ise.get_endpoint_inventory().refresh(client)
+
+    restored = ise.EndpointInventory(str(tmp_path / 'inventory.db'))
+
+    assert restored.loaded
+    assert restored.records() == ise.get_endpoint_inventory().records()
@@ -0,0 +1,31 @@
+"""
+Prometheus形式のメトリクス (/metrics) のテスト。
+"""
+import pytest
+
+import ise_api_client as ise
+
+prometheus_client = pytest.importorskip('prometheus_client')
+
+
+def test_metrics_wrappers_do_not_shadow_prometheus_client():
+    assert isinstance(ise.CACHE_REQUESTS, ise.CounterMetric)
+    assert isinstance(ise.CACHE_REQUESTS._metric, prometheus_client.Counter)
+    assert isinstance(ise.ROUTE_IN_FLIGHT._metric, prometheus_client.Gauge)
+    assert isinstance(ise.ISE_API_REQUEST_SECONDS._metric, prometheus_client.Histogram)
+    assert not hasattr(ise, 'Counter')
+
+
+def test_metrics_route_exposes_api_calls_and_node_state(start_mock, use_mock, app_client):
+    mock = start_mock(endpoints=5)
+    use_mock(mock)
+    app_client.get('/get_endpoints?source=live')
+
+    response = app_client.get('/metrics')
+    text = response.get_data(as_text=True)
+
+    assert response.status_code == 200
+    assert response.content_type.startswith('text/plain')
+    assert 'ise_api_request_duration_seconds_count{api="ers_endpoint",method="GET",status="200"}' in text
+    assert 'ise_client_route_duration_seconds_count{method="GET",route="/get_endpoints",status="200"}' in text
+    assert 'ise_node_up{node="127.0.0.1",role="PAN"} 1.0' in text
@@ -0,0 +1,48 @@
+"""
+テストとベンチマークで使う模擬ISE (benchmark/mock_ise.py) 自体のテスト。
+"""
+import requests
+
+
+def _get(mock, path, **kwargs):
+    return requests.get(f"http://127.0.0.1:{mock.port}{path}", auth=('admin', 'admin'), **kwargs)
+
+
+def test_mock_pages_ers_listing(start_mock):
+    mock = start_mock(endpoints=25)
+
+    first = _get(mock, '/ers/config/endpoint?size=20').json()['SearchResult']
+    second = _get(mock, '/ers/config/endpoint?size=20&page=2').json()['SearchResult']
+
+    assert first['total'] == 25
+    assert len(first['resources']) == 20
+    assert first['nextPage']['href'].endswith('/ers/config/endpoint?size=20&page=2')
+    assert len(second['resources']) == 5
+    assert 'nextPage' not in second
+
+
+def test_mock_rejects_requests_over_the_rate(start_mock):
+    mock = start_mock(rate=1, burst=1, retry_after=3)
+
+    assert _get(mock, '/ers/config/endpointgroup').status_code == 200
+    throttled = _get(mock, '/ers/config/endpointgroup')
+
+    assert throttled.status_code == 429
+    assert throttled.headers['Retry-After'] == '3'
+    assert mock.calls['throttled'] == 1
+
+
+def test_mock_answers_if_none_match_with_304(start_mock):
+    mock = start_mock()
+    path = f"/ers/config/endpoint/{mock.data.endpoint_ids()[0]}"
+
+    etag = _get(mock, path).headers['ETag']
+
+    assert _get(mock, path, headers={'If-None-Match': etag}).status_code == 304
+    assert mock.calls['not_modified'] == 1
+
+
+def test_mock_requires_basic_auth(start_mock):
+    mock = start_mock()
+
+    assert requests.get(f"http://127.0.0.1:{mock.port}/ers/config/endpoint").status_code == 401
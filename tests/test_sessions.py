@@ -0,0 +1,165 @@
+"""
+Active Session一覧 (/sessions) と変化の通知 (/sessions/changes) のテスト。
+"""
+import json
+
+import pytest
+
+
+def _session_macs(mock):
+    return [mock.data.endpoints[endpoint_id][0] for endpoint_id in mock.data.endpoint_ids()[:mock.data.session_count]]
+
+
+@pytest.mark.parametrize('source', ['live', 'snapshot'])
+def test_sessions_are_returned_as_structured_records(start_mock, use_mock, app_client, source):
+    mock = start_mock(endpoints=30, sessions=25)
+    use_mock(mock)
+
+    body = app_client.get(f'/sessions?source={source}&offset=5&limit=10').get_json()
+
+    assert body['noOfActiveSession'] == '25'
+    assert body['total'] == 25
+    assert [session['calling_station_id'] for session in body['sessions']] == _session_macs(mock)[5:15]
+    assert body['sessions'][0]['user_name'] == 'user00005'
+    assert body['sessions'][0]['framed_ip_address'] == '10.0.0.5'
+    assert 'raw_xml' not in body
+
+
+@pytest.mark.parametrize('mac_filter', ['02-00-00-00-00-07', '0200.0000.0007'])
+def test_sessions_are_filtered_by_mac(start_mock, use_mock, app_client, mac_filter):
+    use_mock(start_mock(endpoints=30, sessions=25))
+
+    body = app_client.get(f'/sessions?mac={mac_filter}').get_json()
+
+    assert body['total'] == 1
+    assert body['sessions'][0]['calling_station_id'] == '02:00:00:00:00:07'
+
+
+def test_sessions_filter_by_partial_mac(start_mock, use_mock, app_client):
+    use_mock(start_mock(endpoints=30, sessions=25))
+
+    body = app_client.get('/sessions?mac=00:00:1').get_json()
+
+    assert body['total'] == 9 # 02:00:00:00:00:10 ～ 02:00:00:00:00:18
+
+
+def test_raw_xml_is_opt_in(start_mock, use_mock, app_client):
+    use_mock(start_mock(endpoints=10, sessions=3))
+
+    body = app_client.get('/sessions?raw=1&limit=0').get_json()
+
+    assert body['sessions'] == []
+    assert body['raw_xml'].count('<activeSession>') == 3
+
+
+# ---------- Active Sessionの変化 ----------
+
+def test_session_changes_feed(start_mock, use_mock, app_client):
+    mock = start_mock(endpoints=20, sessions=10)
+    use_mock(mock, session_max_age=0) # 待機中に毎回取得し直す
+
+    snapshot = app_client.get('/sessions').get_json()
+    assert snapshot['total'] == 10
+    seq = snapshot['snapshot']['seq']
+    removed_macs = _session_macs(mock)[8:10]
+
+    mock.data.session_count = 8 # 2台がセッションを切断
+    body = app_client.get(f'/sessions/changes?since={seq}&timeout=10').get_json()
+
+    assert [change['type'] for change in body['changes']] == ['removed', 'removed']
+    assert sorted(change['mac'] for change in body['changes']) == sorted(removed_macs)
+    assert body['seq'] == seq + 2
+    assert 'reset' not in body
+
+    # 変化がなければtimeout秒で空の一覧を返す
+    body = app_client.get(f"/sessions/changes?since={body['seq']}&timeout=0.5").get_json()
+    assert body['changes'] == []
+    assert body['seq'] == seq + 2
+
+
+@pytest.mark.parametrize('since', [-1, 100])
+def test_session_changes_reset_for_unknown_seq(start_mock, use_mock, app_client, since):
+    mock = start_mock(endpoints=5)
+    use_mock(mock)
+    app_client.get('/sessions')
+
+    body = app_client.get(f'/sessions/changes?since={since}&timeout=0').get_json()
+
+    assert body['reset'] is True
+    assert body['changes'] == []
+
+
+def test_session_changes_as_server_sent_events(start_mock, use_mock, app_client):
+    mock = start_mock(endpoints=20, sessions=10)
+    use_mock(mock, session_max_age=0)
+    seq = app_client.get('/sessions').get_json()['snapshot']['seq']
+    mock.data.session_count = 11 # 1台が接続
+
+    response = app_client.get(f'/sessions/changes?since={seq}', headers={'Accept': 'text/event-stream'},
+                              buffered=False)
+    events = response.iter_encoded()
+    event = next(chunk for chunk in events if not chunk.startswith(b':')).decode() # keepaliveは読み飛ばす
+    response.close()
+
+    assert response.mimetype == 'text/event-stream'
+    lines = dict(line.split(': ', 1) for line in event.strip().split('\n'))
+    assert lines['event'] == 'added'
+    assert lines['id'] == str(seq + 1)
+    assert json.loads(lines['data'])['mac'] == _session_macs(mock)[10]
+
+
+# ---------- MACアドレスごとの検索 ----------
+
+def test_session_by_mac_uses_the_mac_address_api(start_mock, use_mock, app_client):
+    mock = start_mock(endpoints=20, sessions=10)
+    use_mock(mock)
+    mac = _session_macs(mock)[3]
+
+    first = app_client.get(f"/session/{mac.lower().replace(':', '-')}").get_json()
+    second = app_client.get(f'/session/{mac}').get_json()
+
+    assert first['active'] is True
+    assert first['session']['user_name'] == 'user00003'
+    assert first['session']['framed_ip_address'] == '10.0.0.3'
+    assert (first['cached'], second['cached']) == (False, True)
+    assert mock.calls['GET /admin/API/mnt/Session/MACAddress/<mac>'] == 1
+    assert mock.calls['GET /admin/API/mnt/Session/ActiveList'] == 0 # 一覧全体は取得しない
+
+
+def test_session_by_mac_without_session_and_invalid_mac(start_mock, use_mock, app_client):
+    mock = start_mock(endpoints=20, sessions=10)
+    use_mock(mock)
+
+    inactive = app_client.get(f'/session/{mock.data.endpoints[mock.data.endpoint_ids()[15]][0]}').get_json()
+    invalid = app_client.get('/session/not-a-mac')
+
+    assert inactive['active'] is False
+    assert inactive['session'] is None
+    assert invalid.status_code == 400
+
+
+def test_sessions_lookup_checks_macs_concurrently(start_mock, use_mock, app_client):
+    mock = start_mock(endpoints=20, sessions=10)
+    use_mock(mock)
+    macs = _session_macs(mock)
+
+    body = app_client.post('/sessions/lookup', json=[macs[0], macs[1], macs[0], 'not-a-mac']).get_json()
+
+    assert [result.get('active') for result in body['results']] == [True, True, True, None]
+    assert (body['total'], body['active'], body['failed']) == (4, 3, 1)
+    assert mock.calls['GET /admin/API/mnt/Session/MACAddress/<mac>'] == 2 # 同じMACアドレスは1回だけ問い合わせる
+
+
+@pytest.mark.parametrize('payload, bad_entry', [
+    ({'mac_addresses': ['02:00:00:00:00:01', 123]}, 'mac_addresses[1]'),
+    ({'endpoints': [5]}, 'endpoints[0]'),
+    ([None], '[0]'),
+    (42, 'JSON'),
+])
+def test_sessions_lookup_rejects_malformed_json(start_mock, use_mock, app_client, payload, bad_entry):
+    use_mock(start_mock(endpoints=5))
+
+    response = app_client.post('/sessions/lookup', json=payload)
+
+    assert response.status_code == 400
+    assert bad_entry in response.get_json()['error']
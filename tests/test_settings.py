@@ -0,0 +1,85 @@
+"""
+設定の再読み込み (reload_settings) とISEClientの作り直しのテスト。
+"""
+import os
+
+import pytest
+
+import ise_api_client as ise
+
+
+@pytest.fixture
+def dotenv_file(tmp_path, monkeypatch):
+    """
+    再読み込みで読む.envを一時ファイルに差し替え、write(内容) で書き換える関数を返す。
+    終了時は.envから反映した環境変数を取り除いて設定を読み直す。
+    """
+    path = tmp_path / '.env'
+    path.write_text('')
+    monkeypatch.setattr(ise, 'ENV_FILE_PATH', str(path))
+    monkeypatch.setattr(ise, '_dotenv_keys', set())
+    monkeypatch.setattr(ise, '_settings', ise.get_settings()) # 再読み込みした設定はテスト後に元に戻す
+    yield path.write_text
+    path.write_text('')
+    ise.reload_settings()
+
+
+@pytest.fixture
+def mock_ports_in_env(monkeypatch):
+    """
+    Settings.from_env() が模擬ISEのポートを読むよう環境変数に設定する。
+    """
+    def set_ports(mock):
+        monkeypatch.setenv('ISE_ERS_PORT', str(mock.port))
+        monkeypatch.setenv('ISE_MNT_PORT', str(mock.port))
+    return set_ports
+
+
+def test_reload_without_connection_changes_keeps_the_client(start_mock, use_mock, dotenv_file, mock_ports_in_env):
+    mock = start_mock()
+    mock_ports_in_env(mock)
+    client = use_mock(mock)
+    client.pan_pool.record_failure('127.0.0.1', 'connection refused')
+
+    dotenv_file('ISE_GROUP_CACHE_TTL=77\n')
+    changed = ise.reload_settings()
+
+    assert changed == ['group_cache_ttl']
+    assert ise.get_ise_client() is client
+    assert client.settings is ise.get_settings()
+    assert client.pan_pool.status()[0]['failure_count'] == 1 # ブレーカーの状態を引き継ぐ
+
+
+def test_reload_with_connection_changes_replaces_and_closes_the_client(
+        start_mock, use_mock, dotenv_file, mock_ports_in_env, tmp_path, monkeypatch):
+    mock = start_mock()
+    mock_ports_in_env(mock)
+    monkeypatch.setenv('ISE_HTTP_CACHE_DB', str(tmp_path / 'http_cache.db'))
+    client = use_mock(mock, http_cache_db=str(tmp_path / 'http_cache.db'))
+    client.ers_request('GET', f"/ers/config/endpoint/{mock.data.endpoint_ids()[0]}")
+
+    dotenv_file('ISE_READ_TIMEOUT=12\n')
+    changed = ise.reload_settings()
+    new_client = ise.get_ise_client()
+
+    assert changed == ['read_timeout']
+    assert new_client is not client
+    assert new_client.timeout == (ise.get_settings().connect_timeout, 12.0)
+    assert client._sessions == {}
+    assert client.response_cache._connection is None
+    assert new_client.response_cache.get(f"/ers/config/endpoint/{mock.data.endpoint_ids()[0]}") is not None
+
+
+def test_dotenv_does_not_override_process_environment(dotenv_file):
+    dotenv_file('ISE_USERNAME=from-dotenv\nISE_LOG_SAMPLE_RATE=5\n')
+    ise.reload_settings()
+
+    assert os.environ['ISE_USERNAME'] == 'admin' # conftestで起動前に設定した環境変数
+    assert ise.get_settings().username == 'admin'
+    assert ise.get_settings().log_sample_rate == 5
+
+    dotenv_file('')
+    ise.reload_settings()
+
+    assert 'ISE_LOG_SAMPLE_RATE' not in os.environ # .envから削除したキーは取り除く
+    assert os.environ['ISE_USERNAME'] == 'admin'
@@ -0,0 +1,50 @@
+"""
+OpenTelemetryによるトレース (ルートとISE APIコールのスパン) のテスト。
+"""
+import pytest
+
+import ise_api_client as ise
+
+pytest.importorskip('opentelemetry.sdk')
+from opentelemetry import trace as otel_trace # noqa: E402
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter # noqa: E402
+
+
+@pytest.fixture
+def spans(monkeypatch):
+    """
+    スパンをメモリに記録するTracerに差し替え、記録済みのスパンを返す関数を返す。
+    """
+    exporter = InMemorySpanExporter()
+    tracer = ise.Tracer(exporter)
+    monkeypatch.setattr(ise, 'tracer', tracer)
+
+    def finished():
+        tracer._provider.force_flush()
+        return exporter.get_finished_spans()
+    yield finished
+    tracer.shutdown()
+
+
+def test_route_and_ise_calls_share_one_trace(start_mock, use_mock, app_client, spans):
+    use_mock(start_mock(endpoints=5))
+
+    response = app_client.get('/get_endpoints?source=live&workers=4')
+    recorded = spans()
+
+    trace_id = response.headers['X-Trace-Id']
+    assert {otel_trace.format_trace_id(span.context.trace_id) for span in recorded} == {trace_id}
+    route_span = next(span for span in recorded if span.parent is None)
+    assert route_span.attributes['http.response.status_code'] == 200
+    ise_calls = [span for span in recorded if span.name.startswith('ISE GET')]
+    assert len(ise_calls) == 7 # 一覧1回、詳細5件 (ワーカースレッド)、Group一覧1回
+    assert all(span.kind == otel_trace.SpanKind.CLIENT for span in ise_calls)
+
+
+def test_tracing_is_disabled_by_default(start_mock, use_mock, app_client):
+    use_mock(start_mock(endpoints=5))
+
+    response = app_client.get('/get_endpoints?source=live')
+
+    assert not ise.tracer.enabled
+    assert 'X-Trace-Id' not in response.headers
@@ -0,0 +1,69 @@
+"""
+MnTのXML応答の逐次解析 (XmlRecordParser) とActive Sessionスナップショットへの取り込みのテスト。
+"""
+import xml.etree.ElementTree as ET
+
+from flask import Response
+import pytest
+
+import ise_api_client as ise
+
+ACTIVE_LIST = (
+    b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    b'<activeList noOfActiveSession="2">'
+    b'<activeSession><user_name>user1</user_name><calling_station_id>AA:BB:CC:DD:EE:01</calling_station_id>'
+    b'<framed_ip_address> 10.0.0.1 </framed_ip_address></activeSession>'
+    b'<activeSession><user_name>user2</user_name><calling_station_id>AA:BB:CC:DD:EE:02</calling_station_id>'
+    b'<framed_ip_address/></activeSession>'
+    b'</activeList>'
+)
+
+
+def test_xml_record_parser_returns_records_as_chunks_complete():
+    root_attrib = {}
+    parser = ise.XmlRecordParser('activeSession', root_attrib)
+    records = []
+    for start in range(0, len(ACTIVE_LIST), 7): # レコードの途中で区切れるチャンク
+        records.extend(parser.feed(ACTIVE_LIST[start:start + 7]))
+    records.extend(parser.close())
+
+    assert root_attrib == {'noOfActiveSession': '2'}
+    assert records == [
+        {'user_name': 'user1', 'calling_station_id': 'AA:BB:CC:DD:EE:01', 'framed_ip_address': '10.0.0.1'},
+        {'user_name': 'user2', 'calling_station_id': 'AA:BB:CC:DD:EE:02', 'framed_ip_address': ''},
+    ]
+
+
+def test_xml_record_parser_yields_first_record_before_document_ends():
+    parser = ise.XmlRecordParser('activeSession')
+    end_of_first = ACTIVE_LIST.index(b'</activeSession>') + len(b'</activeSession>')
+    assert [record['user_name'] for record in parser.feed(ACTIVE_LIST[:end_of_first])] == ['user1']
+
+
+def test_xml_record_parser_single_record_root():
+    parser = ise.XmlRecordParser('sessionParameters')
+    records = parser.feed(b'<sessionParameters><user_name>user1</user_name><passed>true</passed></sessionParameters>')
+    assert records + parser.close() == [{'user_name': 'user1', 'passed': 'true'}]
+
+
+def test_xml_record_parser_truncated_document():
+    parser = ise.XmlRecordParser('activeSession')
+    parser.feed(ACTIVE_LIST[:-20])
+    with pytest.raises(ET.ParseError):
+        parser.close()
+
+
+def test_snapshot_keeps_previous_sessions_when_stream_is_truncated(start_mock, use_mock):
+    mock = start_mock(endpoints=10, sessions=5)
+    client = use_mock(mock)
+    snapshot = ise.SessionSnapshot()
+    snapshot.refresh(client)
+    sessions, _, seq = snapshot.state()
+    mock.view_functions['active_list'] = lambda: Response(ACTIVE_LIST[:-20], mimetype='application/xml')
+
+    with pytest.raises(ET.ParseError):
+        snapshot.refresh(client)
+
+    assert snapshot.state() == (sessions, {'noOfActiveSession': '5'}, seq) # 途中まで受信した内容で置き換えない
+    assert len(sessions) == 5
+    assert snapshot.last_error